@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of hlimap.
+##
+## hlimap is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## hlimap is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+
+'''Message memory and construction time benchmark.
+
+Usage::
+
+    python benchmarks/bench_message.py [number of messages]
+
+Compares the slotted Message with the previous implementation, that kept
+the server, the folder and six boolean flag attributes on the instance
+dict. The memory is measured with tracemalloc, when available (Python 3.4
+or later).
+'''
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..'))
+
+from hlimap.imapmessage import Message, SEEN, DELETED, ANSWERED, FLAGGED, \
+    DRAFT, RECENT
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+class DictMessage(object):
+    '''The Message instance attributes before __slots__.
+    '''
+
+    def __init__(self, server, folder, msg_info):
+        self.server = server
+        self.folder = folder
+        self.envelope = msg_info['ENVELOPE']
+        self.size = msg_info['RFC822.SIZE']
+        self.uid = msg_info['UID']
+        self.get_flags( msg_info['FLAGS'] )
+
+        self.__bodystructure = None
+
+    def get_flags(self, flags):
+        self.seen = SEEN in flags
+        self.deleted = DELETED in flags
+        self.answered = ANSWERED  in flags
+        self.flagged = FLAGGED in flags
+        self.draft = DRAFT in flags
+        self.recent = RECENT in flags
+
+class Server(object):
+    pass
+
+class Folder(object):
+    name = 'INBOX'
+
+    def __init__(self, server):
+        self.server = server
+
+def make_msg_info(count):
+    msg_list = []
+    for uid in range(1, count + 1):
+        envelope = [ 'Mon, 1 Jan 2001 00:00:%02d +0000' % (uid % 60),
+            '=?utf-8?q?Relat=C3=B3rio_n=C2=BA_%d?=' % uid,
+            [[ '=?iso-8859-1?q?Jos=E9_Silva?=', None, 'jose%d' % (uid % 50),
+               'example.com' ]],
+            None, None, [[ None, None, 'user', 'example.com' ]], None, None,
+            None, '<%d@example.com>' % uid ]
+        msg_list.append({ 'UID': uid, 'RFC822.SIZE': 1000 + uid,
+                          'FLAGS': [ SEEN ], 'ENVELOPE': envelope })
+    return msg_list
+
+def measure(message_class, msg_list, server, folder):
+    if tracemalloc:
+        tracemalloc.start()
+    start = time.time()
+    messages = [ message_class(server, folder, msg_info)
+                 for msg_info in msg_list ]
+    elapsed = time.time() - start
+    memory = None
+    if tracemalloc:
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+    return messages, elapsed, memory
+
+def report(name, count, elapsed, memory):
+    line = '%-12s %8.2f us/message' % (name, elapsed / count * 1e6)
+    if memory is not None:
+        line += ' %8d bytes/message' % (memory // count)
+    print(line)
+
+def main():
+    count = 50000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    msg_list = make_msg_info(count)
+    server = Server()
+    folder = Folder(server)
+
+    print('%d messages' % count)
+    messages, elapsed, memory = measure(DictMessage, msg_list, server,
+        folder)
+    report('dict', count, elapsed, memory)
+    del messages
+
+    messages, elapsed, memory = measure(Message, msg_list, server, folder)
+    report('slots', count, elapsed, memory)
+
+    # Lazy decoding, the second access is memoized
+    for label in ('first', 'second'):
+        start = time.time()
+        for message in messages:
+            message.subject
+            message.from_name
+        print('%-12s %8.2f us/message (subject and from, %s access)' % (
+            'decode', (time.time() - start) / count * 1e6, label))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of hlimap.
+##
+## hlimap is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## hlimap is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+
+'''Benchmark suite, against the in-process fake server of fakeimap.
+
+Usage::
+
+    python benchmarks/bench_suite.py [options]
+
+Options:
+
+    --list              list the scenarios and exit
+    --scenario NAME     run only this scenario, can be repeated
+    --large             run the large scenarios too (a million messages,
+                        twenty thousand folders)
+    --repeat N          runs of each operation, 5 by default
+    --output FILE       write the results to FILE instead of stdout
+
+Each scenario is an account (number of folders and of INBOX messages), a
+set of capabilities and a round trip latency. The operations timed are
+FolderTree.refresh_folders (full and lazy), FolderTree.refresh_status,
+MessageList.refresh_messages (unsorted, sorted and threaded),
+MessageList.msg_iter_page (first and middle page) and Message.part.
+
+The results are written as JSON, one entry for each scenario and operation
+with the minimum, median and maximum wall time of the runs, the median time
+spent on the fake server (included on the wall time, latency included) and
+on hlimap, and the round trips of each run. Compare the client times
+between releases to catch regressions.
+'''
+
+import os
+import sys
+import json
+import time
+import platform
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from hlimap.imapserver import ImapServer
+from hlimap.imapmessage import THREADED, SORTED, UNSORTED
+from fakeimap import Account, connection_class, CAPABILITIES
+
+REPEAT = 5
+
+# name: (account parameters, capabilities, latency in seconds)
+SCENARIOS = [
+    ('small', dict(folders=100, messages=10000), 'modern', 0.0),
+    ('legacy', dict(folders=100, messages=10000), 'imap4rev1', 0.0),
+    ('sort', dict(folders=1000, messages=50000), 'sort', 0.0),
+    ('modern', dict(folders=1000, messages=50000), 'modern', 0.0),
+    ('wan-legacy', dict(folders=500, messages=10000), 'imap4rev1', 0.02),
+    ('wan-modern', dict(folders=500, messages=10000), 'modern', 0.02),
+    ]
+
+LARGE_SCENARIOS = [
+    ('huge-mailbox', dict(folders=100, messages=1000000), 'modern', 0.0),
+    ('huge-mailbox-sort', dict(folders=100, messages=1000000), 'sort', 0.0),
+    ('many-folders', dict(folders=20000, messages=1000), 'modern', 0.0),
+    ('many-folders-legacy', dict(folders=20000, messages=1000), 'imap4rev1',
+        0.001),
+    ]
+
+class TextPart(object):
+    '''The text part of the fake messages, with the attributes of the
+    imaplibii body structure parts used by Message.part.
+    '''
+    media = 'TEXT'
+    media_subtype = 'PLAIN'
+
+    def __init__(self, encoding):
+        self.body_fld_enc = encoding
+
+    def query(self):
+        return 'BODY[1]'
+
+    def charset(self):
+        return 'utf-8'
+
+# Operations, each one returns (setup, run) functions, setup is called
+# before each run and isn't timed
+
+def connect(server_class):
+    server = server_class()
+    server.login('user', 'password')
+    return server
+
+def refresh_folders(server_class, lazy=False):
+    server = connect(server_class)
+    def setup():
+        server.folder_tree = None
+    def run():
+        server.refresh_folders(subscribed=False, lazy=lazy)
+    return setup, run
+
+def refresh_status(server_class):
+    server = connect(server_class)
+    server.refresh_folders(subscribed=False)
+    def setup():
+        pass
+    def run():
+        server.folder_tree.refresh_status()
+    return setup, run
+
+def message_list(server_class, style):
+    server = connect(server_class)
+    msg_list = server['INBOX'].message_list
+    msg_list.show_style = style
+    return server, msg_list
+
+def refresh_messages(server_class, style):
+    server, msg_list = message_list(server_class, style)
+    def setup():
+        msg_list.reset()
+    def run():
+        msg_list.refresh_messages()
+    return setup, run
+
+def msg_iter_page(server_class, style, middle=False):
+    server, msg_list = message_list(server_class, style)
+    msg_list.refresh_messages()
+    if middle:
+        msg_list.paginator.current_page = max(1,
+            msg_list.paginator.max_page // 2)
+    def setup():
+        pass
+    def run():
+        for message in msg_list.msg_iter_page():
+            message.subject
+            message.from_name
+    return setup, run
+
+def message_part(server_class):
+    server, msg_list = message_list(server_class, SORTED)
+    message = list(msg_list.msg_iter_page())[0]
+    part = TextPart(server_class.connection_class.account.encoding)
+    def setup():
+        pass
+    def run():
+        message.part(part)
+    return setup, run
+
+OPERATIONS = [
+    ('refresh_folders', refresh_folders, {}),
+    ('refresh_folders_lazy', refresh_folders, { 'lazy': True }),
+    ('refresh_status', refresh_status, {}),
+    ('refresh_messages_unsorted', refresh_messages, { 'style': UNSORTED }),
+    ('refresh_messages_sorted', refresh_messages, { 'style': SORTED }),
+    ('refresh_messages_threaded', refresh_messages, { 'style': THREADED }),
+    ('msg_iter_page_first', msg_iter_page, { 'style': SORTED }),
+    ('msg_iter_page_middle', msg_iter_page, { 'style': SORTED,
+        'middle': True }),
+    ('message_part', message_part, {}),
+    ]
+
+# Measures
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+def measure(server_class, operation, arguments, repeat):
+    stats = server_class.connection_class.stats
+    setup, run = operation(server_class, **arguments)
+    wall = []
+    server = []
+    round_trips = []
+    for count in range(repeat):
+        setup()
+        server_time = stats['server_time']
+        trips = stats['round_trips']
+        start = time.time()
+        run()
+        wall.append(time.time() - start)
+        server.append(stats['server_time'] - server_time)
+        round_trips.append(stats['round_trips'] - trips)
+    return {
+        'wall': { 'min': min(wall), 'median': median(wall),
+                  'max': max(wall) },
+        'server': median(server),
+        'client': median([ total - spent for total, spent in
+                           zip(wall, server) ]),
+        'round_trips': median(round_trips),
+        }
+
+def run_scenario(name, account_args, capabilities, latency, repeat):
+    account = Account(**account_args)
+    server_class = type('BenchServer', (ImapServer,), {
+        'connection_class': connection_class(account,
+            CAPABILITIES[capabilities], latency) })
+    results = []
+    for operation_name, operation, arguments in OPERATIONS:
+        # An error stops the suite, there's nothing to compare
+        result = { 'scenario': name, 'operation': operation_name,
+                   'repeat': repeat }
+        result.update(measure(server_class, operation, arguments, repeat))
+        results.append(result)
+        sys.stderr.write('%-20s %-28s %10.4f s\n' % (name, operation_name,
+            result['wall']['median']))
+    return results
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--list', action='store_true', default=False)
+    parser.add_option('--scenario', action='append', default=[])
+    parser.add_option('--large', action='store_true', default=False)
+    parser.add_option('--repeat', type='int', default=REPEAT)
+    parser.add_option('--output', default=None)
+    options, args = parser.parse_args()
+
+    scenarios = SCENARIOS
+    if options.large or options.scenario:
+        scenarios = SCENARIOS + LARGE_SCENARIOS
+    if options.scenario:
+        scenarios = [ scenario for scenario in scenarios
+                      if scenario[0] in options.scenario ]
+    if options.list:
+        for name, account_args, capabilities, latency in scenarios:
+            print('%-20s %-10s latency %.3fs %s' % (name, capabilities,
+                latency, ', '.join([ '%s=%s' % item for item in
+                sorted(account_args.items()) ])))
+        return
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'scenarios': dict([ (name, { 'account': account_args,
+            'capabilities': capabilities, 'latency': latency })
+            for name, account_args, capabilities, latency in scenarios ]),
+        'results': [],
+        }
+    for name, account_args, capabilities, latency in scenarios:
+        report['results'].extend(run_scenario(name, account_args,
+            capabilities, latency, options.repeat))
+
+    output = sys.stdout
+    if options.output:
+        output = open(options.output, 'w')
+    try:
+        json.dump(report, output, indent=2, sort_keys=True)
+        output.write('\n')
+    finally:
+        if options.output:
+            output.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1103 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of hlimap.
+##
+## hlimap is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## hlimap is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+
+'''In-process fake IMAP server, for the tests and the benchmarks.
+
+L{FakeIMAP4P} has the part of the imaplibii IMAP4P interface used by hlimap:
+the high level methods (list, lsub, status, select, fetch_smart,
+search_smart, sort_smart, thread_smart, ...) and the raw command interface
+(_imap.send_command, _imap.read_responses, _imap.send and _imap.readline).
+
+The mailboxes are synthetic, the messages are generated from their UIDs when
+fetched, so that an L{Account} can have millions of messages and tens of
+thousands of folders without using much memory. Every fifth message starts
+a thread, the next four are replies to it.
+
+Each round trip waits for the configured latency. The raw commands are
+timestamped when sent, so pipelined commands wait for the latency once.
+The time spent on the fake, generating the responses and waiting, is added
+to the stats dict of the connection class (server_time and round_trips), so
+that the benchmarks can tell it apart from the time spent on hlimap. The
+commands received are logged there too (commands), as (command name,
+number of items) tuples::
+
+    >>> account = Account(folders=1000, messages=100000)
+    >>> class BenchServer(ImapServer):
+    ...     connection_class = connection_class(account, MODERN, 0.005)
+    >>> M = BenchServer()
+    >>> BenchServer.connection_class.stats['server_time']
+'''
+
+# Imports
+import re
+import time
+import base64
+import quopri
+import calendar
+import threading
+
+# Exceptions:
+
+class FakeServerError(Exception): pass
+
+# Constants:
+
+# Capability sets
+IMAP4REV1 = ( 'IMAP4REV1', )
+SORT = IMAP4REV1 + ( 'SORT', 'THREAD=ORDEREDSUBJECT', 'THREAD=REFERENCES' )
+MODERN = SORT + ( 'LITERAL+', 'UIDPLUS', 'UNSELECT', 'ENABLE', 'CONDSTORE',
+    'QRESYNC', 'ESEARCH', 'ESORT', 'CONTEXT=SEARCH', 'CONTEXT=SORT',
+    'LIST-STATUS', 'MULTIAPPEND', 'MOVE', 'IDLE' )
+CAPABILITIES = { 'imap4rev1': IMAP4REV1, 'sort': SORT, 'modern': MODERN }
+
+DELIMITER = '/'
+# Seconds readline waits for a response line
+READLINE_TIMEOUT = 10
+THREAD_SIZE = 5
+# Date of the first message, one message every ten minutes
+BASE_TIME = calendar.timegm((2010, 1, 1, 0, 0, 0))
+MESSAGE_INTERVAL = 600
+
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep',
+    'Oct', 'Nov', 'Dec')
+DAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+WORDS = ( 'lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur',
+    'adipiscing', 'elit', 'sed', 'do', 'eiusmod', 'tempor', 'incididunt',
+    'ut', 'labore', 'et', 'dolore', 'magna', 'aliqua', u'relat\xf3rio' )
+
+_ITEM = re.compile(r'(BODY(?:\.PEEK)?\[[^\]]*\])(?:<(\d+)(?:\.(\d+))?>)?|'
+    r'[A-Z0-9.]+', re.I)
+_RETURN = re.compile(r'^RETURN \(([^)]*)\) ', re.I)
+_LITERAL_SIZE = re.compile(r'\{(\d+)(\+?)\}$')
+_CHANGEDSINCE = re.compile(r'\s*\(CHANGEDSINCE (\d+)[^)]*\)\s*$', re.I)
+_NUMBER = re.compile(r'^\d+$')
+_LITERAL = re.compile(r'\{(\d+)\+?\}\r?\n')
+
+# The fake has its own parser, it doesn't depend on the code tested
+
+def parse_arguments(line):
+    '''Parses the arguments of a command to nested lists. Numbers are
+    converted to int, quoted strings and literals to str.
+    '''
+    stack = [[]]
+    pos = 0
+    length = len(line)
+    while pos < length:
+        char = line[pos]
+        if char in ' \r\n':
+            pos += 1
+        elif char == '(':
+            new = []
+            stack[-1].append(new)
+            stack.append(new)
+            pos += 1
+        elif char == ')':
+            if len(stack) > 1:
+                stack.pop()
+            pos += 1
+        elif char == '"':
+            pos += 1
+            chars = []
+            while pos < length and line[pos] != '"':
+                if line[pos] == '\\':
+                    pos += 1
+                chars.append(line[pos:pos+1])
+                pos += 1
+            stack[-1].append(''.join(chars))
+            pos += 1
+        elif char == '{' and _LITERAL.match(line, pos):
+            match = _LITERAL.match(line, pos)
+            size = int(match.group(1))
+            stack[-1].append(line[match.end():match.end() + size])
+            pos = match.end() + size
+        else:
+            start = pos
+            while pos < length and line[pos] not in ' ()\r\n':
+                pos += 1
+            atom = line[start:pos]
+            if _NUMBER.match(atom):
+                atom = int(atom)
+            stack[-1].append(atom)
+    return stack[0]
+
+def parse_sequence_set(sequence_set):
+    '''Expands a sequence set ('1,3:5') to a list of numbers.
+    '''
+    numbers = []
+    for item in str(sequence_set).split(','):
+        if ':' in item:
+            first, last = sorted([ int(number) for number in
+                                   item.split(':') ])
+            numbers.extend(range(first, last + 1))
+        elif item:
+            numbers.append(int(item))
+    return numbers
+
+def quote(text):
+    return '"%s"' % text.replace('\\', '\\\\').replace('"', '\\"')
+
+def ordered_set(uid_list):
+    '''Sequence set keeping the order of the UIDs, for ESORT.
+    '''
+    ranges = []
+    index = 0
+    while index < len(uid_list):
+        first = last = uid_list[index]
+        index += 1
+        step = None
+        while index < len(uid_list) and (
+            uid_list[index] - last in (1, -1) and
+            step in (None, uid_list[index] - last)):
+            step = uid_list[index] - last
+            last = uid_list[index]
+            index += 1
+        if first == last:
+            ranges.append('%d' % first)
+        else:
+            ranges.append('%d:%d' % (first, last))
+    return ','.join(ranges)
+
+def native(data):
+    '''imaplibii returns str, bytes on Python 2.
+    '''
+    if str is bytes and not isinstance(data, str):
+        return data.encode('utf-8')
+    if str is not bytes and isinstance(data, bytes):
+        return data.decode('ascii')
+    return data
+
+def command_name(command):
+    '''SELECT, UID FETCH, ...
+    '''
+    words = command.split(' ', 2)
+    if words[0].upper() == 'UID' and len(words) > 1:
+        return 'UID %s' % words[1].upper()
+    return words[0].upper()
+
+def literal(text):
+    return '{%d}\r\n%s' % (len(text), text)
+
+class MailboxInfo(object):
+    '''A LIST or LSUB response, as returned by imaplibii.
+    '''
+
+    def __init__(self, name, flags=()):
+        self.name = name
+        self.flags = list(flags)
+        self.delimiter = DELIMITER
+        self.parts = name.split(DELIMITER)
+
+    def noselect(self):
+        return r'\Noselect' in self.flags
+
+class Mailbox(object):
+    '''Synthetic mailbox, the messages have the UIDs 1 to messages.
+    '''
+
+    def __init__(self, name, messages, uid_validity, text_size=4096,
+        encoding='QUOTED-PRINTABLE'):
+        '''
+        @param text_size: size of the text part of the messages
+        @param encoding: transfer encoding of the text part, 7BIT, BASE64
+            or QUOTED-PRINTABLE
+        '''
+        self.name = name
+        self.messages = messages
+        self.uid_validity = uid_validity
+        self.text_size = text_size
+        self.encoding = encoding
+        # Results of the last searches and sorts
+        self.results = {}
+        # Changes made with store, expunge and append: HIGHESTMODSEQ, the
+        # mod-sequence of the messages changed, the flags stored and the
+        # messages expunged
+        self.modseq = 1
+        self.changes = {}
+        self.stored = {}
+        self.expunged = set()
+
+    # Changes
+
+    def change(self, uid_list):
+        self.modseq += 1
+        for uid in uid_list:
+            self.changes[uid] = self.modseq
+        self.results = {}
+
+    def store(self, uid_list, flags):
+        for uid in uid_list:
+            self.stored[uid] = list(flags)
+        self.change(uid_list)
+
+    def expunge(self, uid_list):
+        self.expunged.update(uid_list)
+        self.change([])
+
+    def append(self, count):
+        '''Adds count messages, with the next UIDs.
+        '''
+        self.messages += count
+        self.change(range(self.messages - count + 1, self.messages + 1))
+
+    def exists(self):
+        return self.messages - len(self.expunged)
+
+    def present(self, uid):
+        return 1 <= uid <= self.messages and uid not in self.expunged
+
+    # Messages
+
+    def flags(self, uid):
+        if uid in self.stored:
+            return list(self.stored[uid])
+        flags = []
+        if uid % 4:
+            flags.append(r'\Seen')
+        if not uid % 50:
+            flags.append(r'\Flagged')
+        return flags
+
+    def unseen(self):
+        return self.messages // 4
+
+    def size(self, uid):
+        return 2000 + (uid * 7919) % 20000
+
+    def timestamp(self, uid):
+        return BASE_TIME + uid * MESSAGE_INTERVAL
+
+    def internaldate(self, uid):
+        date = time.gmtime(self.timestamp(uid))
+        return '%02d-%s-%04d %02d:%02d:%02d +0000' % (date[2],
+            MONTHS[date[1] - 1], date[0], date[3], date[4], date[5])
+
+    def date(self, uid):
+        date = time.gmtime(self.timestamp(uid))
+        return '%s, %02d %s %04d %02d:%02d:%02d +0000' % (DAYS[date[6]],
+            date[2], MONTHS[date[1] - 1], date[0], date[3], date[4], date[5])
+
+    def root(self, uid):
+        '''First message of the thread.
+        '''
+        return uid - (uid - 1) % THREAD_SIZE
+
+    def subject(self, uid):
+        subject = 'Topic %d' % self.root(uid)
+        if uid != self.root(uid):
+            subject = 'Re: ' + subject
+        return subject
+
+    def sender(self, uid):
+        number = uid % 97
+        return ('Sender %d' % number, 'sender%d' % number, 'example.com')
+
+    def message_id(self, uid):
+        return '<%d.%d@example.com>' % (uid, self.uid_validity)
+
+    def envelope(self, uid):
+        name, mailbox, host = self.sender(uid)
+        sender = [[ name, None, mailbox, host ]]
+        in_reply_to = None
+        if uid != self.root(uid):
+            in_reply_to = self.message_id(self.root(uid))
+        return [ self.date(uid), self.subject(uid), sender, sender, sender,
+            [[ None, None, 'user', 'example.com' ]], None, None, in_reply_to,
+            self.message_id(uid) ]
+
+    def header_fields(self, uid):
+        name, mailbox, host = self.sender(uid)
+        fields = [ ('Date', self.date(uid)),
+            ('From', '%s <%s@%s>' % (name, mailbox, host)),
+            ('To', 'user@example.com'),
+            ('Subject', self.subject(uid)),
+            ('Message-ID', self.message_id(uid)) ]
+        if uid != self.root(uid):
+            fields.append(('In-Reply-To', self.message_id(self.root(uid))))
+            fields.append(('References', self.message_id(self.root(uid))))
+        fields.extend([ ('MIME-Version', '1.0'),
+            ('Content-Type', 'text/plain; charset=utf-8'),
+            ('Content-Transfer-Encoding', self.encoding) ])
+        return fields
+
+    def text(self, uid):
+        '''The decoded text part.
+        '''
+        words = []
+        size = 0
+        index = uid
+        while size < self.text_size:
+            word = WORDS[index % len(WORDS)]
+            words.append(word)
+            size += len(word) + 1
+            index += 1
+            if not index % 12:
+                words.append('\n')
+        return ' '.join(words)[:self.text_size]
+
+    def body(self, uid):
+        '''The encoded text part.
+        '''
+        text = self.text(uid).encode('utf-8')
+        if self.encoding == 'BASE64':
+            encoded = base64.b64encode(text)
+            text = b'\r\n'.join([ encoded[start:start + 76] for start in
+                                   range(0, len(encoded), 76) ])
+        elif self.encoding == 'QUOTED-PRINTABLE':
+            text = quopri.encodestring(text)
+        return native(text)
+
+    def section(self, uid, section):
+        section = section.upper()
+        fields = self.header_fields(uid)
+        if section.startswith('HEADER.FIELDS'):
+            names = [ name.lower() for name in
+                      section.split('(', 1)[1].rstrip(')').split() ]
+            fields = [ field for field in fields
+                       if field[0].lower() in names ]
+            section = 'HEADER'
+        header = ''.join([ '%s: %s\r\n' % field for field in fields ]) + '\r\n'
+        if section == 'HEADER':
+            return header
+        elif section in ('1', 'TEXT'):
+            return self.body(uid)
+        elif section == '':
+            return header + self.body(uid)
+        raise FakeServerError('Unknown section %s' % section)
+
+    def fetch(self, uid, items):
+        '''Fetch response of a message.
+
+        @param items: list of (item name, section, offset, length) tuples
+        '''
+        result = {}
+        for name, section, offset, length in items:
+            if section is not None:
+                data = self.section(uid, section)
+                key = 'BODY[%s]' % section
+                if offset is not None:
+                    data = data[offset:]
+                    if length is not None:
+                        data = data[:length]
+                    key = '%s<%d>' % (key, offset)
+                result[key] = data
+            elif name == 'UID':
+                result['UID'] = uid
+            elif name == 'FLAGS':
+                result['FLAGS'] = self.flags(uid)
+            elif name == 'RFC822.SIZE':
+                result['RFC822.SIZE'] = self.size(uid)
+            elif name == 'INTERNALDATE':
+                result['INTERNALDATE'] = self.internaldate(uid)
+            elif name == 'ENVELOPE':
+                result['ENVELOPE'] = self.envelope(uid)
+            else:
+                raise FakeServerError('Unknown fetch item %s' % name)
+        result.setdefault('UID', uid)
+        return result
+
+    # Search and sort
+
+    def search(self, expression):
+        '''Evaluates a search expression, the keys understood are ALL, SEEN,
+        UNSEEN, FLAGGED, UNFLAGGED, UID, SUBJECT, FROM, NOT, OR and
+        parenthesized lists.
+
+        @return: sorted list of UIDs
+        '''
+        key = ('SEARCH', expression)
+        if key not in self.results:
+            tokens = parse_arguments(expression)
+            if tokens and str(tokens[0]).upper() == 'CHARSET':
+                tokens = tokens[2:]
+            self.results[key] = sorted(self.criteria(tokens) -
+                self.expunged)
+        return self.results[key]
+
+    def criteria(self, tokens):
+        result = None
+        position = 0
+        while position < len(tokens):
+            matches, position = self.criterion(tokens, position)
+            if result is None:
+                result = matches
+            else:
+                result &= matches
+        if result is None:
+            result = set(range(1, self.messages + 1))
+        return result
+
+    def criterion(self, tokens, position):
+        token = tokens[position]
+        if isinstance(token, list):
+            return self.criteria(token), position + 1
+        key = str(token).upper()
+        uids = range(1, self.messages + 1)
+        if key == 'ALL':
+            return set(uids), position + 1
+        elif key == 'NOT':
+            matches, position = self.criterion(tokens, position + 1)
+            return set(uids) - matches, position
+        elif key == 'OR':
+            first, position = self.criterion(tokens, position + 1)
+            second, position = self.criterion(tokens, position)
+            return first | second, position
+        elif key in ('SEEN', 'UNSEEN', 'FLAGGED', 'UNFLAGGED'):
+            flag = '\\' + key.replace('UN', '').capitalize()
+            wanted = not key.startswith('UN')
+            return set([ uid for uid in uids
+                         if (flag in self.flags(uid)) == wanted ]), position + 1
+        elif key == 'UID':
+            sequence_set = str(tokens[position + 1]).replace('*',
+                str(self.messages))
+            return (set(parse_sequence_set(sequence_set)) & set(uids),
+                position + 2)
+        elif key in ('SUBJECT', 'FROM'):
+            text = str(tokens[position + 1]).lower()
+            if key == 'SUBJECT':
+                value = self.subject
+            else:
+                value = lambda uid: '%s <%s@%s>' % self.sender(uid)
+            return set([ uid for uid in uids
+                         if text in value(uid).lower() ]), position + 2
+        elif key == 'BODY':
+            text = str(tokens[position + 1]).lower()
+            return set([ uid for uid in uids
+                         if text in self.text(uid).lower() ]), position + 2
+        raise FakeServerError('Unknown search key %s' % key)
+
+    def sort(self, program, expression):
+        '''SORT command, the keys understood are ARRIVAL, DATE, SIZE,
+        SUBJECT and FROM.
+        '''
+        key = ('SORT', program.upper(), expression)
+        if key in self.results:
+            return self.results[key]
+        uid_list = list(self.search(expression))
+        keys = parse_arguments(program.strip())
+        if keys and isinstance(keys[0], list):
+            keys = keys[0]
+        # RFC 5256: the base subject and the first From mailbox, with the
+        # i;ascii-casemap collation
+        functions = {
+            'ARRIVAL': lambda uid: uid,
+            'DATE': lambda uid: uid,
+            'SIZE': self.size,
+            'SUBJECT': lambda uid: 'TOPIC %d' % self.root(uid),
+            'FROM': lambda uid: self.sender(uid)[1].upper(),
+            }
+        # From the least significant key, the sort is stable
+        keys = [ str(item).upper() for item in keys ]
+        position = len(keys) - 1
+        while position >= 0:
+            reverse = position > 0 and keys[position - 1] == 'REVERSE'
+            if keys[position] not in functions:
+                raise FakeServerError('Unknown sort key %s' % keys[position])
+            uid_list.sort(key=functions[keys[position]], reverse=reverse)
+            position -= reverse and 2 or 1
+        self.results[key] = uid_list
+        return uid_list
+
+    def thread(self, expression):
+        '''THREAD command, the threads ordered by the date of the first
+        message.
+        '''
+        key = ('THREAD', expression)
+        if key in self.results:
+            return self.results[key]
+        threads = []
+        current = None
+        for uid in self.search(expression):
+            root = self.root(uid)
+            if current is None or current[0] != root:
+                current = [ root, [] ]
+                threads.append(current)
+            if uid != root:
+                current[1].append(uid)
+        nested = []
+        for root, children in threads:
+            if len(children) == 1:
+                nested.append([ root, children[0] ])
+            else:
+                nested.append([ root ] + [ [ child ] for child in children ])
+        self.results[key] = nested
+        return nested
+
+class Account(object):
+    '''Synthetic account.
+
+    There's an INBOX with the given number of messages, the other folders
+    are split on two levels, 'Folder0001/Sub0001', and have
+    folder_messages messages each.
+    '''
+
+    def __init__(self, folders=100, messages=10000, folder_messages=20,
+        text_size=4096, encoding='QUOTED-PRINTABLE'):
+        self.folders = folders
+        self.messages = messages
+        self.folder_messages = folder_messages
+        self.text_size = text_size
+        self.encoding = encoding
+        self.mailboxes = {}
+        self.names = self.folder_names()
+        # The UIDVALIDITY of each mailbox doesn't depend on the order they
+        # are used
+        self.positions = dict([ (name, position) for position, name in
+                                enumerate(self.names) ])
+        self.lock = threading.Lock()
+
+    def folder_names(self):
+        names = [ 'INBOX' ]
+        other = self.folders - 1
+        roots = max(1, int(other ** 0.5))
+        count = 0
+        for root in range(1, roots + 1):
+            if count >= other:
+                break
+            root_name = 'Folder%04d' % root
+            names.append(root_name)
+            count += 1
+            for sub in range(1, other // roots + 1):
+                if count >= other:
+                    break
+                names.append('%s%sSub%04d' % (root_name, DELIMITER, sub))
+                count += 1
+        return names
+
+    def has_children(self, name):
+        return name.startswith('Folder') and DELIMITER not in name
+
+    def mailbox(self, name):
+        if name.upper() == 'INBOX':
+            name = 'INBOX'
+        with self.lock:
+            if name not in self.mailboxes:
+                if name not in self.positions:
+                    raise FakeServerError('No such mailbox %s' % name)
+                messages = self.folder_messages
+                if name == 'INBOX':
+                    messages = self.messages
+                self.mailboxes[name] = Mailbox(name, messages,
+                    1000 + self.positions[name], self.text_size,
+                    self.encoding)
+            return self.mailboxes[name]
+
+    def list(self, pattern):
+        '''Mailbox names matching a LIST pattern.
+        '''
+        regex = re.compile('^%s$' % re.escape(pattern).replace(r'\*', '.*'
+            ).replace('\\%', '[^%s]*' % re.escape(DELIMITER)).replace('%',
+            '[^%s]*' % re.escape(DELIMITER)), re.I)
+        return [ name for name in self.names if regex.match(name) ]
+
+    def status(self, name, items):
+        mailbox = self.mailbox(name)
+        values = { 'MESSAGES': mailbox.exists(), 'RECENT': 0,
+            'UIDNEXT': mailbox.messages + 1,
+            'UIDVALIDITY': mailbox.uid_validity,
+            'UNSEEN': mailbox.unseen(), 'HIGHESTMODSEQ': mailbox.modseq }
+        return dict([ (item.upper(), values[item.upper()])
+                      for item in items ])
+
+class Connection(object):
+    '''The raw command interface, IMAP4P._imap.
+    '''
+
+    def __init__(self, imap):
+        self.imap = imap
+        self.number = 0
+        # { tag: (time when the response arrives, response lines), ... }
+        self.pending = {}
+        # Command being received: [ tag, text received, literal octets
+        # still expected, incomplete line ]
+        self.partial = None
+        # Continuation requests and IDLE responses, read with readline
+        self.lines = []
+        self.condition = threading.Condition()
+        # Tag of the IDLE command running
+        self.idling = None
+
+    def send_command(self, command, read_resp=True):
+        self.number += 1
+        tag = 'BENCH%d' % self.number
+        if command.upper() == 'IDLE':
+            self.idling = tag
+            self.push('+ idling')
+            return tag
+        if _LITERAL_SIZE.search(command):
+            self.partial = [ tag, '', 0, '' ]
+            self.receive(command + '\r\n')
+            return tag
+        return self.execute(tag, command, read_resp)
+
+    def push(self, line):
+        '''Adds a response line, to be read with readline. Used to send the
+        untagged responses during IDLE.
+        '''
+        with self.condition:
+            self.lines.append(line)
+            self.condition.notify()
+
+    def readline(self):
+        deadline = time.time() + READLINE_TIMEOUT
+        with self.condition:
+            while not self.lines:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise FakeServerError('No response to read')
+                self.condition.wait(remaining)
+            return self.lines.pop(0)
+
+    def send(self, data):
+        '''The literal data and the rest of the command lines, or the DONE
+        that ends an IDLE command.
+        '''
+        if self.partial is None and self.idling:
+            tag, self.idling = self.idling, None
+            self.push('%s OK IDLE terminated' % tag)
+            return
+        if not isinstance(data, str):
+            # One character per octet, like the literal sizes
+            data = data.decode('latin-1')
+        self.receive(data)
+
+    def receive(self, data):
+        partial = self.partial
+        while data:
+            if partial[2]:
+                chunk = data[:partial[2]]
+                partial[1] += chunk
+                partial[2] -= len(chunk)
+                data = data[len(chunk):]
+                continue
+            position = data.find('\r\n')
+            if position < 0:
+                partial[3] += data
+                return
+            line = partial[3] + data[:position]
+            data = data[position + 2:]
+            partial[3] = ''
+            match = _LITERAL_SIZE.search(line)
+            if not match:
+                self.partial = None
+                self.execute(partial[0], partial[1] + line, False)
+                return
+            partial[1] += line + '\r\n'
+            partial[2] = int(match.group(1))
+            if not match.group(2):
+                self.push('+ Ready for literal data')
+
+    def execute(self, tag, command, read_resp):
+        imap = self.imap
+        start = time.time()
+        try:
+            lines = imap.execute(tag, command)
+        except (FakeServerError, IndexError, ValueError) as error:
+            lines = [ '%s BAD %s' % (tag, error) ]
+        imap.log(command_name(command), len([ line for line in lines
+                                              if line[:1] == '*' ]))
+        self.pending[tag] = (time.time() + imap.latency, lines)
+        imap.add_time(start, False)
+        if read_resp:
+            return self.read_responses(tag)
+        return tag
+
+    def read_responses(self, tag):
+        start = time.time()
+        arrival, lines = self.pending.pop(tag)
+        delay = arrival - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        self.imap.add_time(start)
+        return lines
+
+class FakeIMAP4P(object):
+    '''Fake IMAP4P connected to an L{Account}.
+    '''
+    account = None
+    capabilities = MODERN
+    latency = 0.0
+    stats = { 'lock': threading.Lock(), 'server_time': 0.0,
+              'round_trips': 0, 'commands': [] }
+
+    def __init__(self, host='localhost', port=None, ssl=False, keyfile=None,
+        certfile=None, autologout=False):
+        self._imap = Connection(self)
+        self.selected = None
+        self.enabled = []
+        # Tag of the raw command being executed
+        self.tag = None
+
+    # Accounting
+
+    def add_time(self, start, round_trip=True):
+        with self.stats['lock']:
+            self.stats['server_time'] += time.time() - start
+            if round_trip:
+                self.stats['round_trips'] += 1
+
+    def round_trip(self, start, command, items=0):
+        delay = self.latency - (time.time() - start)
+        if delay > 0:
+            time.sleep(delay)
+        self.add_time(start)
+        self.log(command, items)
+
+    def log(self, command, items=0):
+        with self.stats['lock']:
+            self.stats['commands'].append((command, items))
+
+    # High level interface
+
+    def has_capability(self, capability):
+        return capability.upper() in self.capabilities
+
+    def login(self, username, password):
+        self.round_trip(time.time(), 'LOGIN')
+        return 'OK'
+
+    def logout(self):
+        pass
+
+    def list(self, reference, pattern, command='LIST'):
+        start = time.time()
+        result = [ MailboxInfo(name) for name in self.account.list(pattern) ]
+        self.round_trip(start, command, len(result))
+        return result
+
+    def lsub(self, reference, pattern):
+        return self.list(reference, pattern, 'LSUB')
+
+    def status(self, mailbox, items):
+        start = time.time()
+        result = self.account.status(mailbox, items.strip('()').split())
+        self.round_trip(start, 'STATUS', 1)
+        return result
+
+    def select(self, mailbox, command='SELECT'):
+        start = time.time()
+        self.selected = self.account.mailbox(mailbox)
+        result = { 'FLAGS': [ r'\Seen', r'\Answered', r'\Flagged',
+                r'\Deleted', r'\Draft' ],
+            'PERMANENTFLAGS': [ r'\Seen', r'\Answered', r'\Flagged',
+                r'\Deleted', r'\Draft', r'\*' ],
+            'EXISTS': self.selected.exists(), 'RECENT': 0,
+            'UIDNEXT': self.selected.messages + 1,
+            'UIDVALIDITY': self.selected.uid_validity }
+        if self.selected.unseen():
+            result['UNSEEN'] = 4
+        if 'CONDSTORE' in self.enabled or 'QRESYNC' in self.enabled:
+            result['HIGHESTMODSEQ'] = self.selected.modseq
+        self.round_trip(start, command, result['EXISTS'])
+        return result
+
+    def examine(self, mailbox):
+        return self.select(mailbox, 'EXAMINE')
+
+    def unselect(self):
+        self.selected = None
+
+    def close(self):
+        self.selected = None
+
+    def fetch_smart(self, message_list, query):
+        start = time.time()
+        if not hasattr(message_list, '__iter__'):
+            message_list = [ message_list ]
+        items = self.fetch_items(query)
+        mailbox = self.selected
+        result = dict([ (uid, mailbox.fetch(uid, items))
+            for uid in message_list if mailbox.present(uid) ])
+        self.round_trip(start, 'FETCH', len(message_list))
+        return result
+
+    def search_smart(self, expression):
+        start = time.time()
+        result = list(self.selected.search(expression))
+        self.round_trip(start, 'SEARCH', len(result))
+        return result
+
+    def sort_smart(self, program, charset, expression):
+        start = time.time()
+        result = list(self.selected.sort(program, expression))
+        self.round_trip(start, 'SORT', len(result))
+        return result
+
+    def thread_smart(self, algorithm, charset, expression):
+        start = time.time()
+        result = self.selected.thread(expression)
+        self.round_trip(start, 'THREAD', len(result))
+        return result
+
+    def expunge(self):
+        self.round_trip(time.time(), 'EXPUNGE')
+
+    # Raw commands
+
+    def fetch_items(self, query):
+        items = []
+        for match in _ITEM.finditer(query.strip('()')):
+            if match.group(1):
+                section = match.group(1).split('[', 1)[1][:-1]
+                offset = length = None
+                if match.group(2) is not None:
+                    offset = int(match.group(2))
+                if match.group(3) is not None:
+                    length = int(match.group(3))
+                items.append(('BODY', section, offset, length))
+            else:
+                items.append((match.group(0).upper(), None, None, None))
+        return items
+
+    def execute(self, tag, command):
+        '''Runs a raw command.
+
+        @return: the response lines
+        '''
+        self.tag = tag
+        name, arguments = (command.split(' ', 1) + [ '' ])[:2]
+        name = name.upper()
+        uid = False
+        if name == 'UID':
+            uid = True
+            name, arguments = (arguments.split(' ', 1) + [ '' ])[:2]
+            name = name.upper()
+        method = getattr(self, 'command_%s' % name.lower(), None)
+        if method is None:
+            raise FakeServerError('Unknown command %s' % name)
+        return method(arguments, uid) + [ '%s OK %s completed' % (tag,
+            name) ]
+
+    def command_noop(self, arguments, uid):
+        return []
+
+    def command_enable(self, arguments, uid):
+        enabled = [ capability for capability in arguments.upper().split()
+                    if capability in self.capabilities ]
+        self.enabled.extend(enabled)
+        return [ '* ENABLED %s' % ' '.join(enabled) ]
+
+    def command_select(self, arguments, uid):
+        self.selected = self.account.mailbox(str(parse_arguments(arguments)[0]))
+        return [ r'* FLAGS (\Seen \Answered \Flagged \Deleted \Draft)',
+            '* %d EXISTS' % self.selected.exists(), '* 0 RECENT',
+            '* OK [UIDVALIDITY %d] UIDs valid' % self.selected.uid_validity,
+            '* OK [UIDNEXT %d] Predicted next UID' % (
+                self.selected.messages + 1) ]
+
+    command_examine = command_select
+
+    def command_status(self, arguments, uid):
+        tokens = parse_arguments(arguments)
+        status = self.account.status(str(tokens[0]),
+            [ str(item) for item in tokens[1] ])
+        return [ '* STATUS %s (%s)' % (quote(str(tokens[0])),
+            ' '.join([ '%s %s' % item for item in status.items() ])) ]
+
+    def command_list(self, arguments, uid, name='LIST'):
+        tokens = parse_arguments(arguments)
+        status_items = None
+        if len(tokens) > 3 and str(tokens[2]).upper() == 'RETURN':
+            options = tokens[3]
+            if options and str(options[0]).upper() == 'STATUS':
+                status_items = [ str(item) for item in options[1] ]
+        lines = []
+        for mailbox in self.account.list(str(tokens[1])):
+            flags = self.account.has_children(mailbox) and \
+                r'\HasChildren' or r'\HasNoChildren'
+            lines.append('* %s (%s) "%s" %s' % (name, flags, DELIMITER,
+                quote(mailbox)))
+            if status_items:
+                status = self.account.status(mailbox, status_items)
+                lines.append('* STATUS %s (%s)' % (quote(mailbox),
+                    ' '.join([ '%s %s' % item for item in status.items() ])))
+        return lines
+
+    def command_lsub(self, arguments, uid):
+        return self.command_list(arguments, uid, 'LSUB')
+
+    def command_fetch(self, arguments, uid):
+        sequence_set, query = arguments.split(' ', 1)
+        mailbox = self.selected
+        changed_since = None
+        match = _CHANGEDSINCE.search(query)
+        if match:
+            changed_since = int(match.group(1))
+            query = query[:match.start()]
+        items = self.fetch_items(query)
+        lines = []
+        for msg_uid in parse_sequence_set(sequence_set.replace('*',
+            str(mailbox.messages))):
+            if not mailbox.present(msg_uid):
+                continue
+            values = []
+            if changed_since is not None:
+                modseq = mailbox.changes.get(msg_uid, 1)
+                if modseq <= changed_since:
+                    continue
+                values.append('MODSEQ (%d)' % modseq)
+            for key, value in mailbox.fetch(msg_uid, items).items():
+                if isinstance(value, list):
+                    if key == 'FLAGS':
+                        value = '(%s)' % ' '.join(value)
+                    else:
+                        continue
+                elif key.startswith('BODY['):
+                    value = literal(value)
+                elif not isinstance(value, int):
+                    value = quote(value)
+                values.append('%s %s' % (key, value))
+            lines.append('* %d FETCH (%s)' % (msg_uid, ' '.join(values)))
+        return lines
+
+    def command_append(self, arguments, uid):
+        tokens = parse_arguments(arguments)
+        mailbox = self.account.mailbox(str(tokens[0]))
+        # The flags are always sent by hlimap, one list for each message
+        count = len([ token for token in tokens if isinstance(token, list) ])
+        if count > 1 and 'MULTIAPPEND' not in self.capabilities:
+            raise FakeServerError('MULTIAPPEND not supported')
+        mailbox.append(count)
+        if 'UIDPLUS' not in self.capabilities:
+            return []
+        return [ '* OK [APPENDUID %d %d:%d] Done' % (mailbox.uid_validity,
+            mailbox.messages - count + 1, mailbox.messages) ]
+
+    def command_copy(self, arguments, uid, move=False):
+        sequence_set, name = arguments.split(' ', 1)
+        mailbox = self.selected
+        destination = self.account.mailbox(str(parse_arguments(name)[0]))
+        uid_list = [ msg_uid for msg_uid in parse_sequence_set(
+            sequence_set.replace('*', str(mailbox.messages)))
+            if mailbox.present(msg_uid) ]
+        if not uid_list:
+            return []
+        first = destination.messages + 1
+        destination.append(len(uid_list))
+        if move:
+            mailbox.expunge(uid_list)
+        if 'UIDPLUS' not in self.capabilities:
+            return []
+        return [ '* OK [COPYUID %d %s %d:%d] Done' % (
+            destination.uid_validity, ordered_set(uid_list), first,
+            destination.messages) ]
+
+    def command_move(self, arguments, uid):
+        return self.command_copy(arguments, uid, True)
+
+    def command_expunge(self, arguments, uid):
+        mailbox = self.selected
+        candidates = range(1, mailbox.messages + 1)
+        if uid:
+            candidates = parse_sequence_set(arguments.replace('*',
+                str(mailbox.messages)))
+        mailbox.expunge([ msg_uid for msg_uid in candidates
+            if mailbox.present(msg_uid) and
+            r'\Deleted' in mailbox.flags(msg_uid) ])
+        return []
+
+    def command_store(self, arguments, uid):
+        sequence_set, item, flags = arguments.split(' ', 2)
+        mailbox = self.selected
+        item = item.upper()
+        flags = [ str(flag) for flag in parse_arguments(flags)[0] ]
+        lines = []
+        for msg_uid in parse_sequence_set(sequence_set.replace('*',
+            str(mailbox.messages))):
+            if not mailbox.present(msg_uid):
+                continue
+            current = mailbox.flags(msg_uid)
+            if item.startswith('+'):
+                new = current + [ flag for flag in flags
+                                  if flag not in current ]
+            elif item.startswith('-'):
+                new = [ flag for flag in current if flag not in flags ]
+            else:
+                new = flags
+            mailbox.store([ msg_uid ], new)
+            if not item.endswith('.SILENT'):
+                lines.append('* %d FETCH (UID %d FLAGS (%s))' % (msg_uid,
+                    msg_uid, ' '.join(new)))
+        return lines
+
+    def command_search(self, arguments, uid, program=None):
+        options = None
+        match = _RETURN.match(arguments)
+        if match:
+            options = match.group(1).upper().split()
+            arguments = arguments[match.end():]
+        if program is None:
+            result = self.selected.search(arguments)
+        else:
+            result = self.selected.sort(program, arguments)
+        if options is None:
+            return [ '* %s %s' % (program is None and 'SEARCH' or 'SORT',
+                ' '.join([ str(msg_uid) for msg_uid in result ])) ]
+
+        values = []
+        position = 0
+        while position < len(options):
+            option = options[position]
+            if option == 'COUNT':
+                values.append('COUNT %d' % len(result))
+            elif option == 'MIN' and result:
+                values.append('MIN %d' % min(result))
+            elif option == 'MAX' and result:
+                values.append('MAX %d' % max(result))
+            elif option == 'ALL' and result:
+                values.append('ALL %s' % ordered_set(result))
+            elif option == 'PARTIAL':
+                position += 1
+                first, last = [ int(number) for number in
+                                options[position].split(':') ]
+                partial = result[first - 1:last]
+                values.append('PARTIAL (%s %s)' % (options[position],
+                    partial and ordered_set(partial) or 'NIL'))
+            position += 1
+        return [ '* ESEARCH (TAG "%s")%s %s' % (self.tag, uid and ' UID' or '',
+            ' '.join(values)) ]
+
+    def command_sort(self, arguments, uid):
+        options = ''
+        match = _RETURN.match(arguments)
+        if match:
+            options = match.group(0)
+            arguments = arguments[match.end():]
+        program, arguments = arguments.split(')', 1)
+        charset, expression = arguments.strip().split(' ', 1)
+        return self.command_search(options + expression, uid,
+            program + ')')
+
+def connection_class(account, capabilities=MODERN, latency=0.0):
+    '''Returns a FakeIMAP4P class bound to an account, to be used as
+    ImapServer.connection_class.
+
+    @param capabilities: list of capabilities, see L{CAPABILITIES}
+    @param latency: round trip time, in seconds
+    '''
+    return type('FakeIMAP4P', (FakeIMAP4P,), { 'account': account,
+        'capabilities': tuple([ capability.upper() for capability in
+                                capabilities ]),
+        'latency': latency,
+        'stats': { 'lock': threading.Lock(), 'server_time': 0.0,
+                   'round_trips': 0, 'commands': [] } })
@@ -24,7 +24,7 @@
 # $Id: __init__.py 20 2010-01-15 20:44:48Z hguerreiro $
 #
 
-from imapserver import ImapServer
+from .imapserver import ImapServer
 
 '''High Level IMAP Lib
 
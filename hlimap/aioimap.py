@@ -0,0 +1,1087 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of hlimap.
+##
+## hlimap is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## hlimap is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+
+'''High Level IMAP Lib - asyncio API
+
+This module is part of the hlimap lib. It needs Python 3.6 or later, and it
+doesn't use imaplibii.
+
+Notes
+=====
+
+This is the asyncio counterpart of the blocking API, with the same object
+model::
+
+    >>> M = AsyncImapServer('example.com', ssl=True)
+    >>> await M.login('user', 'password')
+    >>> await M.refresh_folders()
+    >>> async for folder in M:
+    ...     await folder.refresh_status()
+    >>> folder = await M.get_folder('INBOX')
+    >>> async for message in folder:
+    ...     print(message.uid, message.seen)
+    >>> await M.logout()
+
+The folder tree, folder, message list and message classes are sub classes of
+the blocking ones, the methods that talk with the server are coroutines with
+the same name. L{AsyncImapServer} isn't a sub class of
+L{ImapServer<imapserver.ImapServer>}, it has the same attributes and the
+methods that make sense without threads. The differences are:
+
+    * C{server[path]} and C{folder[uid]} become C{await server.get_folder(path)}
+      and C{await folder.get_message(uid)};
+    * the status getters (C{folder.messages()}, C{folder.unseen()}, ...) are
+      coroutines;
+    * the envelopes and body structures are the raw parsed responses
+      (nested lists), see L{imapext<imapext>};
+    * CONDSTORE isn't enabled, the message lists are loaded again when a
+      folder is selected again, and the body cache and the search index
+      aren't used.
+
+Concurrent commands
+-------------------
+
+L{AsyncIMAP4} sends the commands as soon as they are issued, without waiting
+for the previous ones to complete, whenever IMAP allows it: STATUS, FETCH,
+STORE, and so on. The commands that change the connection state (LOGIN,
+SELECT, EXPUNGE, ...) wait for the commands in flight, and the new commands
+wait for them. So refreshing the status of all the folders, or fetching the
+sort keys of a big folder in several batches, costs about one round trip.
+
+SEARCH, SORT and THREAD run alone too: their untagged responses don't say
+which command they answer, so two of them in flight would mix their
+results.
+'''
+
+# Imports
+import re
+import ssl as ssl_module
+import base64
+import quopri
+import asyncio
+
+from .imapext import Response, parse_response, pairs, quote, \
+    status_responses, copy_uids, parse_sequence_set, literal_segments
+from .imapimport import message_source, message_octets
+from .imapsort import FetchedMessages, BATCH_SIZE, sort_messages, \
+    sort_query, parse_sort_program
+from .imapthread import THREAD_QUERY, thread_messages, sort_threads
+from .imapfolder import FolderTree, Folder, Flags, NoSuchFolder, \
+    NoFolderListError, STATUS_ITEMS
+from .imapmessage import MessageList, Message, MessageNotFound, THREADED, \
+    SORTED, CHUNK_SIZE, StreamDecoder, section_data
+from .utils import sequence_set, sequence_sets, MAX_SET_LENGTH
+
+# Exceptions:
+
+class AsyncIMAPError(Exception): pass
+
+# Constants:
+
+# Maximum number of commands in flight on a connection
+MAX_PIPELINE = 32
+
+_LITERAL_END = re.compile(r'\{(\d+)\}\r?\n$')
+
+# Connection
+
+class AsyncIMAP4(object):
+    '''Asyncio IMAP connection.
+    '''
+
+    def __init__(self, host='localhost', port=None, ssl=False,
+        ssl_context=None):
+        '''
+        @param host: host name of the imap server;
+        @param port: port to be used. If not specified it will default to 143
+            for plain text and 993 for ssl;
+        @param ssl: Is the connection ssl?
+        @param ssl_context: ssl.SSLContext to use, implies ssl.
+        '''
+        if ssl and not ssl_context:
+            ssl_context = ssl_module.create_default_context()
+        self.host = host
+        self.port = port or (ssl_context and 993 or 143)
+        self.ssl_context = ssl_context
+
+        self.capabilities = set()
+        self.tag_counter = 0
+        self.pending = {}
+        self.exclusive = False
+        self.continuation = None
+
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+        self.condition = None
+        self.pipeline = None
+
+    def connected(self):
+        return self.writer is not None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host,
+            self.port, ssl=self.ssl_context)
+        self.condition = asyncio.Condition()
+        self.pipeline = asyncio.Semaphore(MAX_PIPELINE)
+        greeting = await self.read_line()
+        if not greeting.upper().startswith(('* OK', '* PREAUTH')):
+            raise AsyncIMAPError(greeting)
+        self.reader_task = asyncio.ensure_future(self.read_loop())
+        await self.capability()
+
+    # Responses
+
+    async def read_line(self):
+        '''Reads a response line, with the literals inline.
+        '''
+        line = await self.reader.readline()
+        if not line:
+            raise AsyncIMAPError('Connection closed by the server')
+        line = line.decode('latin-1')
+        while True:
+            match = _LITERAL_END.search(line)
+            if not match:
+                break
+            data = await self.reader.readexactly(int(match.group(1)))
+            line += data.decode('latin-1')
+            line += (await self.reader.readline()).decode('latin-1')
+        return line.rstrip('\r\n')
+
+    async def read_loop(self):
+        try:
+            while True:
+                line = await self.read_line()
+                if line.startswith('+'):
+                    if self.continuation and not self.continuation.done():
+                        self.continuation.set_result(line)
+                elif line.startswith('*'):
+                    self.untagged(line)
+                else:
+                    tag = line.split(' ', 1)[0]
+                    future, lines = self.pending.pop(tag, (None, None))
+                    if future is not None and not future.done():
+                        lines.append(line)
+                        future.set_result(Response(tag, lines))
+        except Exception as error:
+            for future, lines in self.pending.values():
+                if not future.done():
+                    future.set_exception(AsyncIMAPError(str(error)))
+            self.pending.clear()
+            if self.continuation and not self.continuation.done():
+                self.continuation.set_exception(AsyncIMAPError(str(error)))
+
+    def untagged(self, line):
+        '''The untagged responses can't be matched to the commands in
+        flight, they are given to all of them. Each command picks the ones
+        it's interested in.
+        '''
+        for future, lines in self.pending.values():
+            lines.append(line)
+        if line[:13].upper() == '* CAPABILITY ':
+            self.capabilities = set([ str(token).upper() for token
+                in parse_response(line)[2:] ])
+
+    # Commands
+
+    async def command(self, command, exclusive=False, literal=None,
+        check=True):
+        '''Sends a command and waits for its completion.
+
+        @param command: the command line, without the tag
+        @param exclusive: the command must not run concurrently with other
+            commands
+        @param literal: data sent as a literal after the command line, the
+            command line must end with the literal size ({n})
+        @param check: raise AsyncIMAPError if the command fails
+
+        The synchronizing literals on the command line are sent when the
+        server asks for them, see L{literal_segments<imapext.literal_segments>}.
+
+        @return: L{Response<imapext.Response>} instance
+        '''
+        segments = literal_segments(command)
+        literals = [ segment.encode('latin-1') for segment in segments[1:] ]
+        if literal is not None:
+            if isinstance(literal, str):
+                literal = literal.encode('latin-1')
+            literals.append(literal)
+        if exclusive or literals:
+            exclusive = True
+        async with self.pipeline:
+            async with self.condition:
+                if exclusive:
+                    await self.condition.wait_for(lambda:
+                        not self.exclusive and not self.pending)
+                    self.exclusive = True
+                else:
+                    await self.condition.wait_for(lambda: not self.exclusive)
+                self.tag_counter += 1
+                tag = 'H%04d' % self.tag_counter
+                future = asyncio.get_event_loop().create_future()
+                self.pending[tag] = (future, [])
+                if literals:
+                    self.continuation = \
+                        asyncio.get_event_loop().create_future()
+                self.writer.write(('%s %s\r\n' % (tag, segments[0])).encode(
+                    'latin-1'))
+            try:
+                await self.writer.drain()
+                for data in literals:
+                    done, pending = await asyncio.wait([ self.continuation,
+                        future ], return_when=asyncio.FIRST_COMPLETED)
+                    if self.continuation not in done:
+                        # The server refused the command
+                        break
+                    self.continuation = \
+                        asyncio.get_event_loop().create_future()
+                    self.writer.write(data + b'\r\n')
+                    await self.writer.drain()
+                response = await future
+            finally:
+                async with self.condition:
+                    if exclusive:
+                        self.exclusive = False
+                    self.continuation = None
+                    self.condition.notify_all()
+        if check and not response.ok():
+            raise AsyncIMAPError(response.text)
+        return response
+
+    async def capability(self):
+        response = await self.command('CAPABILITY')
+        for tokens in response.responses('CAPABILITY'):
+            self.capabilities = set([ str(token).upper()
+                                      for token in tokens ])
+        return self.capabilities
+
+    def has_capability(self, capability):
+        return capability.upper() in self.capabilities
+
+    async def login(self, username, password):
+        response = await self.command('LOGIN %s %s' % (quote(username),
+            quote(password)), exclusive=True)
+        # The capabilities usually change after the login
+        code = response.response_code('CAPABILITY')
+        if code:
+            self.capabilities = set([ str(token).upper() for token in code ])
+        else:
+            await self.capability()
+        return response
+
+    async def logout(self):
+        try:
+            response = await self.command('LOGOUT', exclusive=True,
+                check=False)
+        finally:
+            self.writer.close()
+            self.writer = None
+            if self.reader_task:
+                self.reader_task.cancel()
+        return response
+
+    async def enable(self, *capabilities):
+        capabilities = [ capability for capability in capabilities
+                         if self.has_capability(capability) ]
+        if not capabilities or not self.has_capability('ENABLE'):
+            return []
+        response = await self.command('ENABLE %s' % ' '.join(capabilities),
+            exclusive=True)
+        enabled = []
+        for tokens in response.responses('ENABLED'):
+            enabled.extend([ str(token).upper() for token in tokens ])
+        return enabled
+
+    async def list(self, reference='""', pattern='*', command='LIST'):
+        '''LIST or LSUB command.
+
+        @return: list of (flag list, delimiter, mailbox name) tuples
+        '''
+        response = await self.command('%s %s %s' % (command,
+            reference, quote(pattern)))
+        mailboxes = []
+        for tokens in response.responses(command):
+            if len(tokens) >= 3:
+                mailboxes.append(([ str(flag).upper()
+                    for flag in tokens[0] ], tokens[1], str(tokens[2])))
+        return mailboxes
+
+    async def lsub(self, reference='""', pattern='*'):
+        return await self.list(reference, pattern, 'LSUB')
+
+    async def list_status(self, items, reference='""', pattern='*'):
+        '''LIST command returning the status of the mailboxes, RFC 5819.
+
+        @return: dict in the form { mailbox: status dict, ... }
+        '''
+        response = await self.command('LIST %s %s RETURN (STATUS (%s))' % (
+            reference, quote(pattern), ' '.join(items)))
+        return status_responses([ response ])
+
+    async def status(self, mailbox, names):
+        '''STATUS command.
+
+        @param names: status items, in the form '(MESSAGES UNSEEN)'
+        '''
+        response = await self.command('STATUS %s %s' % (quote(mailbox),
+            names))
+        for tokens in response.responses('STATUS'):
+            # We might get the responses of other STATUS commands in flight
+            if (len(tokens) > 1 and str(tokens[0]) == mailbox and
+                isinstance(tokens[1], list)):
+                return pairs(tokens[1])
+        return {}
+
+    async def select(self, mailbox, readonly=False):
+        response = await self.command('%s %s' % (readonly and 'EXAMINE' or
+            'SELECT', quote(mailbox)), exclusive=True)
+        result = {}
+        for tokens in response.untagged:
+            if len(tokens) < 3:
+                continue
+            if isinstance(tokens[1], int):
+                result[str(tokens[2]).upper()] = tokens[1]
+            elif str(tokens[1]).upper() == 'FLAGS':
+                result['FLAGS'] = [ str(flag) for flag in tokens[2] ]
+            elif isinstance(tokens[2], list) and tokens[2]:
+                code = tokens[2]
+                name = str(code[0]).upper()
+                if name == 'PERMANENTFLAGS':
+                    result[name] = [ str(flag) for flag in code[1] ]
+                elif len(code) > 1:
+                    result[name] = code[1]
+        result.setdefault('PERMANENTFLAGS', [r'\*'])
+        result.setdefault('FLAGS', [])
+        return result
+
+    async def unselect(self):
+        return await self.command('UNSELECT', exclusive=True)
+
+    async def expunge(self):
+        return await self.command('EXPUNGE', exclusive=True)
+
+    async def search(self, criteria='ALL'):
+        response = await self.command('UID SEARCH %s' % criteria,
+            exclusive=True)
+        uid_list = []
+        for tokens in response.responses('SEARCH'):
+            uid_list.extend(tokens)
+        return uid_list
+
+    async def sort(self, program, charset, criteria='ALL'):
+        response = await self.command('UID SORT %s %s %s' % (program,
+            charset, criteria), exclusive=True)
+        uid_list = []
+        for tokens in response.responses('SORT'):
+            uid_list.extend(tokens)
+        return uid_list
+
+    async def thread(self, algorithm, charset, criteria='ALL'):
+        response = await self.command('UID THREAD %s %s %s' % (algorithm,
+            charset, criteria), exclusive=True)
+        threads = []
+        for tokens in response.responses('THREAD'):
+            threads.extend(tokens)
+        return threads
+
+    async def fetch(self, uid_list, query, batch_size=BATCH_SIZE):
+        '''UID FETCH command. Big message lists are split in batches, that
+        are fetched concurrently.
+
+        @return: a dict in the form returned by imaplibii's fetch_smart
+        '''
+        if isinstance(uid_list, int):
+            uid_list = [ uid_list ]
+        message_sets = [ message_set
+            for first in range(0, len(uid_list), batch_size)
+            for message_set in sequence_sets(uid_list[first:first +
+                batch_size]) ]
+        responses = await asyncio.gather(*[ self.command('UID FETCH %s %s'
+            % (message_set, query)) for message_set in message_sets ])
+        wanted = set(uid_list)
+        result = {}
+        for response in responses:
+            for msg_info in response.fetch_responses():
+                uid = msg_info.get('UID')
+                if uid in wanted:
+                    result.setdefault(uid, {}).update(msg_info)
+        return result
+
+    async def store(self, uid_list, command, flags):
+        responses = await asyncio.gather(*[ self.command(
+            'UID STORE %s %s (%s)' % (message_set, command, ' '.join(flags)))
+            for message_set in sequence_sets(uid_list) ])
+        return dict((msg_info['UID'], msg_info) for response in responses
+            for msg_info in response.fetch_responses() if 'UID' in msg_info)
+
+    async def append(self, mailbox, message, flags='', date=None):
+        message = message_octets(message)
+        command = 'APPEND %s' % quote(mailbox)
+        if flags:
+            command += ' %s' % flags
+        if date:
+            command += ' %s' % quote(date)
+        return await self.command('%s {%d}' % (command, len(message)),
+            literal=message)
+
+# High level objects
+
+class AsyncMessage(Message):
+    '''Message, the methods that talk with the server are coroutines.
+    '''
+    __slots__ = ()
+
+    async def get_bodystructure(self):
+        if not self._Message__bodystructure:
+            response = await self._imap.fetch(self.uid, '(BODYSTRUCTURE)')
+            self._Message__bodystructure = response[self.uid]['BODYSTRUCTURE']
+        return self._Message__bodystructure
+    bodystructure = property(get_bodystructure)
+
+    async def fetch(self, query):
+        '''Returns the fetch response for the query
+        '''
+        response = await self._imap.fetch(self.uid, '(%s)' % query)
+        msg_info = response[self.uid]
+        # BODY.PEEK[...] is answered as BODY[...]
+        return msg_info.get(query, msg_info.get(query.replace('.PEEK', '')))
+
+    async def part(self, part):
+        '''Get a part from the server.
+        '''
+        text = (await self.fetch(part.query())).encode('latin-1')
+
+        if part.body_fld_enc == 'BASE64':
+            text = base64.b64decode(text)
+        elif part.body_fld_enc == 'QUOTED-PRINTABLE':
+            text = quopri.decodestring(text)
+
+        if part.media == 'TEXT' and part.media_subtype != 'HTML':
+            try:
+                return text.decode(part.charset() or 'us-ascii')
+            except (UnicodeDecodeError, LookupError):
+                return text.decode('iso-8859-1')
+
+        return text
+
+    async def source(self):
+        return await self.fetch('BODY[]')
+
+    async def write_part(self, part, output, chunk_size=CHUNK_SIZE):
+        '''Writes a part, decoded, to a file like object. The part is
+        fetched in chunks.
+        '''
+        section = re.search(r'\[(.*)\]', part.query()).group(1)
+        return await self.write_section(section, output, part.body_fld_enc,
+            chunk_size)
+
+    async def write_source(self, output, chunk_size=CHUNK_SIZE):
+        return await self.write_section('', output, None, chunk_size)
+
+    async def write_section(self, section, output, encoding=None,
+        chunk_size=CHUNK_SIZE):
+        decoder = StreamDecoder(encoding)
+        offset = 0
+        while True:
+            response = await self._imap.command(
+                'UID FETCH %d (BODY.PEEK[%s]<%d.%d>)' % (self.uid, section,
+                offset, chunk_size))
+            data = section_data(response, self.uid)
+            offset += len(data)
+            output.write(decoder.decode(data))
+            if len(data) < chunk_size:
+                break
+        output.write(decoder.flush())
+        return offset
+
+    async def part_header(self, part=None):
+        if part:
+            query = 'BODY[%s.HEADER]' % part
+        else:
+            query = 'BODY[HEADER]'
+        return await self.fetch(query)
+
+    async def store_flags(self, command, flags):
+        changed = await self.folder.store_flags([ self.uid ], command, flags)
+        self.update_flags(command, flags)
+        if self.uid in changed:
+            self.get_flags(changed[self.uid])
+
+    async def set_flags(self, *args):
+        await self.store_flags('+FLAGS.SILENT', args)
+
+    async def reset_flags(self, *args):
+        await self.store_flags('-FLAGS.SILENT', args)
+
+class AsyncMessageList(MessageList):
+    '''Message list, the methods that talk with the server are coroutines.
+    '''
+
+    def _get_number_messages(self):
+        # Can't refresh here, refresh_messages must be awaited first
+        return self._number_messages or 0
+    number_messages = property(_get_number_messages)
+
+    async def have_messages(self):
+        if self._number_messages is None:
+            await self.refresh_messages()
+        return bool(self._number_messages)
+
+    async def client_side(self, function, query, uid_list, *args):
+        '''Runs the client side sort or threading, with all the messages
+        fetched concurrently beforehand.
+        '''
+        msg_dict = await self._imap.fetch(uid_list, query)
+        return function(FetchedMessages(msg_dict), uid_list, *args)
+
+    async def sort_client_side(self, uid_list):
+        keys = [ key for key, reverse in
+                 parse_sort_program(self.sort_program) ]
+        return await self.client_side(sort_messages, sort_query(keys),
+            uid_list, self.sort_program)
+
+    async def get_message_list(self):
+        use = self.search_capability & self.show_style
+
+        if self.show_style == THREADED:
+            if use == THREADED:
+                message_list = await self._imap.thread(self.thread_alg,
+                    'utf-8', self.search_expression)
+            else:
+                message_list = await self.client_side(thread_messages,
+                    THREAD_QUERY, await self.search_messages(
+                    self.search_expression), self.thread_alg)
+            if self.thread_sort:
+                keys = [ key for key, reverse in
+                         parse_sort_program(self.sort_program) ]
+                if self.thread_latest and 'DATE' not in keys:
+                    keys.append('DATE')
+                msg_dict = await self._imap.fetch(list(
+                    flaten_uids(message_list)), sort_query(keys))
+                message_list = sort_threads(FetchedMessages(msg_dict),
+                    message_list, self.sort_program, self.thread_latest)
+        elif self.show_style == SORTED:
+            if self.server_sort:
+                message_list = await self._imap.sort(self.sort_string(),
+                    'utf-8', self.search_expression)
+            else:
+                message_list = await self.sort_client_side(
+                    await self.search_messages(self.search_expression))
+        else:
+            message_list = await self.search_messages(
+                self.search_expression)
+
+        return message_list
+
+    async def refresh_messages(self):
+        self.set_message_list(await self.get_message_list())
+
+    async def refine(self, query):
+        '''Narrows the current message list with more search keys, see
+        L{MessageList.refine<imapmessage.MessageList.refine>}.
+        '''
+        if self.refresh or self._number_messages is None:
+            uid_list = None
+        else:
+            uid_list = list(self.flat_message_list)
+
+        literal_plus = self._imap.has_capability('LITERAL+')
+        if self.query is not None:
+            self.set_search_expression(self.query & query)
+        elif self.search_expression.upper() == 'ALL':
+            self.set_search_expression(query)
+        else:
+            self.search_expression = '(%s) %s' % (self.search_expression,
+                query.criteria(literal_plus))
+            self.search_charset = self.search_charset or query.charset()
+
+        if uid_list is None or self.show_style == THREADED:
+            self.reset()
+            return
+
+        matches = query.filter(await self.message_data(uid_list))
+        if matches is None and uid_list:
+            search_expression = 'UID %s %s' % (sequence_set(uid_list),
+                query.criteria(literal_plus))
+            if len(search_expression) > MAX_SET_LENGTH:
+                self.reset()
+                return
+            matches = await self.search_messages(search_expression,
+                query.charset())
+        matches = set(matches or [])
+        self.set_message_list([ msg_id for msg_id in uid_list
+                                if msg_id in matches ])
+
+    async def message_data(self, uid_list):
+        '''Returns the data of the messages for the local evaluation of the
+        queries, see L{MessageList.message_data
+        <imapmessage.MessageList.message_data>}.
+        '''
+        result = []
+        missing = []
+        for msg_id in uid_list:
+            entry = self.message_dict.get(msg_id)
+            if entry is not None and 'data' in entry:
+                result.append(entry['data'].msg_info())
+            else:
+                missing.append(msg_id)
+        cache = self.server.envelope_cache
+        if missing and cache is not None:
+            cached = cache.get(self.folder.path,
+                await self.folder.uid_validity(), missing)
+            for msg_id, (envelope, size) in cached.items():
+                result.append({ 'UID': msg_id, 'ENVELOPE': envelope,
+                                'RFC822.SIZE': size })
+            missing = [ msg_id for msg_id in missing
+                        if msg_id not in cached ]
+        result.extend([ { 'UID': msg_id } for msg_id in missing ])
+        return result
+
+    async def search_messages(self, search_expression, charset=None):
+        charset = charset or self.search_charset
+        if charset:
+            search_expression = 'CHARSET %s %s' % (charset,
+                search_expression)
+        return await self._imap.search(search_expression)
+
+    # Flags
+    async def set_flags(self, message_list, *flags):
+        return await self.store_flags(message_list, '+FLAGS.SILENT', flags)
+
+    async def reset_flags(self, message_list, *flags):
+        return await self.store_flags(message_list, '-FLAGS.SILENT', flags)
+
+    async def store_flags(self, message_list, command, flags):
+        changed = await self.folder.store_flags(message_list, command, flags)
+        self.update_flags(message_list, command, flags, changed)
+        return changed
+
+    async def add_messages_range(self):
+        message_list = self.page_list()
+        if message_list:
+            for msg_id, msg_info in (await self.fetch_envelopes(
+                message_list)).items():
+                self.message_dict[msg_id]['data'] = AsyncMessage(
+                    self.server, self.folder, msg_info)
+
+    async def fetch_envelopes(self, message_list):
+        cache = self.server.envelope_cache
+        if cache is None:
+            return await self._imap.fetch(message_list,
+                '(ENVELOPE RFC822.SIZE FLAGS)')
+
+        path = self.folder.path
+        uid_validity = await self.folder.uid_validity()
+        cached = cache.get(path, uid_validity, message_list)
+        missing = [ msg_id for msg_id in message_list
+                    if msg_id not in cached ]
+
+        requests = [ self._imap.fetch(list(cached), '(FLAGS)') ]
+        if missing:
+            requests.append(self._imap.fetch(missing,
+                '(ENVELOPE RFC822.SIZE FLAGS)'))
+        responses = await asyncio.gather(*requests)
+
+        response = {}
+        for msg_id, msg_info in responses[0].items():
+            envelope, size = cached[msg_id]
+            msg_info['ENVELOPE'] = envelope
+            msg_info['RFC822.SIZE'] = size
+            response[msg_id] = msg_info
+        if missing:
+            fetched = responses[1]
+            cache.set(path, uid_validity, dict(
+                (msg_id, (msg_info['ENVELOPE'], msg_info['RFC822.SIZE']))
+                for msg_id, msg_info in fetched.items()))
+            response.update(fetched)
+        return response
+
+    async def get_message(self, message_id):
+        try:
+            msg_info = (await self.fetch_envelopes([message_id]))[message_id]
+        except KeyError:
+            raise MessageNotFound('%s message not found' % message_id)
+        return AsyncMessage(self.server, self.folder, msg_info)
+
+    async def msg_iter_page(self):
+        '''Iteract through the current range (page) of messages.
+        '''
+        if self.refresh:
+            await self.refresh_messages()
+        await self.add_messages_range()
+
+        for msg_id in self.page_list():
+            yield self.message_dict[msg_id]['data']
+
+def flaten_uids(nested_list):
+    '''Iterative version of flaten_nested.
+    '''
+    stack = [ iter(nested_list) ]
+    while stack:
+        for item in stack[-1]:
+            if isinstance(item, list):
+                stack.append(iter(item))
+                break
+            yield item
+        else:
+            stack.pop()
+
+class AsyncFolder(Folder):
+    '''Folder, the methods that talk with the server are coroutines.
+    '''
+
+    def __init__(self, server, tree, parts, subscribed=True,
+        noselect=False):
+        Folder.__init__(self, server, tree, parts, subscribed, noselect)
+        self.__message_list = None
+
+    # Mailbox statistics
+    async def refresh_status(self):
+        if not self.noselect:
+            self.status = await self.server._imap.status(self.path,
+                '(%s)' % ' '.join(STATUS_ITEMS))
+        else:
+            self.status = {}
+
+    async def get_status(self, prop):
+        if prop not in self.status:
+            await self.refresh_status()
+        return self.status[prop]
+
+    async def messages(self):
+        return await self.get_status('MESSAGES')
+    total = messages
+    async def recent(self):
+        return await self.get_status('RECENT')
+    async def uid_next(self):
+        return await self.get_status('UIDNEXT')
+    async def uid_validity(self):
+        return await self.get_status('UIDVALIDITY')
+    async def unseen(self):
+        return await self.get_status('UNSEEN')
+
+    # Messages
+    async def append(self, message):
+        await self.server._imap.append(self.path, message, r'(\Seen)')
+
+    async def import_messages(self, source, progress=None):
+        '''Appends many messages to this folder, keeping their flags and
+        dates, one APPEND command at a time.
+
+        @param source: see L{message_source<imapimport.message_source>}
+        @param progress: called as progress(messages, octets) as the
+            messages are appended
+
+        @return: list of (UIDVALIDITY, UID) tuples, (None, None) if the
+            server doesn't return the UIDs
+        '''
+        uid_list = []
+        totals = [0, 0]
+        try:
+            for message, flags, date in message_source(source):
+                response = await self.server._imap.append(self.path,
+                    message, flags and '(%s)' % ' '.join(flags) or '', date)
+                code = response.response_code('APPENDUID')
+                if code and len(code) == 2:
+                    uid_list.append((code[0],
+                        parse_sequence_set(code[1])[0]))
+                else:
+                    uid_list.append((None, None))
+                totals[0] += 1
+                totals[1] += len(message)
+                if progress:
+                    progress(totals[0], totals[1])
+        finally:
+            self.status = {}
+            self.__message_list = None
+        return uid_list
+
+    # Folder operations:
+    async def select(self):
+        result = await self._imap.select(self.path)
+        self.flags = Flags(result['FLAGS'], result['PERMANENTFLAGS'])
+        self.status['MESSAGES'] = result.get('EXISTS', 0)
+        self.status['RECENT'] = result.get('RECENT', 0)
+        self.status['UNSEEN'] = result.get('UNSEEN', 0)
+        for name in ('UIDNEXT', 'UIDVALIDITY'):
+            if name in result:
+                self.status[name] = result[name]
+        return self
+
+    async def resync(self, result):
+        '''CONDSTORE isn't enabled by L{AsyncImapServer}, the message list
+        is loaded again.
+        '''
+        self.__message_list = None
+
+    async def expunge(self):
+        await self._imap.expunge()
+        self.__message_list = None
+
+    async def set_flags(self, message_list, *args):
+        return await self.message_list.set_flags(message_list, *args)
+
+    async def reset_flags(self, message_list, *args):
+        return await self.message_list.reset_flags(message_list, *args)
+
+    async def store_flags(self, message_list, command, flags):
+        '''UID STORE commands, sent concurrently, see
+        L{Folder.store_flags<imapfolder.Folder.store_flags>}.
+
+        @return: dict in the form { UID: flag list, ... }
+        '''
+        responses = await asyncio.gather(*[ self._imap.command(
+            'UID STORE %s %s (%s)' % (message_set, command, ' '.join(flags)))
+            for message_set in sequence_sets(message_list) ])
+        changed = {}
+        for response in responses:
+            for msg_info in response.fetch_responses():
+                if 'UID' in msg_info and 'FLAGS' in msg_info:
+                    changed[msg_info['UID']] = msg_info['FLAGS']
+        return changed
+
+    # Copy and move
+    async def copy_to(self, folder, message_list):
+        '''Copies messages to another folder, see
+        L{Folder.copy_to<imapfolder.Folder.copy_to>}.
+        '''
+        return await self.transfer(folder, message_list, False)
+
+    async def move_to(self, folder, message_list):
+        '''Moves messages to another folder, see
+        L{Folder.move_to<imapfolder.Folder.move_to>}.
+        '''
+        return await self.transfer(folder, message_list, True)
+
+    async def transfer(self, folder, message_list, move):
+        if self.server.folder_tree.selected is not self:
+            # The UIDs are the ones of this folder
+            await self.server.select_folder(self)
+        imap = self._imap
+        message_list = list(message_list)
+        message_sets = sequence_sets(message_list)
+        use_move = move and imap.has_capability('MOVE')
+
+        responses = await asyncio.gather(*[ imap.command('UID %s %s %s' % (
+            use_move and 'MOVE' or 'COPY', message_set, quote(folder.path)))
+            for message_set in message_sets ])
+        uid_validity, uid_map = copy_uids(responses)
+
+        expunged = use_move
+        if move and not use_move:
+            await self.message_list.store_flags(message_list,
+                '+FLAGS.SILENT', [ r'\Deleted' ])
+            if imap.has_capability('UIDPLUS'):
+                await asyncio.gather(*[ imap.command('UID EXPUNGE %s' %
+                    message_set) for message_set in message_sets ])
+                expunged = True
+
+        envelope_cache = self.server.envelope_cache
+        if uid_map and envelope_cache:
+            envelope_cache.copy(self.path, await self.uid_validity(),
+                folder.path, uid_validity, uid_map)
+        if expunged:
+            if envelope_cache:
+                envelope_cache.invalidate(self.path, message_list)
+            if self.__message_list:
+                self.__message_list.apply_changes(vanished=message_list)
+            self.status = {}
+        folder.status = {}
+        if folder.__message_list:
+            folder.__message_list.reset()
+        return uid_map
+
+    # Message list management
+    def _get_message_list(self):
+        if not self.__message_list:
+            self.__message_list = AsyncMessageList(self.server, self)
+        return self.__message_list
+    message_list = property(_get_message_list)
+
+    async def have_messages(self):
+        return await self.message_list.have_messages()
+
+    async def refresh_messages(self):
+        await self.message_list.refresh_messages()
+
+    async def get_message(self, message_id):
+        return await self.message_list.get_message(message_id)
+
+    # Special methods
+    def __getitem__(self, message_id):
+        raise TypeError('Use "await folder.get_message(uid)".')
+
+    def __iter__(self):
+        raise TypeError('Use "async for message in folder".')
+
+    def __aiter__(self):
+        return self.message_list.msg_iter_page()
+
+class AsyncFolderTree(FolderTree):
+    '''Folder tree, the methods that talk with the server are coroutines.
+    '''
+
+    def __init__(self, server):
+        FolderTree.__init__(self, server)
+        self.folder_class = AsyncFolder
+
+    async def refresh_folders(self, subscribed=True):
+        if subscribed:
+            flat_list = await self._imap.lsub('""', '*')
+        else:
+            flat_list = await self._imap.list('""', '*')
+
+        if not flat_list:
+            raise NoFolderListError('No folders found')
+
+        self.dl = flat_list[0][1] or '.'
+
+        for flags, delimiter, name in flat_list:
+            self.add_mailbox(flags, delimiter, name, subscribed)
+
+        self.sort()
+
+    async def refresh_status(self):
+        '''With LIST-STATUS a single LIST command is used, otherwise the
+        STATUS commands are all sent concurrently.
+        '''
+        if not self._imap.has_capability('LIST-STATUS'):
+            await asyncio.gather(*[ folder.refresh_status()
+                                    for folder in self.iter_all() ])
+            return
+        status_dict = await self._imap.list_status(STATUS_ITEMS)
+        for folder in self.iter_all():
+            folder.status = status_dict.get(folder.path, {})
+
+    async def get_folder(self, path):
+        if path not in self.folder_dict:
+            mailboxes = await self._imap.lsub('""', path)
+            if not mailboxes:
+                raise NoSuchFolder(path)
+            flags, delimiter, name = mailboxes[0]
+            self.dl = delimiter or '.'
+            self.add_mailbox(flags, delimiter, name, True)
+
+        folder = self.folder_dict[path]['data']
+        await self.server.select_folder(folder)
+
+        return folder
+
+class AsyncImapServer(object):
+    '''Establishes the server connection, and does the authentication. The
+    counterpart of L{ImapServer<imapserver.ImapServer>}, with the same
+    attributes, but not a sub class of it.
+    '''
+
+    def __init__(self, host='localhost', port=None, ssl=False,
+        ssl_context=None):
+        '''
+        @param host: host name of the imap server;
+        @param port: port to be used. If not specified it will default to 143
+            for plain text and 993 for ssl;
+        @param ssl: Is the connection ssl?
+        @param ssl_context: ssl.SSLContext to use, implies ssl.
+        '''
+        self._imap = AsyncIMAP4(host, port, ssl, ssl_context)
+
+        self.special_folders = []
+        self.expand_list = []
+        self.folder_tree = None
+        self.folders = None
+        self.envelope_cache = None
+        # Not used by the asyncio API, see the module notes
+        self.body_cache = None
+        self.search_index = None
+        self.concurrent = False
+
+        self.enabled = []
+        self.condstore = False
+        self.qresync = False
+
+    # IMAP methods
+    async def connect(self):
+        if not self._imap.connected():
+            await self._imap.connect()
+
+    async def login(self, username, password):
+        await self.connect()
+        return await self._imap.login(username, password)
+
+    async def logout(self):
+        if self._imap.connected():
+            return await self._imap.logout()
+
+    # Connections
+    def connection(self, folder=None):
+        return self._imap
+
+    async def select_folder(self, folder):
+        # SELECT closes the previously selected mailbox
+        self.folder_tree.selected = await folder.select()
+
+    def release(self):
+        pass
+
+    # Caches
+    def set_envelope_cache(self, cache):
+        self.envelope_cache = cache
+
+    # Folder list management
+    def set_special_folders(self, *folder_list):
+        self.special_folders = folder_list
+
+    def set_expand_list(self, *folder_list):
+        self.expand_list = folder_list
+
+    def _get_folder_tree(self):
+        if not self.folder_tree:
+            self.folder_tree = AsyncFolderTree(self)
+        return self.folder_tree
+
+    async def refresh_folders(self, subscribed=True):
+        tree = self._get_folder_tree()
+        await tree.refresh_folders(subscribed)
+        tree.set_properties(self.expand_list, self.special_folders)
+        tree.sort()
+        self.set_iterator(tree.iter_expand)
+
+    def set_iterator(self, it):
+        if self.folder_tree:
+            self.folders = it
+        else:
+            raise NoFolderListError('No folder list')
+
+    async def get_folder(self, path):
+        '''Returns a folder object'''
+        return await self._get_folder_tree().get_folder(path)
+
+    async def iter_folders(self):
+        if not self.folder_tree:
+            await self.refresh_folders()
+        for folder in self.folders():
+            yield folder
+
+    # Special methods
+    def __aiter__(self):
+        return self.iter_folders()
@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of hlimap.
+##
+## hlimap is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## hlimap is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+
+'''High Level IMAP Lib - caches
+
+This module is part of the hlimap lib.
+
+Notes
+=====
+
+Envelope cache
+--------------
+
+The envelope and the size of a message never change, as long as the
+UIDVALIDITY of the mailbox stays the same. So we can keep them on a
+persistent cache, and when showing a page of messages only the flags have
+to be fetched from the server.
+
+To use the cache::
+
+    >>> from hlimap.imapcache import SQLiteEnvelopeCache
+    >>> M = ImapServer('example.com')
+    >>> M.set_envelope_cache(SQLiteEnvelopeCache('/var/cache/user.db'))
+
+Other storage backends can be used by sub classing L{EnvelopeCache}.
+
+Body cache
+----------
+
+The message sources, parts and body structures are kept on a L{BodyCache},
+shared by all the messages of a server. It's an LRU cache with a limit on
+the number of bytes kept in memory. The entries evicted from memory can be
+kept on disk, with their own limit::
+
+    >>> from hlimap.imapcache import BodyCache
+    >>> M.set_body_cache(BodyCache(32 * 1024 * 1024,
+    ...     spill_dir='/var/cache/hlimap/user'))
+
+This way showing the preview, then the full message, then quoting it on a
+reply fetches the message once.
+'''
+
+# Imports
+import os
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+# Constants:
+
+# SQLite limits the number of variables on a statement
+SQL_CHUNK = 500
+
+# Body cache default limits, in bytes
+BODY_CACHE_SIZE = 32 * 1024 * 1024
+BODY_SPILL_SIZE = 256 * 1024 * 1024
+
+class EnvelopeCache(object):
+    '''Envelope cache interface. This class does no caching at all.
+
+    The cached data is keyed by mailbox, UIDVALIDITY and UID. Whenever a
+    different UIDVALIDITY is used for a mailbox, all the data cached for
+    that mailbox must be discarded. If the UIDVALIDITY is not known (None)
+    nothing is cached.
+    '''
+
+    def get(self, mailbox, uid_validity, uid_list):
+        '''Gets the cached messages.
+
+        @param mailbox: mailbox path
+        @param uid_validity: current UIDVALIDITY of the mailbox
+        @param uid_list: list of UIDs
+
+        @return: a dict in the form { UID: (envelope, size), ... } with the
+            messages found on the cache.
+        '''
+        return {}
+
+    def set(self, mailbox, uid_validity, msg_dict):
+        '''Adds messages to the cache.
+
+        @param msg_dict: a dict in the form { UID: (envelope, size), ... }
+        '''
+        pass
+
+    def invalidate(self, mailbox, uid_list=None):
+        '''Removes messages from the cache.
+
+        @param uid_list: list of UIDs to remove, if not given the cache for
+            the whole mailbox is removed.
+        '''
+        pass
+
+    def copy(self, mailbox, uid_validity, new_mailbox, new_uid_validity,
+        uid_map):
+        '''Copies the cached messages to another mailbox, after the messages
+        were copied or moved on the server.
+
+        @param uid_map: dict in the form { UID: new UID, ... }
+        '''
+        msg_dict = self.get(mailbox, uid_validity, uid_map.keys())
+        if msg_dict:
+            self.set(new_mailbox, new_uid_validity, dict([ (uid_map[uid],
+                value) for uid, value in msg_dict.items() ]))
+
+class SQLiteEnvelopeCache(EnvelopeCache):
+    '''Envelope cache stored on a SQLite database.
+    '''
+
+    def __init__(self, path):
+        '''
+        @param path: path to the database file, it's created if necessary.
+        '''
+        EnvelopeCache.__init__(self)
+        self.path = path
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS mailbox (
+                mailbox TEXT PRIMARY KEY,
+                uid_validity INTEGER NOT NULL );
+            CREATE TABLE IF NOT EXISTS envelope (
+                mailbox TEXT NOT NULL,
+                uid INTEGER NOT NULL,
+                envelope BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                PRIMARY KEY (mailbox, uid) );
+            ''')
+        self.uid_validity = {}
+
+    def check_validity(self, mailbox, uid_validity):
+        '''Discards the mailbox data if the UIDVALIDITY has changed.
+
+        @return: False if the UIDVALIDITY is not known, the mailbox can't be
+            cached.
+        '''
+        if uid_validity is None:
+            return False
+        uid_validity = int(uid_validity)
+        if self.uid_validity.get(mailbox) == uid_validity:
+            return True
+        row = self.db.execute('SELECT uid_validity FROM mailbox '
+            'WHERE mailbox = ?', (mailbox,)).fetchone()
+        if not row or row[0] != uid_validity:
+            self.db.execute('DELETE FROM envelope WHERE mailbox = ?',
+                (mailbox,))
+            self.db.execute('INSERT OR REPLACE INTO mailbox '
+                '(mailbox, uid_validity) VALUES (?, ?)',
+                (mailbox, uid_validity))
+            self.db.commit()
+        self.uid_validity[mailbox] = uid_validity
+        return True
+
+    def get(self, mailbox, uid_validity, uid_list):
+        result = {}
+        uid_list = list(uid_list)
+        with self.lock:
+            if not self.check_validity(mailbox, uid_validity):
+                return result
+            for first in range(0, len(uid_list), SQL_CHUNK):
+                chunk = uid_list[first:first + SQL_CHUNK]
+                rows = self.db.execute('SELECT uid, envelope, size '
+                    'FROM envelope WHERE mailbox = ? AND uid IN (%s)' %
+                    ','.join('?' * len(chunk)), [mailbox] + chunk)
+                for uid, envelope, size in rows:
+                    result[uid] = (pickle.loads(bytes(envelope)), size)
+        return result
+
+    def set(self, mailbox, uid_validity, msg_dict):
+        rows = [ (mailbox, uid, sqlite3.Binary(pickle.dumps(envelope,
+                  pickle.HIGHEST_PROTOCOL)), size)
+                 for uid, (envelope, size) in msg_dict.items() ]
+        with self.lock:
+            if not self.check_validity(mailbox, uid_validity):
+                return
+            self.db.executemany('INSERT OR REPLACE INTO envelope '
+                '(mailbox, uid, envelope, size) VALUES (?, ?, ?, ?)', rows)
+            self.db.commit()
+
+    def invalidate(self, mailbox, uid_list=None):
+        with self.lock:
+            if uid_list is None:
+                self.db.execute('DELETE FROM envelope WHERE mailbox = ?',
+                    (mailbox,))
+                self.db.execute('DELETE FROM mailbox WHERE mailbox = ?',
+                    (mailbox,))
+                self.uid_validity.pop(mailbox, None)
+            else:
+                uid_list = list(uid_list)
+                for first in range(0, len(uid_list), SQL_CHUNK):
+                    chunk = uid_list[first:first + SQL_CHUNK]
+                    self.db.execute('DELETE FROM envelope WHERE mailbox = ? '
+                        'AND uid IN (%s)' % ','.join('?' * len(chunk)),
+                        [mailbox] + chunk)
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+class BodyCache(object):
+    '''LRU cache for message data (sources, parts, body structures).
+
+    The keys are tuples in the form (mailbox, UIDVALIDITY, UID, section),
+    since the UIDVALIDITY is part of the key the data never gets stale. The
+    UIDVALIDITY is an int, see
+    L{Message.cache_key<imapmessage.Message.cache_key>}.
+    '''
+
+    def __init__(self, max_bytes=BODY_CACHE_SIZE, spill_dir=None,
+        max_spill_bytes=BODY_SPILL_SIZE):
+        '''
+        @param max_bytes: maximum size of the data kept in memory
+        @param spill_dir: directory where the entries evicted from memory
+            are kept, if not given they are discarded.
+        @param max_spill_bytes: maximum size of the data kept on disk
+        '''
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.max_spill_bytes = max_spill_bytes
+        self.lock = threading.RLock()
+
+        # { key: (value, size) }, least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        # { key: (file name, size) }
+        self.spilled = OrderedDict()
+        self.spill_size = 0
+
+        if spill_dir and not os.path.isdir(spill_dir):
+            os.makedirs(spill_dir)
+
+    def sizeof(self, value):
+        if isinstance(value, (bytes, type(u''))):
+            return len(value)
+        return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.entries:
+                value, size = self.entries.pop(key)
+                self.entries[key] = (value, size)
+                return value
+            if key not in self.spilled:
+                return default
+            file_name, size = self.spilled.pop(key)
+            self.spill_size -= size
+        try:
+            with open(file_name, 'rb') as spill_file:
+                value = pickle.load(spill_file)
+            os.remove(file_name)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return default
+        self.set(key, value)
+        return value
+
+    def set(self, key, value):
+        size = self.sizeof(value)
+        with self.lock:
+            self.discard(key)
+            if size > self.max_bytes:
+                # Too big for the memory, straight to the disk
+                self.spill(key, value, size)
+                return
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                old_key, (old_value, old_size) = self.entries.popitem(
+                    last=False)
+                self.size -= old_size
+                self.spill(old_key, old_value, old_size)
+
+    def spill(self, key, value, size):
+        '''Writes an entry evicted from memory to the disk.
+        '''
+        if not self.spill_dir or size > self.max_spill_bytes:
+            return
+        file_name = os.path.join(self.spill_dir, hashlib.sha1(
+            repr(key).encode('utf-8')).hexdigest())
+        try:
+            with open(file_name, 'wb') as spill_file:
+                pickle.dump(value, spill_file, pickle.HIGHEST_PROTOCOL)
+        except (IOError, OSError):
+            return
+        self.spilled[key] = (file_name, size)
+        self.spill_size += size
+        while self.spill_size > self.max_spill_bytes:
+            old_key, (old_file, old_size) = self.spilled.popitem(last=False)
+            self.spill_size -= old_size
+            self.remove_file(old_file)
+
+    def remove_file(self, file_name):
+        try:
+            os.remove(file_name)
+        except OSError:
+            pass
+
+    def discard(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            if key in self.spilled:
+                file_name, size = self.spilled.pop(key)
+                self.spill_size -= size
+                self.remove_file(file_name)
+
+    def copy(self, mailbox, uid_validity, new_mailbox, new_uid_validity,
+        uid_map, move=False):
+        '''Copies the cached data of messages copied or moved to another
+        mailbox. When moving, the entries kept on disk are moved too,
+        otherwise only the entries in memory are copied. Nothing is copied
+        if one of the UIDVALIDITY values is not known (None).
+
+        @param uid_map: dict in the form { UID: new UID, ... }
+        '''
+        if uid_validity is None or new_uid_validity is None:
+            return
+        uid_validity = int(uid_validity)
+        new_uid_validity = int(new_uid_validity)
+
+        def new_key(key):
+            if (key[0] == mailbox and key[1] == uid_validity and
+                key[2] in uid_map):
+                return (new_mailbox, new_uid_validity, uid_map[key[2]],
+                    key[3])
+            return None
+
+        with self.lock:
+            for key, (value, size) in list(self.entries.items()):
+                key_copy = new_key(key)
+                if key_copy:
+                    if move:
+                        self.discard(key)
+                    self.set(key_copy, value)
+            if move:
+                for key, item in list(self.spilled.items()):
+                    key_copy = new_key(key)
+                    if key_copy:
+                        del self.spilled[key]
+                        self.spilled[key_copy] = item
+
+    def clear(self):
+        with self.lock:
+            for file_name, size in self.spilled.values():
+                self.remove_file(file_name)
+            self.entries.clear()
+            self.spilled.clear()
+            self.size = 0
+            self.spill_size = 0
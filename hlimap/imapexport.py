@@ -0,0 +1,487 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of hlimap.
+##
+## hlimap is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## hlimap is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+
+'''High Level IMAP Lib - account export
+
+This module is part of the hlimap lib.
+
+Notes
+=====
+
+An L{AccountExport} writes all the folders of an account to mbox files or
+Maildirs, one per folder, on a directory tree that follows the folder
+hierarchy::
+
+    >>> M = PooledImapServer('example.com')
+    >>> M.login('user', 'password')
+    >>> M.refresh_folders(subscribed=False)
+    >>> export = AccountExport(M, '/backup/user', MAILDIR, connections=4,
+    ...     checkpoint='/backup/user.checkpoint')
+    >>> export.run()
+    {'INBOX': 10354, 'INBOX.Sent': 2561, ...}
+
+Each folder is exported by a single connection, several folders are
+exported at the same time using one thread and one connection for each.
+The connections are created with the server's new_connection method (see
+L{PooledImapServer<imappool.PooledImapServer>}), even when only one is
+used. Without it the folders are examined on the main connection, and the
+folder selected before is selected again at the end.
+
+The messages are fetched in batches of UIDs, with BODY.PEEK[] so the \\Seen
+flag isn't set, and the next batch is requested before the current one is
+written. The flags and the INTERNALDATE are kept, the mbox files and
+Maildirs can be imported back with
+L{Folder.import_messages<imapfolder.Folder.import_messages>}.
+
+After each batch the last UID written is recorded on the checkpoint file,
+for each folder and UIDVALIDITY. An interrupted export continues from
+there, the end of the mbox files not covered by the checkpoint is
+discarded. If the UIDVALIDITY of a folder changes, the folder is exported
+again from the start.
+'''
+
+# Imports
+import os
+import re
+import time
+import json
+import socket
+import calendar
+import threading
+
+from .imapext import command, send_command, read_response, quote
+from .imapimport import MBOX_FLAGS, MAILDIR_FLAGS
+from .utils import sequence_set, MONTHS
+
+# Exceptions:
+
+class ExportError(Exception): pass
+
+# Constants:
+
+MBOX = 'mbox'
+MAILDIR = 'maildir'
+
+# Maximum number of messages and of octets fetched on each command
+EXPORT_BATCH = 500
+EXPORT_BATCH_BYTES = 16 * 1024 * 1024
+
+DAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+
+MBOX_LETTERS = dict([ (flag, letter) for letter, flag in MBOX_FLAGS.items() ])
+MAILDIR_LETTERS = dict([ (flag, letter)
+    for letter, flag in MAILDIR_FLAGS.items() ])
+
+_MBOX_FROM = re.compile(br'^(>*From )', re.M)
+
+# Dates
+
+def internaldate_timestamp(date):
+    '''Converts an INTERNALDATE, '17-Jul-1996 02:44:25 -0700', to a
+    timestamp.
+    '''
+    try:
+        date = date.strip()
+        timestamp = calendar.timegm(time.strptime(date[:20],
+            '%d-%b-%Y %H:%M:%S'))
+        zone = date[21:]
+        offset = (int(zone[1:3]) * 60 + int(zone[3:5])) * 60
+        if zone[0] == '-':
+            offset = -offset
+        return timestamp - offset
+    except (ValueError, IndexError, AttributeError):
+        return time.time()
+
+def from_line_date(timestamp):
+    '''Date of the mbox From_ line, in UTC: 'Sat Jan  3 01:05:34 1996'.
+    '''
+    date = time.gmtime(timestamp)
+    return '%s %s %2d %02d:%02d:%02d %d' % (DAYS[date[6]],
+        MONTHS[date[1] - 1], date[2], date[3], date[4], date[5], date[0])
+
+def safe_name(name):
+    '''File name for a folder name.
+    '''
+    name = name.replace(os.sep, '_')
+    if name.startswith('.'):
+        name = '_' + name[1:]
+    return name or '_'
+
+# Checkpoints
+
+class Checkpoint(object):
+    '''Last UID exported of each folder, kept on a JSON file.
+    '''
+
+    def __init__(self, path=None):
+        '''
+        @param path: path of the checkpoint file, if not given nothing is
+            saved and every export starts from the beginning.
+        '''
+        self.path = path
+        self.lock = threading.Lock()
+        self.folders = {}
+        if path and os.path.exists(path):
+            with open(path) as checkpoint_file:
+                self.folders = json.load(checkpoint_file)
+
+    def get(self, mailbox, uid_validity):
+        '''
+        @return: a tuple (last UID exported, size of the output), (0, 0) if
+            the folder wasn't exported with this UIDVALIDITY.
+        '''
+        with self.lock:
+            state = self.folders.get(mailbox)
+        if not state or state['uid_validity'] != uid_validity:
+            return 0, 0
+        return state['last_uid'], state['offset']
+
+    def set(self, mailbox, uid_validity, last_uid, offset):
+        with self.lock:
+            self.folders[mailbox] = { 'uid_validity': uid_validity,
+                'last_uid': last_uid, 'offset': offset }
+            self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as checkpoint_file:
+            json.dump(self.folders, checkpoint_file)
+        if os.name == 'nt' and os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(temp_path, self.path)
+
+# Writers
+
+class MboxWriter(object):
+    '''Writes messages to an mbox file (mboxrd).
+    '''
+    extension = '.mbox'
+
+    def __init__(self, path, offset=0):
+        '''
+        @param offset: size of the file already exported, anything after
+            it is discarded.
+        '''
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.file = open(path, os.path.exists(path) and 'r+b' or 'w+b')
+        self.file.seek(offset)
+        self.file.truncate()
+
+    def write(self, message, flags, timestamp, uid, uid_validity):
+        status = '\\Seen' in flags and b'RO' or b'O'
+        x_status = b''.join([ MBOX_LETTERS[flag] for flag in flags
+                              if flag in MBOX_LETTERS and flag != '\\Seen' ])
+        message = _MBOX_FROM.sub(br'>\1', message.replace(b'\r\n', b'\n'))
+        if not message.endswith(b'\n'):
+            message += b'\n'
+
+        write = self.file.write
+        write(('From MAILER-DAEMON %s\n' % from_line_date(timestamp)).encode(
+            'ascii'))
+        write(b'Status: ' + status + b'\n')
+        if x_status:
+            write(b'X-Status: ' + x_status + b'\n')
+        write(message)
+        write(b'\n')
+
+    def flush(self):
+        '''
+        @return: size of the file
+        '''
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+class MaildirWriter(object):
+    '''Writes messages to a Maildir. The file names have the UID and the
+    UIDVALIDITY so a message exported twice is written to the same file.
+    '''
+    extension = ''
+
+    def __init__(self, path, offset=0):
+        self.path = path
+        for sub_dir in ('tmp', 'new', 'cur'):
+            directory = os.path.join(path, sub_dir)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        self.host = socket.gethostname().replace('/', '\\057').replace(':',
+            '\\072')
+
+    def write(self, message, flags, timestamp, uid, uid_validity):
+        name = '%d.U%dV%d.%s' % (timestamp, uid, uid_validity, self.host)
+        info = ''.join(sorted([ MAILDIR_LETTERS[flag] for flag in flags
+                                if flag in MAILDIR_LETTERS ]))
+        temp_name = os.path.join(self.path, 'tmp', name)
+        with open(temp_name, 'wb') as message_file:
+            message_file.write(message)
+        os.utime(temp_name, (timestamp, timestamp))
+        final_name = os.path.join(self.path, 'cur', '%s:2,%s' % (name, info))
+        if os.name == 'nt' and os.path.exists(final_name):
+            os.remove(final_name)
+        os.rename(temp_name, final_name)
+
+    def flush(self):
+        return 0
+
+    def close(self):
+        pass
+
+WRITERS = { MBOX: MboxWriter, MAILDIR: MaildirWriter }
+
+# Export
+
+class AccountExport(object):
+    '''Exports the folders of an account using several connections.
+    '''
+
+    def __init__(self, server, destination, format=MBOX, connections=4,
+        checkpoint=None, batch_size=EXPORT_BATCH,
+        batch_bytes=EXPORT_BATCH_BYTES, progress=None):
+        '''
+        @param server: L{ImapServer<imapserver.ImapServer>} instance, with
+            the folder list already retrieved
+        @param destination: directory where the folders are written
+        @param format: MBOX or MAILDIR
+        @param connections: number of connections used at the same time
+        @param checkpoint: path of the checkpoint file
+        @param batch_size: maximum number of messages fetched at once
+        @param batch_bytes: maximum size of the messages fetched at once
+        @param progress: called as progress(folder path, messages) with the
+            number of messages of the folder exported so far. It's called
+            from the export threads.
+        '''
+        if format not in WRITERS:
+            raise ExportError('Unknown format: %s' % format)
+        self.server = server
+        self.destination = destination
+        self.writer_class = WRITERS[format]
+        self.connections = connections
+        self.checkpoint = Checkpoint(checkpoint)
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.progress = progress
+
+        self.lock = threading.Lock()
+        self.queue = []
+        self.result = {}
+        self.errors = []
+
+    def target(self, folder):
+        return os.path.join(self.destination, *[ safe_name(part)
+            for part in folder.parts ]) + self.writer_class.extension
+
+    def run(self, folder_list=None):
+        '''Exports the folders.
+
+        @param folder_list: list of L{Folder<imapfolder.Folder>} instances,
+            by default all the selectable folders.
+
+        @return: dict in the form { folder path: messages exported, ... }.
+            If some folders fail an L{ExportError} is raised after the
+            other folders are exported.
+        '''
+        if folder_list is None:
+            folder_list = [ folder for folder in
+                            self.server.folder_tree.iter_all()
+                            if not folder.noselect ]
+        # The biggest folders first, so that they don't end up alone
+        self.queue = sorted(folder_list,
+            key=lambda folder: folder.status.get('MESSAGES', 0),
+            reverse=True)
+        self.result = {}
+        self.errors = []
+
+        new_connection = getattr(self.server, 'new_connection', None)
+        if new_connection is None:
+            tree = self.server.folder_tree
+            selected = tree.selected
+            tree.selected = None
+            try:
+                self.worker(self.server._imap)
+            finally:
+                self.restore_selected(selected)
+        else:
+            workers = [ threading.Thread(target=self.connection_worker,
+                args=(new_connection,)) for i in range(min(
+                max(self.connections, 1), len(self.queue))) ]
+            for worker in workers:
+                worker.daemon = True
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+        if self.errors:
+            raise ExportError('; '.join([ '%s: %s' % error
+                                          for error in self.errors ]))
+        return self.result
+
+    def restore_selected(self, folder):
+        '''Selects again, on the main connection, the folder that was
+        selected before the export. If there was none the last folder
+        exported is closed.
+        '''
+        if folder is not None:
+            self.server.select_folder(folder)
+            return
+        imap = self.server._imap
+        try:
+            if imap.has_capability('UNSELECT'):
+                imap.unselect()
+            else:
+                # Doesn't expunge, the folders are examined
+                imap.close()
+        except Exception:
+            # No folder was examined
+            pass
+
+    def connection_worker(self, new_connection):
+        try:
+            imap = new_connection()
+        except Exception as error:
+            with self.lock:
+                self.errors.append(('connection', error))
+            return
+        try:
+            self.worker(imap)
+        finally:
+            try:
+                imap.logout()
+            except Exception:
+                pass
+
+    def worker(self, imap):
+        '''Exports folders from the queue until it's empty.
+        '''
+        while True:
+            with self.lock:
+                if not self.queue:
+                    return
+                folder = self.queue.pop(0)
+            try:
+                count = self.export_folder(imap, folder)
+            except Exception as error:
+                with self.lock:
+                    self.errors.append((folder.path, error))
+            else:
+                with self.lock:
+                    self.result[folder.path] = count
+
+    def batches(self, size_list):
+        '''Groups the messages on batches.
+
+        @param size_list: list of (UID, size) tuples
+        @return: list of UID lists
+        '''
+        batch_list = []
+        batch = []
+        total = 0
+        for uid, size in size_list:
+            if batch and (len(batch) >= self.batch_size or
+                          total + size > self.batch_bytes):
+                batch_list.append(batch)
+                batch = []
+                total = 0
+            batch.append(uid)
+            total += size
+        if batch:
+            batch_list.append(batch)
+        return batch_list
+
+    def export_folder(self, imap, folder):
+        '''Exports the messages of a folder not exported yet.
+
+        @return: number of messages exported.
+        '''
+        path = folder.path
+        response = command(imap, 'EXAMINE %s' % quote(path))
+        code = response.response_code('UIDVALIDITY')
+        uid_validity = code and code[0] or 0
+        exists = 0
+        for tokens in response.untagged:
+            if len(tokens) > 2 and str(tokens[2]).upper() == 'EXISTS':
+                exists = tokens[1]
+
+        last_uid, offset = self.checkpoint.get(path, uid_validity)
+        writer = self.writer_class(self.target(folder), offset)
+        count = 0
+        tag = None
+        try:
+            if not exists:
+                self.checkpoint.set(path, uid_validity, last_uid,
+                    writer.flush())
+                return 0
+
+            # n:* always matches the last message
+            response = command(imap, 'UID FETCH %d:* (RFC822.SIZE)' %
+                (last_uid + 1))
+            size_list = sorted([ (msg_info['UID'],
+                msg_info.get('RFC822.SIZE') or 0)
+                for msg_info in response.fetch_responses()
+                if msg_info.get('UID', 0) > last_uid ])
+            batch_list = self.batches(size_list)
+
+            query = 'UID FETCH %s (UID FLAGS INTERNALDATE BODY.PEEK[])'
+            if batch_list:
+                tag = send_command(imap, query % sequence_set(batch_list[0]))
+            for index, uid_list in enumerate(batch_list):
+                response = read_response(imap, tag)
+                tag = None
+                if index + 1 < len(batch_list):
+                    tag = send_command(imap, query %
+                        sequence_set(batch_list[index + 1]))
+                response.check()
+
+                msg_dict = dict([ (msg_info['UID'], msg_info)
+                                  for msg_info in response.fetch_responses()
+                                  if 'UID' in msg_info ])
+                for uid in uid_list:
+                    msg_info = msg_dict.get(uid)
+                    if msg_info is None or msg_info.get('BODY[]') is None:
+                        # Expunged meanwhile
+                        continue
+                    message = msg_info['BODY[]']
+                    if not isinstance(message, bytes):
+                        message = message.encode('latin-1')
+                    writer.write(message, msg_info.get('FLAGS') or [],
+                        internaldate_timestamp(msg_info.get('INTERNALDATE')),
+                        uid, uid_validity)
+                    count += 1
+
+                self.checkpoint.set(path, uid_validity, uid_list[-1],
+                    writer.flush())
+                if self.progress:
+                    self.progress(path, count)
+        finally:
+            writer.close()
+            if tag:
+                # Don't leave a response behind on the connection
+                read_response(imap, tag)
+        return count
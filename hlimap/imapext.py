@@ -0,0 +1,555 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of hlimap.
+##
+## hlimap is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## hlimap is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+
+'''High Level IMAP Lib - protocol extensions
+
+This module is part of the hlimap lib.
+
+Notes
+=====
+
+imaplibii processes the responses of the IMAP4rev1 commands and of a few
+extensions. Some of the extensions we use (ENABLE, CONDSTORE, QRESYNC, ...)
+have commands or responses it doesn't know about. Those commands are sent
+using the low level imaplibii object, and the responses are parsed here.
+
+We only use these methods of the low level object (IMAP4P._imap):
+
+    * send_command(command, read_resp=False) - sends a command line and
+      returns its tag;
+    * read_responses(tag) - reads the responses until the tagged response
+      with the given tag, and returns them as a list of raw lines. The
+      literals are kept inline, using the {n}CRLF syntax;
+    * send(data), readline() and read(size) - raw access to the socket,
+      only used by commands that don't follow the command/response
+      pattern, like IDLE.
+
+Since the tagged response is read separately, several commands can be
+pipelined: they are all sent before any response is read. The exception are
+the commands with synchronizing literals ({n}CRLF followed by the data on the
+command line): L{send_command} waits for the continuation request before
+sending each literal, so no other command can be waiting for a response.
+
+Parsed responses
+----------------
+
+The response lines are parsed to nested lists::
+
+    * 12 FETCH (UID 43 FLAGS (\\Seen) MODSEQ (624140003))
+
+    ['*', 12, 'FETCH', ['UID', 43, 'FLAGS', ['\\\\Seen'], 'MODSEQ',
+        [624140003]]]
+
+Numbers are converted to int, NIL to None, quoted strings and literals to
+str. Response codes (the [...] part of a status response) are parsed as
+lists too.
+'''
+
+# Imports
+import re
+
+# Exceptions:
+
+class ExtensionError(Exception): pass
+
+# Constants:
+
+_NUMBER = re.compile(r'^\d+$')
+_LITERAL = re.compile(r'\{(\d+)\+?\}\r?\n')
+_LITERAL_END = re.compile(r'\{(\d+)\}\r?\n$')
+_SYNC_LITERAL = re.compile(r'\{(\d+)\}\r\n')
+_ATOM_END = ' ()[]\r\n'
+
+# Maximum number of pipelined commands waiting for a response
+PIPELINE_WINDOW = 64
+
+# Parser
+
+def parse_response(line):
+    '''Parses a response line.
+
+    @return: list of tokens
+    '''
+    stack = [[]]
+    pos = 0
+    length = len(line)
+    while pos < length:
+        char = line[pos]
+        if char in ' \r\n':
+            pos += 1
+        elif char in '([':
+            new = []
+            stack[-1].append(new)
+            stack.append(new)
+            pos += 1
+        elif char in ')]':
+            if len(stack) > 1:
+                stack.pop()
+            pos += 1
+        elif char == '"':
+            pos += 1
+            chars = []
+            while pos < length and line[pos] != '"':
+                if line[pos] == '\\':
+                    pos += 1
+                chars.append(line[pos:pos+1])
+                pos += 1
+            stack[-1].append(''.join(chars))
+            pos += 1
+        elif char == '{' and _LITERAL.match(line, pos):
+            match = _LITERAL.match(line, pos)
+            size = int(match.group(1))
+            stack[-1].append(line[match.end():match.end() + size])
+            pos = match.end() + size
+        else:
+            # Atom, the brackets are part of it (BODY[HEADER.FIELDS (TO)])
+            start = pos
+            depth = 0
+            while pos < length:
+                char = line[pos]
+                if char == '[':
+                    depth += 1
+                elif char == ']':
+                    if not depth:
+                        break
+                    depth -= 1
+                elif not depth and char in _ATOM_END:
+                    break
+                pos += 1
+            atom = line[start:pos]
+            if _NUMBER.match(atom):
+                atom = int(atom)
+            elif atom.upper() == 'NIL':
+                atom = None
+            stack[-1].append(atom)
+    return stack[0]
+
+def parse_sequence_set(sequence_set, ordered=False):
+    '''Expands a sequence set ('1,3:5') to a list of numbers.
+
+    @param ordered: keep the order of the ranges, '5:3' gives [5, 4, 3]
+        instead of [3, 4, 5]. For the results of ESORT.
+    '''
+    numbers = []
+    for item in str(sequence_set).split(','):
+        if ':' in item:
+            first, last = item.split(':')
+            first, last = int(first), int(last)
+            if first > last:
+                if ordered:
+                    numbers.extend(range(first, last - 1, -1))
+                    continue
+                first, last = last, first
+            numbers.extend(range(first, last + 1))
+        elif item:
+            numbers.append(int(item))
+    return numbers
+
+def pairs(token_list):
+    '''Converts a list in the form [KEY, VALUE, KEY, VALUE, ...] to a dict,
+    the keys are upper cased.
+    '''
+    result = {}
+    for index in range(0, len(token_list) - 1, 2):
+        key = token_list[index]
+        if isinstance(key, str):
+            key = key.upper()
+        result[key] = token_list[index + 1]
+    return result
+
+def quote(text):
+    '''Quotes a string, escaping the quotes and backslashes.
+    '''
+    return '"%s"' % text.replace('\\', '\\\\').replace('"', '\\"')
+
+# Response
+
+class Response(object):
+    '''Responses to a command.
+    '''
+
+    def __init__(self, tag, lines):
+        self.tag = tag
+        self.untagged = []
+        self.status = None
+        self.text = ''
+        self.code = None
+        for line in lines:
+            if line.startswith('%s ' % tag):
+                tokens = parse_response(line)
+                self.status = str(tokens[1]).upper()
+                self.text = line
+                if len(tokens) > 2 and isinstance(tokens[2], list):
+                    self.code = tokens[2]
+            elif line.startswith('*'):
+                self.untagged.append(parse_response(line))
+
+    def ok(self):
+        return self.status == 'OK'
+
+    def check(self):
+        if not self.ok():
+            raise ExtensionError(self.text)
+        return self
+
+    def responses(self, name):
+        '''Iterates through the untagged responses with the given name, the
+        tokens after the name are returned.
+
+        For instance, for 'VANISHED' the response '* VANISHED 1:3' gives
+        ['1:3'] and for 'FETCH' the response '* 3 FETCH (...)' gives [[...]].
+        '''
+        name = name.upper()
+        for tokens in self.untagged:
+            for index in (1, 2):
+                if (len(tokens) > index and isinstance(tokens[index], str)
+                    and tokens[index].upper() == name):
+                    yield tokens[index + 1:]
+                    break
+
+    def fetch_responses(self):
+        '''Iterates through the FETCH responses, returns dicts with the
+        fetched items.
+        '''
+        for tokens in self.responses('FETCH'):
+            if tokens and isinstance(tokens[0], list):
+                yield pairs(tokens[0])
+
+    def response_code(self, name):
+        '''Returns the arguments of a response code on the tagged
+        response, or on an untagged OK response.
+        '''
+        name = name.upper()
+        codes = [ self.code ] + [ tokens[2] for tokens in self.untagged
+            if len(tokens) > 2 and isinstance(tokens[2], list) ]
+        for code in codes:
+            if (code and isinstance(code[0], str) and
+                code[0].upper() == name):
+                return code[1:]
+        return None
+
+# Commands
+
+def literal_segments(command):
+    '''Splits a command line on the parts sent before and after each
+    continuation request, at the synchronizing literals ({n}CRLF followed by
+    the data). The non synchronizing literals ({n+}CRLF) are left alone.
+
+    @return: list of strings, the first one is the command line up to the
+        first literal size, the others begin with the literal data. The
+        line breaks are not included.
+    '''
+    segments = []
+    start = 0
+    position = 0
+    while True:
+        match = _SYNC_LITERAL.search(command, position)
+        if not match:
+            break
+        segments.append(command[start:match.end() - 2])
+        start = match.end()
+        position = start + int(match.group(1))
+    segments.append(command[start:])
+    return segments
+
+def send_command(imap, command):
+    '''Sends a command without waiting for the response. The synchronizing
+    literals on the command line are sent when the server asks for them.
+
+    @param imap: IMAP4P instance
+    @return: the command tag. An L{ExtensionError} is raised if the server
+        refuses a literal.
+    '''
+    segments = literal_segments(command)
+    tag = imap._imap.send_command(segments[0], read_resp=False)
+    for segment in segments[1:]:
+        response = read_line(imap)
+        if not response.startswith('+'):
+            raise ExtensionError(response.strip())
+        imap._imap.send('%s\r\n' % segment)
+    return tag
+
+def read_response(imap, tag):
+    '''Reads the responses of a command sent with L{send_command}.
+
+    @return: L{Response} instance.
+    '''
+    return Response(tag, imap._imap.read_responses(tag))
+
+def send_line(imap, line):
+    '''Sends a line that isn't a command, for instance DONE to end an IDLE
+    command.
+    '''
+    imap._imap.send('%s\r\n' % line)
+
+def read_line(imap):
+    '''Reads a single response line, with the literals inline.
+    '''
+    line = imap._imap.readline()
+    while True:
+        match = _LITERAL_END.search(line)
+        if not match:
+            break
+        line += imap._imap.read(int(match.group(1)))
+        line += imap._imap.readline()
+    return line
+
+def command(imap, command):
+    '''Sends a command and waits for the response.
+
+    @return: L{Response} instance, an L{ExtensionError} is raised if the
+        command fails.
+    '''
+    return read_response(imap, send_command(imap, command)).check()
+
+def pipeline(imap, command_list, window=PIPELINE_WINDOW):
+    '''Sends the commands without waiting for the previous responses.
+
+    At most window commands are waiting for a response at any time, so
+    that neither side blocks writing to a full socket buffer.
+
+    @return: list of L{Response} instances, on the same order as the
+        commands. The status of the responses is not checked.
+    '''
+    tags = []
+    responses = []
+    for command in command_list:
+        if len(tags) - len(responses) >= window:
+            responses.append(read_response(imap, tags[len(responses)]))
+        tags.append(send_command(imap, command))
+    for tag in tags[len(responses):]:
+        responses.append(read_response(imap, tag))
+    return responses
+
+def send_append(imap, mailbox, message_list, literal_plus=False):
+    '''Sends an APPEND command without waiting for the tagged response. With
+    more than one message it's a MULTIAPPEND command, RFC 3502.
+
+    With synchronizing literals we have to wait for the server before
+    sending each message, so no other command can be waiting for a response.
+    With non synchronizing literals (LITERAL+, RFC 7888) the command is sent
+    at once and can be pipelined.
+
+    @param message_list: list of (message, flag list, date) tuples, the
+        messages are octets with CRLF line endings and the date is an IMAP
+        date-time string or None
+    @param literal_plus: use non synchronizing literals
+
+    @return: the command tag. An L{ExtensionError} is raised if the server
+        refuses a literal.
+    '''
+    marker = literal_plus and '+' or ''
+    tag = None
+    for message, flags, date in message_list:
+        line = ' (%s)' % ' '.join(flags)
+        if date:
+            line += ' %s' % quote(date)
+        # The literal size counts octets
+        line += ' {%d%s}' % (len(message), marker)
+        if tag is None:
+            tag = send_command(imap, 'APPEND %s%s' % (quote(mailbox), line))
+        else:
+            imap._imap.send(('%s\r\n' % line).encode('latin-1'))
+        if not literal_plus:
+            response = read_line(imap)
+            if not response.startswith('+'):
+                raise ExtensionError(response.strip())
+        imap._imap.send(message)
+    imap._imap.send(b'\r\n')
+    return tag
+
+def search_command(imap, command_line):
+    '''Sends a SEARCH, SORT or THREAD command, used instead of the imaplibii
+    methods when the search keys have synchronizing literals.
+
+    @return: list of numbers on the order given by the server, or nested
+        lists for THREAD, as returned by thread_smart.
+    '''
+    response = command(imap, command_line)
+    result = []
+    for name in ('SEARCH', 'SORT', 'THREAD'):
+        for tokens in response.responses(name):
+            result.extend(tokens)
+    return result
+
+def copy_uids(response_list):
+    '''Collects the COPYUID response codes of UID COPY or UID MOVE commands,
+    UIDPLUS extension, RFC 4315.
+
+    @return: a tuple (UIDVALIDITY of the destination mailbox, as an int,
+        { UID: new UID, ... }), (None, {}) if the server didn't send
+        COPYUID.
+    '''
+    uid_validity = None
+    uid_map = {}
+    for response in response_list:
+        code = response.response_code('COPYUID')
+        if not code or len(code) != 3:
+            continue
+        source = parse_sequence_set(code[1])
+        destination = parse_sequence_set(code[2])
+        if len(source) == len(destination):
+            uid_validity = int(code[0])
+            uid_map.update(zip(source, destination))
+    return uid_validity, uid_map
+
+def extended_search(imap, command_line):
+    '''Sends a SEARCH or SORT command with the RETURN option, ESEARCH (RFC
+    4731) and ESORT (RFC 5267) extensions, and parses the ESEARCH response.
+
+    @return: dict with the result options returned: COUNT, MIN and MAX are
+        numbers, ALL and PARTIAL are lists of numbers on the order given by
+        the server.
+    '''
+    response = command(imap, command_line)
+    result = {}
+    for tokens in response.responses('ESEARCH'):
+        # Skip the (TAG "...") correlator and the UID indicator
+        while tokens and (isinstance(tokens[0], list) or
+                          str(tokens[0]).upper() == 'UID'):
+            tokens = tokens[1:]
+        for name, value in pairs(tokens).items():
+            if name == 'PARTIAL':
+                # (first:last uid-set), NIL if there are no messages
+                if isinstance(value, list) and len(value) > 1 and value[1]:
+                    value = parse_sequence_set(value[1], True)
+                else:
+                    value = []
+            elif name == 'ALL':
+                value = parse_sequence_set(value, True)
+            result[name] = value
+    return result
+
+def enable(imap, *capabilities):
+    '''ENABLE extension, RFC 5161. Must be used on the authenticated state.
+
+    @return: list of the enabled capabilities.
+    '''
+    capabilities = [ capability for capability in capabilities
+                     if imap.has_capability(capability) ]
+    if not capabilities or not imap.has_capability('ENABLE'):
+        return []
+    response = command(imap, 'ENABLE %s' % ' '.join(capabilities))
+    enabled = []
+    for tokens in response.responses('ENABLED'):
+        enabled.extend([ str(token).upper() for token in tokens ])
+    return enabled
+
+def fetch_changes(imap, modseq, vanished=False, message_set='1:*'):
+    '''Fetches the flags changed since a mod-sequence, CONDSTORE and QRESYNC
+    extensions, RFC 7162.
+
+    @param modseq: the HIGHESTMODSEQ we know about
+    @param vanished: ask for the expunged messages (QRESYNC must be enabled)
+
+    @return: a tuple (vanished uid list, { UID: flag list, ...}, highest
+        modseq found on the responses)
+    '''
+    modifiers = 'CHANGEDSINCE %d' % modseq
+    if vanished:
+        modifiers += ' VANISHED'
+    response = command(imap, 'UID FETCH %s (FLAGS) (%s)' % (message_set,
+        modifiers))
+
+    vanished_list = []
+    for tokens in response.responses('VANISHED'):
+        if tokens and isinstance(tokens[0], list):
+            # (EARLIER)
+            tokens = tokens[1:]
+        for token in tokens:
+            vanished_list.extend(parse_sequence_set(token))
+
+    changed = {}
+    highest = modseq
+    for msg_info in response.fetch_responses():
+        if 'UID' not in msg_info:
+            continue
+        changed[msg_info['UID']] = msg_info.get('FLAGS') or []
+        msg_modseq = msg_info.get('MODSEQ')
+        if msg_modseq:
+            highest = max(highest, msg_modseq[0])
+
+    return vanished_list, changed, highest
+
+def status(imap, mailbox, items):
+    '''STATUS command with items imaplibii might not know about.
+
+    @return: dict with the status items
+    '''
+    response = command(imap, 'STATUS %s (%s)' % (quote(mailbox),
+        ' '.join(items)))
+    for tokens in response.responses('STATUS'):
+        if len(tokens) > 1 and isinstance(tokens[1], list):
+            return pairs(tokens[1])
+    return {}
+
+def list_mailboxes(imap, pattern, name='LIST', reference=''):
+    '''LIST or LSUB command.
+
+    @return: list of (flag list, delimiter, mailbox name) tuples, the flags
+        are upper cased.
+    '''
+    response = command(imap, '%s %s %s' % (name, quote(reference),
+        quote(pattern)))
+    mailbox_list = []
+    for tokens in response.responses(name):
+        if len(tokens) >= 3 and isinstance(tokens[0], list):
+            mailbox_list.append(([ str(flag).upper() for flag in tokens[0] ],
+                tokens[1], str(tokens[2])))
+    return mailbox_list
+
+def status_responses(response_list):
+    '''Collects the STATUS responses.
+
+    @return: dict in the form { mailbox: status dict, ... }
+    '''
+    result = {}
+    for response in response_list:
+        for tokens in response.responses('STATUS'):
+            if len(tokens) > 1 and isinstance(tokens[1], list):
+                result[str(tokens[0])] = pairs(tokens[1])
+    return result
+
+def status_all(imap, mailbox_list, items, list_status=True):
+    '''Gets the status of several mailboxes at once.
+
+    If the server has the LIST-STATUS extension (RFC 5819) a single LIST
+    command returns the status of all the mailboxes, otherwise the STATUS
+    commands are pipelined.
+
+    @param mailbox_list: list of mailbox paths
+    @param items: list of status items
+    @param list_status: use LIST-STATUS if available
+
+    @return: dict in the form { mailbox: status dict, ... }, the mailboxes
+        for which the server didn't return the status are missing.
+    '''
+    items = ' '.join(items)
+    if list_status and imap.has_capability('LIST-STATUS'):
+        responses = [ command(imap, 'LIST "" "*" RETURN (STATUS (%s))' %
+            items) ]
+    else:
+        responses = pipeline(imap, [ 'STATUS %s (%s)' % (quote(mailbox),
+            items) for mailbox in mailbox_list ])
+    return status_responses(responses)
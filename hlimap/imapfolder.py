@@ -23,26 +23,60 @@
 #
 # $Id: imapfolder.py 20 2010-01-15 20:44:48Z hguerreiro $
 #
-from imapmessage import MessageList
-from imaplibii.parselist import Mailbox
+from .imapmessage import MessageList, UNSORTED
+from .imapext import fetch_changes, status, status_all, list_mailboxes, \
+    pipeline, copy_uids, quote, command
+from .imapimport import import_messages, IMPORT_BATCH, \
+    IMPORT_BATCH_BYTES
+from .utils import sequence_sets
 import base64
 
 class DupError(Exception): pass
 class NoSuchFolder(Exception): pass
 class NoFolderListError(Exception): pass
 
+# Status items shown for each folder
+STATUS_ITEMS = ( 'MESSAGES', 'RECENT', 'UIDNEXT', 'UIDVALIDITY', 'UNSEEN' )
+
 class FolderTree(object):
     def __init__(self, server ):
         '''Initializes the folder tree.
         '''
-        self._imap = server._imap
         self.server = server
         self.dl = None
         self.folder_dict = {}
         self.root_folder = []
         self.selected = None
+        self.folder_class = Folder
+        # Lazy mode, the sub folders are listed on demand
+        self.lazy = False
+        self.subscribed = True
+
+    def _get_imap(self):
+        return self.server._imap
+    _imap = property(_get_imap)
+
+    def refresh_folders( self, subscribed=True, lazy=False ):
+        '''Gets the folder list from the server.
+
+        @param subscribed: list only the subscribed folders
+        @param lazy: list only the first level of the hierarchy, the sub
+            folders of a folder are listed when the folder is expanded or
+            iter_all reaches it. Use this with huge hierarchies.
+        '''
+        self.lazy = lazy
+        self.subscribed = subscribed
+        if lazy:
+            mailbox_list = list_mailboxes(self._imap, '%',
+                subscribed and 'LSUB' or 'LIST')
+            if not mailbox_list:
+                raise NoFolderListError('No folders found')
+            self.dl = mailbox_list[0][1] or '.'
+            for flags, delimiter, name in mailbox_list:
+                self.add_mailbox(flags, delimiter, name, subscribed)
+            self.sort()
+            return
 
-    def refresh_folders( self, subscribed=True ):
         # It's very fast to retrieve the folder listing, so we just
         # query the server for all the folders.
         if subscribed:
@@ -63,10 +97,11 @@ class FolderTree(object):
 
     def add_folder( self, parts, subscribed, child = None, noselect = False ):
         path = self.dl.join( parts )
-        if not self.folder_dict.has_key(path):
-            self.folder_dict[ path ] = { 'data' : Folder(self.server, self, parts,
-                                                         subscribed, noselect),
+        if path not in self.folder_dict:
+            self.folder_dict[ path ] = { 'data' : self.folder_class(self.server,
+                                                    self, parts, subscribed, noselect),
                                          'children': [] }
+            self.folder_dict[ path ]['data'].children_loaded = not self.lazy
             if len(parts) == 1:
                 self.root_folder.append( path )
 
@@ -78,42 +113,81 @@ class FolderTree(object):
 
         if parent_parts:
             parent_path = self.dl.join( parent_parts )
-            if not self.folder_dict.has_key( parent_path ):
+            if parent_path not in self.folder_dict:
                 self.add_folder( parent_parts, False, child = path,
                     noselect = True )
             else:
                 self.add_folder( parent_parts, subscribed, child = path )
 
 
+    def add_mailbox(self, flags, delimiter, name, subscribed):
+        '''Adds a folder from a LIST or LSUB response.
+
+        @param flags: list of mailbox flags, upper case
+        '''
+        if delimiter:
+            parts = name.split(delimiter)
+        else:
+            parts = [ name ]
+        noselect = r'\NOSELECT' in flags or r'\NONEXISTENT' in flags
+        path = self.dl.join( parts )
+        if path in self.folder_dict:
+            # Created before as the parent of another folder
+            folder = self.folder_dict[path]['data']
+            folder.noselect = noselect
+            folder.subscribed = subscribed
+        self.add_folder( parts, subscribed, noselect = noselect )
+
+        if self.lazy:
+            folder = self.folder_dict[path]['data']
+            if (r'\HASNOCHILDREN' in flags or r'\NOINFERIORS' in flags or
+                not delimiter):
+                folder.children_loaded = True
+            elif r'\HASCHILDREN' in flags:
+                folder.children_hint = True
+
+    def load_children(self, path):
+        '''On the lazy mode, lists the sub folders of a folder if it wasn't
+        done before.
+        '''
+        folder = self.folder_dict[path]['data']
+        if folder.children_loaded:
+            return
+        folder.children_loaded = True
+
+        for flags, delimiter, name in list_mailboxes(self._imap,
+            '%s%s%%' % (path, self.dl), self.subscribed and 'LSUB' or 'LIST'):
+            self.add_mailbox(flags, delimiter, name, self.subscribed)
+
+        children = self.folder_dict[path]['children']
+        if children:
+            self.sort( children )
+
     # Set folder properties
     def set_properties(self, expand_list,  special_folders):
+        # The parents first, on the lazy mode expanding a folder lists
+        # its children
+        expand_list = sorted(expand_list,
+            key=lambda folder_name: folder_name.count(self.dl))
         for folder_name in expand_list:
-            if self.folder_dict.has_key( folder_name ):
+            if folder_name in self.folder_dict:
                 self.folder_dict[folder_name]['data'].set_expand(True)
 
         for folder_name in special_folders:
-            if self.folder_dict.has_key( folder_name ):
+            if folder_name in self.folder_dict:
                 self.folder_dict[folder_name]['data'].special = True
 
     def sort(self, folder_list = None):
         '''Sorts the folders.
         '''
-        def compare( name1, name2 ):
-            spc1 = self.folder_dict[name1]['data'].special
-
-            spc2 = self.folder_dict[name2]['data'].special
-
-            if spc1 and not spc2:
-                return -1
-            elif not spc1 and spc2:
-                return 1
-            else:
-                return cmp( name1, name2 )
+        def sort_key( name ):
+            # The special folders first
+            return ( not self.folder_dict[name]['data'].special, name )
 
         if not folder_list:
             folder_list = self.root_folder
 
-        folder_list.sort(compare)
+        folder_list.sort(key=sort_key)
 
         for folder_name in folder_list:
             children = self.folder_dict[folder_name]['children']
@@ -122,8 +196,20 @@ class FolderTree(object):
 
 
     def refresh_status(self):
-        for folder in self.iter_all():
-            folder.refresh_status()
+        '''Gets the status of all the folders, using a single LIST command
+        if the server has LIST-STATUS, or pipelined STATUS commands.
+        '''
+        all_folders = [ item['data'] for item in self.folder_dict.values() ]
+        folder_list = [ folder for folder in all_folders
+                        if not folder.noselect ]
+        # On the lazy mode LIST-STATUS would list the whole hierarchy
+        status_dict = status_all(self.server._imap,
+            [ folder.path for folder in folder_list ], STATUS_ITEMS,
+            list_status = not self.lazy)
+
+        for folder in all_folders:
+            # If the status is missing it'll be asked on the first access
+            folder.status = status_dict.get(folder.path, {})
 
     # Iterators
 
@@ -136,6 +222,8 @@ class FolderTree(object):
         for folder_name in folder_list:
             yield self.folder_dict[folder_name]['data']
             # iteract children
+            if self.lazy:
+                self.load_children( folder_name )
             children = self.folder_dict[folder_name]['children']
             for child in self.iter_all( children ):
                 yield child
@@ -158,7 +246,7 @@ class FolderTree(object):
 
     # Folder operations
     def get_folder(self, path):
-        if not self.folder_dict.has_key(path):
+        if path not in self.folder_dict:
             try:
                 mailbox = self._imap.lsub("", path)[0]
                 self.dl = mailbox.delimiter
@@ -168,11 +256,7 @@ class FolderTree(object):
                 child = None, noselect = mailbox.noselect() )
 
         folder = self.folder_dict[path]['data']
-
-        if self.selected and self._imap.has_capability('UNSELECT'):
-            self._imap.unselect()
-            self.selected = None
-        self.selected = folder.select()
+        self.server.select_folder(folder)
 
         return folder
 
@@ -214,7 +298,6 @@ class Flags(object):
 class Folder(object):
     def __init__(self, server, tree, parts, subscribed=True,
         noselect = False):
-        self._imap = server._imap
         self.server = server
         self.tree = tree
         self.server = server
@@ -230,6 +313,10 @@ class Folder(object):
 
         # Tree behavior
         self.expanded = False
+        # Lazy mode: were the sub folders listed? Did the server tell us
+        # there are sub folders (\HasChildren)?
+        self.children_loaded = True
+        self.children_hint = False
         self.special = False
         self.noselect = noselect
         self.subscribed = subscribed
@@ -238,16 +325,31 @@ class Folder(object):
         self.status = {}
         self.flags = None
 
+        # Mailbox state on the last select: UIDVALIDITY, HIGHESTMODSEQ,
+        # UIDNEXT and EXISTS
+        self.sync_state = None
+
         # Messages
         self.__message_list = None
 
     # Attributes
+    def _get_imap(self):
+        return self.server.connection(self)
+    _imap = property(_get_imap, None, None,
+        'Connection used for the operations on this folder.')
+
     def haschildren(self):
+        if not self.children_loaded:
+            if self.children_hint:
+                return True
+            self.tree.load_children(self.path)
         return bool(self.tree.folder_dict[self.path]['children'])
     has_children = property( haschildren )
 
     def set_expand(self, value):
         self.expanded = value
+        if value:
+            self.tree.load_children(self.path)
         #if value:
             ## If the folder is to be expanded then all parent folders
             ## should also be expanded
@@ -257,13 +359,14 @@ class Folder(object):
     # Mailbox statistics
     def refresh_status(self):
         if not self.noselect:
-            self.status = self._imap.status(self.path,
-                '(MESSAGES RECENT UIDNEXT UIDVALIDITY UNSEEN)')
+            # No need for a selected mailbox here
+            self.status = self.server._imap.status(self.path,
+                '(%s)' % ' '.join(STATUS_ITEMS))
         else:
             self.status = {}
 
     def get_status(self, prop):
-        if not self.status:
+        if prop not in self.status:
             self.refresh_status()
         return self.status[prop]
 
@@ -295,7 +398,10 @@ class Folder(object):
     def url(self):
         '''Return the folder name on a url safe way
         '''
-        return base64.urlsafe_b64encode(self.path)
+        url = base64.urlsafe_b64encode(self.path.encode('ascii'))
+        if not isinstance(url, str):
+            url = url.decode('ascii')
+        return url
 
     def unicode_name(self):
         return self.__unicode__()
@@ -304,7 +410,28 @@ class Folder(object):
     def append( self, message ):
         '''Appends a message to this folder
         '''
-        self._imap.append( self.path, message, '(\Seen)' )
+        self.server._imap.append( self.path, message, r'(\Seen)' )
+
+    def import_messages(self, source, batch_size=IMPORT_BATCH,
+        batch_bytes=IMPORT_BATCH_BYTES, progress=None):
+        '''Appends many messages to this folder, keeping their flags and
+        dates. Uses MULTIAPPEND and pipelined commands when available.
+
+        @param source: path of an mbox file or of a Maildir, or an iterable
+            of messages or of (message, flag list, date) tuples
+        @param progress: called as progress(messages, octets) as the
+            messages are appended
+
+        @return: list of (UIDVALIDITY, UID) tuples, see
+            L{import_messages<imapimport.import_messages>}
+        '''
+        try:
+            # Like append, the folder doesn't have to be selected
+            return import_messages(self.server._imap, self.path, source,
+                batch_size, batch_bytes, progress)
+        finally:
+            self.status = {}
+            self.__message_list = None
 
     # Folder operations:
     def select(self):
@@ -329,17 +456,217 @@ class Folder(object):
             self.status['UIDNEXT'] = get_status(result, 'UIDNEXT')
             self.status['UIDVALIDITY'] = get_status(result, 'UIDVALIDITY')
 
+        if self.server.condstore:
+            self.resync(result)
+
         return self
 
+    def resync(self, result):
+        '''Incremental resynchronization using CONDSTORE, RFC 7162.
+
+        We remember the HIGHESTMODSEQ of the mailbox, and when it's selected
+        again only the flags changed since then are fetched. If the number
+        of messages shows that some were expunged, the UIDs still on the
+        mailbox are searched to find them. Those changes are applied to the
+        existing message list, instead of doing a new SORT or THREAD.
+
+        QRESYNC isn't used: once enabled the server sends VANISHED responses
+        instead of EXPUNGE, on all the commands, and imaplibii doesn't
+        understand them.
+
+        @param result: the SELECT command response
+        '''
+        modseq = result.get('HIGHESTMODSEQ')
+        if modseq is None:
+            modseq = status(self._imap, self.path,
+                ['HIGHESTMODSEQ']).get('HIGHESTMODSEQ')
+        if not modseq:
+            # The mailbox doesn't support mod-sequences (NOMODSEQ)
+            self.sync_state = None
+            return
+
+        old_state = self.sync_state
+        self.sync_state = (result.get('UIDVALIDITY'), int(modseq),
+            result.get('UIDNEXT'), result['EXISTS'])
+        message_list = self.__message_list
+        if not old_state or not message_list:
+            return
+        uid_validity, old_modseq, uid_next, exists = old_state
+
+        if uid_validity != self.sync_state[0]:
+            # All the UIDs we know about are invalid
+            self.__message_list = None
+            return
+        if old_modseq == self.sync_state[1]:
+            # Nothing changed
+            return
+
+        vanished, changed, highest = fetch_changes(self._imap, old_modseq)
+
+        if not uid_next:
+            message_list.reset()
+            return
+        new = len([ uid for uid in changed if uid >= uid_next ])
+        if exists + new != self.sync_state[3] and not message_list.refresh:
+            if message_list.window_start is not None:
+                # Only a window of the list is known
+                message_list.reset()
+                return
+            # Some messages were expunged, the ones we know about that
+            # aren't on the mailbox anymore
+            remaining = set(self._imap.search_smart('UID 1:%d' % (
+                uid_next - 1)))
+            vanished = [ uid for uid in message_list.flat_message_list
+                         if uid not in remaining ]
+
+        if vanished and self.server.envelope_cache:
+            self.server.envelope_cache.invalidate(self.path, vanished)
+
+        message_list.apply_changes(vanished, changed)
+
+    def noop(self):
+        '''Gets the changes made to the selected mailbox by other
+        connections. If there are any, the message list is resynchronized
+        with CONDSTORE, or reloaded when the list is needed again.
+
+        @return: True if the mailbox changed
+        '''
+        response = command(self._imap, 'NOOP')
+        for name in ('EXISTS', 'EXPUNGE', 'VANISHED', 'FETCH'):
+            if list(response.responses(name)):
+                break
+        else:
+            return False
+        if self.server.condstore:
+            self.select()
+        elif self.__message_list:
+            self.__message_list.reset()
+        return True
+
     def expunge(self):
         self._imap.expunge()
         self.__message_list = None
 
     def set_flags(self, message_list, *args ):
-        return self._imap.store_smart(message_list, '+FLAGS.SILENT', args)
+        return self.message_list.set_flags(message_list, *args)
 
     def reset_flags(self, message_list, *args ):
-        return self._imap.store_smart(message_list, '-FLAGS.SILENT', args)
+        return self.message_list.reset_flags(message_list, *args)
+
+    def store_flags(self, message_list, command, flags):
+        '''UID STORE command. The message list is sent as sequence sets
+        (1:100,200), split on several pipelined commands if it's too long.
+
+        @param command: +FLAGS, -FLAGS, FLAGS, optionally .SILENT
+        @param flags: list of flags
+
+        @return: dict in the form { UID: flag list, ... } with the FETCH
+            responses received.
+        '''
+        command_list = [ 'UID STORE %s %s (%s)' % (message_set, command,
+            ' '.join(flags)) for message_set in sequence_sets(message_list) ]
+        changed = {}
+        for response in pipeline(self._imap, command_list):
+            response.check()
+            for msg_info in response.fetch_responses():
+                if 'UID' in msg_info and 'FLAGS' in msg_info:
+                    changed[msg_info['UID']] = msg_info['FLAGS']
+        return changed
+
+    # Copy and move
+    def copy_to(self, folder, message_list):
+        '''Copies messages to another folder with UID COPY. Long message
+        lists are split on several pipelined commands.
+
+        @param folder: destination L{Folder} instance
+        @param message_list: list of UIDs
+
+        @return: dict in the form { UID: new UID, ... } taken from the
+            COPYUID responses, empty if the server doesn't have the UIDPLUS
+            extension.
+        '''
+        return self.transfer(folder, message_list, False)
+
+    def move_to(self, folder, message_list):
+        '''Moves messages to another folder. With the MOVE extension (RFC
+        6851) UID MOVE is used, otherwise the messages are copied, flagged
+        \\Deleted and removed with UID EXPUNGE. Without UIDPLUS there's no
+        UID EXPUNGE, the messages are only flagged, use L{expunge} to
+        remove them.
+
+        @return: dict in the form { UID: new UID, ... }, see L{copy_to}
+        '''
+        return self.transfer(folder, message_list, True)
+
+    def transfer(self, folder, message_list, move):
+        if self.server.folder_tree.selected is not self:
+            # The UIDs are the ones of this folder
+            self.server.select_folder(self)
+        imap = self._imap
+        message_list = list(message_list)
+        message_sets = sequence_sets(message_list)
+        use_move = move and imap.has_capability('MOVE')
+
+        responses = pipeline(imap, [ 'UID %s %s %s' % (use_move and 'MOVE'
+            or 'COPY', message_set, quote(folder.path))
+            for message_set in message_sets ])
+        for response in responses:
+            response.check()
+        uid_validity, uid_map = copy_uids(responses)
+
+        expunged = use_move
+        if move and not use_move:
+            self.message_list.store_flags(message_list, '+FLAGS.SILENT',
+                [ r'\Deleted' ])
+            if imap.has_capability('UIDPLUS'):
+                for response in pipeline(imap, [ 'UID EXPUNGE %s' %
+                    message_set for message_set in message_sets ]):
+                    response.check()
+                expunged = True
+
+        self.transferred(folder, message_list, uid_validity, uid_map,
+            expunged)
+        return uid_map
+
+    def transferred(self, folder, message_list, uid_validity, uid_map,
+        expunged):
+        '''Updates the message lists and the caches of this folder and of
+        the destination folder after a copy or a move. The cached data is
+        copied to the new UIDs instead of being fetched again.
+        '''
+        envelope_cache = self.server.envelope_cache
+        body_cache = self.server.body_cache
+        if uid_map and (envelope_cache or body_cache):
+            try:
+                source_validity = self.uid_validity()
+            except KeyError:
+                # Not sent by the server, the caches ignore the data
+                source_validity = None
+            if envelope_cache:
+                envelope_cache.copy(self.path, source_validity, folder.path,
+                    uid_validity, uid_map)
+            if body_cache:
+                body_cache.copy(self.path, source_validity, folder.path,
+                    uid_validity, uid_map, expunged)
+
+        if expunged:
+            if envelope_cache:
+                envelope_cache.invalidate(self.path, message_list)
+            if self.__message_list:
+                self.__message_list.apply_changes(vanished=message_list)
+            self.status = {}
+
+        folder.status = {}
+        destination_list = folder.__message_list
+        if destination_list:
+            if (uid_map and destination_list.show_style == UNSORTED and
+                destination_list.search_expression.upper() == 'ALL'):
+                # The destination isn't selected, the new messages can be
+                # added only if there's no need to search or sort them
+                destination_list.apply_changes(changed=dict([ (uid, [])
+                    for uid in uid_map.values() ]))
+            else:
+                destination_list.reset()
 
     # Message list management
     def _get_message_list(self):
@@ -360,11 +687,16 @@ class Folder(object):
 
     # Special methods
     def __unicode__(self):
+        # Modified UTF-7, RFC 3501 section 5.1.3, one character per octet
+        # on Python 3
         mailbox = self.name
+        if not isinstance(mailbox, bytes):
+            mailbox = mailbox.encode('latin-1')
         try:
-            return unicode(mailbox.replace('+','+-').replace('&','+'),'utf-7')
+            return mailbox.replace(b'+', b'+-').replace(b'&', b'+').decode(
+                'utf-7')
         except UnicodeDecodeError:
-            return unicode(mailbox.replace('+','+-').replace('&','+'),'utf-8')
+            return mailbox.decode('utf-8', 'replace')
 
     def __repr__(self):
         return '<Folder instance "%s">' % (self.name)
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of hlimap.
+##
+## hlimap is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## hlimap is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+
+'''High Level IMAP Lib - live updates
+
+This module is part of the hlimap lib.
+
+Notes
+=====
+
+An L{IdleListener} keeps an IDLE command (RFC 2177) running on a folder and
+reports the new, expunged and changed messages as they happen, so there's no
+need to poll the server.
+
+IDLE blocks the connection, so the listener needs a connection of its own,
+already authenticated. It's logged out when the listener stops::
+
+    >>> M = PooledImapServer('example.com')
+    >>> M.login('user', 'password')
+    >>> folder = M['INBOX']
+    >>> listener = IdleListener(folder, M.new_connection())
+    >>> listener.subscribe(notify_browser)
+    >>> listener.start()
+
+The subscribers are called from the listener thread with a L{Changes}
+instance. A subscriber can be the put method of a Queue.Queue, for
+instance.
+
+The folder message list is not changed by the listener thread. The thread
+using the folder calls L{IdleListener.apply} from time to time (for
+instance at the start of each request) to apply the changes received so
+far to the message list.
+'''
+
+# Imports
+import threading
+
+from .imapext import send_command, read_response, read_line, send_line, \
+    command, parse_response, parse_sequence_set, pairs, quote, \
+    ExtensionError
+
+# Constants:
+
+# The servers may drop an IDLE connection after 30 minutes (RFC 2177),
+# so the IDLE command is restarted before that.
+IDLE_TIMEOUT = 29 * 60 - 60
+
+class Changes(object):
+    '''Changes on a mailbox.
+    '''
+
+    def __init__(self, vanished=None, changed=None, exists=None):
+        '''
+        @param vanished: list of expunged UIDs
+        @param changed: dict in the form { UID: flag list, ... } with the
+            new messages and the messages whose flags changed
+        @param exists: number of messages on the mailbox
+        '''
+        self.vanished = vanished or []
+        self.changed = changed or {}
+        self.exists = exists
+
+    def __repr__(self):
+        return '<Changes vanished %s changed %s exists %s>' % (
+            self.vanished, self.changed.keys(), self.exists)
+
+class IdleListener(threading.Thread):
+    '''Listens for changes on a folder using IDLE.
+    '''
+
+    def __init__(self, folder, imap, timeout=IDLE_TIMEOUT):
+        '''
+        @param folder: L{Folder<imapfolder.Folder>} instance
+        @param imap: IMAP4P instance used only by the listener, it must be
+            authenticated and must have the IDLE capability
+        @param timeout: seconds after which the IDLE command is restarted
+        '''
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.folder = folder
+        self.imap = imap
+        self.timeout = timeout
+
+        self.subscribers = []
+        self.pending = []
+        self.lock = threading.RLock()
+        self.stopped = False
+        self.error = None
+
+        # Tag of the running IDLE command
+        self.idle_tag = None
+        self.done_sent = False
+        # UIDs of the messages, by sequence number
+        self.uid_list = []
+
+    # Subscribers
+
+    def subscribe(self, callback):
+        '''The callback is called with a L{Changes} instance for each change
+        on the mailbox.
+        '''
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self.subscribers.remove(callback)
+
+    def publish(self, changes):
+        with self.lock:
+            self.pending.append(changes)
+        for callback in self.subscribers:
+            callback(changes)
+
+    def apply(self):
+        '''Applies the changes received to the folder message list. Must be
+        called by the thread that uses the folder.
+
+        @return: list of L{Changes} instances applied.
+        '''
+        with self.lock:
+            pending, self.pending = self.pending, []
+
+        folder = self.folder
+        cache = folder.server.envelope_cache
+        for changes in pending:
+            if changes.exists is not None:
+                folder.status['MESSAGES'] = changes.exists
+            if changes.vanished and cache:
+                cache.invalidate(folder.path, changes.vanished)
+            folder.message_list.apply_changes(changes.vanished,
+                changes.changed)
+        return pending
+
+    # IDLE
+
+    def run(self):
+        try:
+            try:
+                self.examine()
+                while not self.stopped:
+                    self.idle()
+            except Exception as error:
+                if not self.stopped:
+                    self.error = error
+        finally:
+            try:
+                self.imap.logout()
+            except Exception:
+                pass
+
+    def stop(self):
+        '''Stops the listener, the connection is logged out.
+        '''
+        self.stopped = True
+        self.done()
+
+    def examine(self):
+        '''Opens the mailbox on read only mode, and gets the UIDs of the
+        messages.
+        '''
+        command(self.imap, 'EXAMINE %s' % quote(self.folder.path))
+        response = command(self.imap, 'UID SEARCH ALL')
+        self.uid_list = []
+        for tokens in response.responses('SEARCH'):
+            self.uid_list.extend(tokens)
+
+    def done(self):
+        '''Ends the running IDLE command, it can be called from any thread.
+        '''
+        with self.lock:
+            if self.idle_tag and not self.done_sent:
+                self.done_sent = True
+                send_line(self.imap, 'DONE')
+
+    def idle(self):
+        '''Runs one IDLE command. It ends on the timeout, when the listener
+        is stopped, or when new messages arrive, the UIDs of the new
+        messages can only be fetched after the IDLE command.
+        '''
+        tag = send_command(self.imap, 'IDLE')
+        line = read_line(self.imap)
+        if not line.startswith('+'):
+            raise ExtensionError(line.strip())
+
+        with self.lock:
+            self.idle_tag = tag
+            self.done_sent = False
+        if self.stopped:
+            self.done()
+        timer = threading.Timer(self.timeout, self.done)
+        timer.daemon = True
+        timer.start()
+
+        new_messages = False
+        try:
+            while True:
+                line = read_line(self.imap)
+                if line.startswith('%s ' % tag):
+                    break
+                if self.untagged(parse_response(line)):
+                    new_messages = True
+                    self.done()
+        finally:
+            timer.cancel()
+            with self.lock:
+                self.idle_tag = None
+
+        if new_messages and not self.stopped:
+            self.fetch_new()
+
+    def untagged(self, tokens):
+        '''Processes an untagged response received during IDLE.
+
+        @return: True if there are new messages.
+        '''
+        if len(tokens) < 3:
+            return False
+        name = str(tokens[2]).upper()
+
+        if str(tokens[1]).upper() == 'VANISHED':
+            # QRESYNC is enabled, the expunged messages are given by UID
+            vanished = []
+            for token in tokens[2:]:
+                if not isinstance(token, list):
+                    vanished.extend(parse_sequence_set(token))
+            gone = set(vanished)
+            self.uid_list = [ uid for uid in self.uid_list
+                              if uid not in gone ]
+            self.publish(Changes(vanished=vanished,
+                exists=len(self.uid_list)))
+        elif name == 'EXISTS':
+            return tokens[1] > len(self.uid_list)
+        elif name == 'EXPUNGE':
+            try:
+                uid = self.uid_list.pop(tokens[1] - 1)
+            except IndexError:
+                return False
+            self.publish(Changes(vanished=[uid],
+                exists=len(self.uid_list)))
+        elif name == 'FETCH' and len(tokens) > 3:
+            msg_info = pairs(tokens[3])
+            uid = msg_info.get('UID')
+            if uid is None:
+                try:
+                    uid = self.uid_list[tokens[1] - 1]
+                except IndexError:
+                    return False
+            if 'FLAGS' in msg_info:
+                self.publish(Changes(changed={ uid: msg_info['FLAGS'] }))
+        return False
+
+    def fetch_new(self):
+        '''Fetches the UIDs and flags of the new messages.
+        '''
+        last = self.uid_list and self.uid_list[-1] or 0
+        response = read_response(self.imap, send_command(self.imap,
+            'UID FETCH %d:* (FLAGS)' % (last + 1))).check()
+        changed = {}
+        for msg_info in response.fetch_responses():
+            uid = msg_info.get('UID')
+            # n:* always matches the last message
+            if uid and uid > last:
+                changed[uid] = msg_info.get('FLAGS') or []
+        if changed:
+            self.uid_list.extend(sorted(changed))
+            self.publish(Changes(changed=changed,
+                exists=len(self.uid_list)))
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of hlimap.
+##
+## hlimap is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## hlimap is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+
+'''High Level IMAP Lib - bulk import
+
+This module is part of the hlimap lib.
+
+Notes
+=====
+
+L{import_messages} appends a stream of messages to a mailbox. The messages
+are read one at a time from:
+
+    * an mbox file, see L{mbox_messages};
+    * a Maildir, see L{maildir_messages};
+    * any iterable, of messages or of (message, flag list, date) tuples.
+      The date can be an IMAP date-time string, a timestamp, a datetime or
+      a time tuple (UTC). The messages can be octets or text, encoded in
+      UTF-8 before being sent.
+
+The messages are sent with CRLF line endings, and the literal sizes count
+octets.
+
+If the server has the MULTIAPPEND extension (RFC 3502) the messages are sent
+in batches, one APPEND command per batch. If it has LITERAL+ (RFC 7888) the
+APPEND commands are pipelined. Only a batch of messages is kept in memory.
+
+The flags and the date of the messages are kept. If the server has the
+UIDPLUS extension (RFC 4315) the UIDs of the new messages are returned::
+
+    >>> folder = M['INBOX']
+    >>> folder.import_messages('/home/user/mbox')
+    [(1201529427, 1), (1201529427, 2), ...]
+'''
+
+# Imports
+import os
+import re
+import time
+import datetime
+
+from .imapext import send_append, read_response, parse_sequence_set, \
+    PIPELINE_WINDOW, ExtensionError
+from .utils import MONTHS
+
+# Constants:
+
+# Maximum number of messages and of octets on a MULTIAPPEND command, a batch
+# has at least one message
+IMPORT_BATCH = 100
+IMPORT_BATCH_BYTES = 4 * 1024 * 1024
+
+# mbox Status and X-Status headers
+MBOX_FLAGS = { b'R': r'\Seen', b'A': r'\Answered', b'F': r'\Flagged',
+    b'T': r'\Draft', b'D': r'\Deleted' }
+
+# Maildir info letters
+MAILDIR_FLAGS = { 'S': r'\Seen', 'R': r'\Answered', 'F': r'\Flagged',
+    'D': r'\Draft', 'T': r'\Deleted' }
+
+_NEWLINE = re.compile(br'\r?\n')
+_FROM_QUOTED = re.compile(br'^>+From ')
+
+# Dates
+
+def imap_date(date):
+    '''Converts a date to the IMAP date-time format, for instance
+    '17-Jul-1996 02:44:25 +0000'.
+
+    @param date: IMAP date-time string (returned as is), timestamp,
+        datetime or time tuple. The naive datetimes and the time tuples
+        are UTC.
+    '''
+    if date is None or isinstance(date, str):
+        return date
+    offset = 0
+    if isinstance(date, datetime.datetime):
+        if date.utcoffset() is not None:
+            offset = (date.utcoffset().days * 86400 +
+                date.utcoffset().seconds) // 60
+        date = date.timetuple()
+    elif isinstance(date, (int, float)):
+        date = time.gmtime(date)
+    sign = offset < 0 and '-' or '+'
+    return '%02d-%s-%04d %02d:%02d:%02d %s%02d%02d' % (date[2],
+        MONTHS[date[1] - 1], date[0], date[3], date[4], date[5], sign,
+        abs(offset) // 60, abs(offset) % 60)
+
+def crlf(message):
+    '''IMAP messages use CRLF line endings.
+    '''
+    return _NEWLINE.sub(b'\r\n', message)
+
+def message_octets(message):
+    '''Returns a message as octets with CRLF line endings, the text messages
+    are encoded in UTF-8.
+    '''
+    if not isinstance(message, bytes):
+        message = message.encode('utf-8')
+    return crlf(message)
+
+# Message sources
+
+def mbox_messages(path):
+    '''Reads the messages of an mbox file one at a time.
+
+    The flags are taken from the Status and X-Status headers and the date
+    from the From_ line. The '>From ' lines are unquoted (mboxrd).
+
+    @return: iterator of (message, flag list, date) tuples.
+    '''
+    def message(from_line, lines):
+        # The empty line before the next From_ line is a separator
+        if lines and not lines[-1].strip():
+            lines.pop()
+        flags = []
+        for line in lines:
+            if not line.strip():
+                break
+            name = line.split(b':', 1)[0].lower()
+            if name in (b'status', b'x-status'):
+                value = line.split(b':', 1)[1]
+                flags.extend([ flag for letter, flag in MBOX_FLAGS.items()
+                               if letter in value and flag not in flags ])
+        return (crlf(b''.join(lines)), flags, mbox_date(from_line))
+
+    mbox = open(path, 'rb')
+    try:
+        from_line = None
+        lines = []
+        for line in mbox:
+            if line.startswith(b'From '):
+                if from_line is not None:
+                    yield message(from_line, lines)
+                from_line = line
+                lines = []
+            elif from_line is not None:
+                if _FROM_QUOTED.match(line):
+                    line = line[1:]
+                lines.append(line)
+        if from_line is not None:
+            yield message(from_line, lines)
+    finally:
+        mbox.close()
+
+def mbox_date(from_line):
+    '''Date of the From_ line, 'From user@host Sat Jan  3 01:05:34 1996'.
+    '''
+    try:
+        words = from_line.decode('latin-1').split()
+        date = time.strptime(' '.join(words[-4:]), '%b %d %H:%M:%S %Y')
+    except (ValueError, IndexError):
+        return None
+    return imap_date(date)
+
+def maildir_messages(path):
+    '''Reads the messages of a Maildir one at a time, the messages on cur
+    first, each sub directory on the order of the file names.
+
+    The flags are taken from the info part of the file names, the date is
+    the modification time of the files.
+
+    @return: iterator of (message, flag list, date) tuples.
+    '''
+    for sub_dir in ('cur', 'new'):
+        directory = os.path.join(path, sub_dir)
+        if not os.path.isdir(directory):
+            continue
+        for name in sorted(os.listdir(directory)):
+            if name.startswith('.'):
+                continue
+            file_name = os.path.join(directory, name)
+            flags = []
+            for separator in (':2,', '!2,'):
+                if separator in name:
+                    flags = [ MAILDIR_FLAGS[letter] for letter in
+                              sorted(name.split(separator, 1)[1])
+                              if letter in MAILDIR_FLAGS ]
+                    break
+            message_file = open(file_name, 'rb')
+            try:
+                message = message_file.read()
+            finally:
+                message_file.close()
+            yield (crlf(message), flags,
+                imap_date(os.path.getmtime(file_name)))
+
+def message_source(source):
+    '''Returns an iterator of (message, flag list, date) tuples.
+
+    @param source: path of an mbox file or of a Maildir, or an iterable of
+        messages or of (message, flag list, date) tuples
+    '''
+    if isinstance(source, str):
+        if os.path.isdir(source):
+            return maildir_messages(source)
+        return mbox_messages(source)
+    return source_tuples(source)
+
+def source_tuples(source):
+    for item in source:
+        if isinstance(item, tuple):
+            message, flags, date = (item + ((), None))[:3]
+        else:
+            message, flags, date = item, (), None
+        # \Recent can't be set by the clients
+        flags = [ flag for flag in flags if flag.lower() != r'\recent' ]
+        yield (message_octets(message), flags, imap_date(date))
+
+def batches(messages, batch_size=IMPORT_BATCH,
+    batch_bytes=IMPORT_BATCH_BYTES):
+    '''Groups the messages on lists with at most batch_size messages and
+    batch_bytes octets, unless a single message is larger.
+    '''
+    batch = []
+    size = 0
+    for item in messages:
+        if batch and (len(batch) >= batch_size or
+                      size + len(item[0]) > batch_bytes):
+            yield batch
+            batch = []
+            size = 0
+        batch.append(item)
+        size += len(item[0])
+    if batch:
+        yield batch
+
+# Import
+
+def import_messages(imap, mailbox, source, batch_size=IMPORT_BATCH,
+    batch_bytes=IMPORT_BATCH_BYTES, progress=None):
+    '''Appends messages to a mailbox.
+
+    @param imap: IMAP4P instance
+    @param source: see L{message_source}
+    @param batch_size: maximum number of messages on a MULTIAPPEND command
+    @param batch_bytes: maximum size of a MULTIAPPEND command
+    @param progress: callable, called as progress(messages, octets) with the
+        totals appended so far, each time the server confirms a command
+
+    @return: list of (UIDVALIDITY, UID) tuples, on the order of the
+        messages, with (None, None) if the server doesn't return the UIDs.
+        If the server refuses a command, the commands already sent are
+        completed and an L{ExtensionError} is raised. The commands already
+        sent are completed too if sending a command, or reading the
+        source, fails.
+    '''
+    if not imap.has_capability('MULTIAPPEND'):
+        batch_size = 1
+    literal_plus = imap.has_capability('LITERAL+')
+    window = literal_plus and PIPELINE_WINDOW or 1
+
+    uid_list = []
+    pending = []
+    totals = [0, 0]
+    errors = []
+
+    def collect():
+        tag, count, size = pending.pop(0)
+        response = read_response(imap, tag)
+        if not response.ok():
+            errors.append(response.text)
+            return
+        code = response.response_code('APPENDUID')
+        uids = []
+        if code and len(code) == 2:
+            uids = parse_sequence_set(code[1])
+        if len(uids) == count:
+            uid_list.extend([ (code[0], uid) for uid in uids ])
+        else:
+            uid_list.extend([ (None, None) ] * count)
+        totals[0] += count
+        totals[1] += size
+        if progress:
+            progress(totals[0], totals[1])
+
+    try:
+        for batch in batches(message_source(source), batch_size,
+            batch_bytes):
+            if len(pending) >= window:
+                collect()
+            if errors:
+                break
+            tag = send_append(imap, mailbox, batch, literal_plus)
+            pending.append((tag, len(batch),
+                sum([ len(item[0]) for item in batch ])))
+    finally:
+        # Don't leave responses behind on the connection
+        while pending:
+            collect()
+
+    if errors:
+        raise ExtensionError(errors[0])
+    return uid_list
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of hlimap.
+##
+## hlimap is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## hlimap is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+
+'''High Level IMAP Lib - message index
+
+This module is part of the hlimap lib.
+
+Notes
+=====
+
+The message list of a folder can have hundreds of thousands of messages.
+Instead of a dict per message, L{MessageIndex} keeps the list on arrays,
+one entry per message on the order of the list:
+
+    * uids - the message UIDs;
+    * parent, first_child, next_sibling - positions on the arrays, -1 means
+      none. Only for threaded lists;
+    * level - depth on the thread. Only for threaded lists.
+
+The UIDs are found through two more arrays, the UIDs sorted and their
+positions, using a binary search. The Message instances are only kept for
+the messages already fetched.
+
+For compatibility the message_dict of a MessageList is a L{MessageDict},
+a read only mapping that gives for each UID a dict like L{MessageEntry}
+with the 'children', 'parent', 'level' and 'data' keys.
+'''
+
+# Imports
+from array import array
+from bisect import bisect_left
+
+# Constants:
+
+NONE = -1
+
+# Index
+
+class MessageIndex(object):
+    '''Compact message list.
+    '''
+
+    def __init__(self, message_list, threaded=False):
+        '''
+        @param message_list: flat list of UIDs or, if threaded, nested list
+            on the form returned by thread_smart.
+        @param threaded: is the list threaded?
+        '''
+        self.threaded = threaded
+        self.uids = array('I')
+        # Messages fetched: { UID: Message, ... }
+        self.data = {}
+        # Messages loaded before being shown
+        self.prefetched = set()
+
+        if threaded:
+            self.build_tree(message_list)
+        else:
+            self.uids.extend(message_list)
+        self.build_map()
+
+    def build_tree(self, nested_list):
+        '''Builds the tree from a nested list. On each list the messages
+        are a chain, each message is the parent of the next one, and the
+        sub lists are branches from the last message before them.
+        '''
+        # The arrays are built from lists, it's faster
+        uids = []
+        parents = []
+        levels = []
+        first_child = []
+        next_sibling = []
+        last_child = []
+        roots = []
+
+        seen = set()
+        stack = [ (iter(nested_list), 0, NONE) ]
+        while stack:
+            items, level, parent = stack.pop()
+            for item in items:
+                if isinstance(item, (list, tuple)):
+                    # Continue here after the branch
+                    stack.append((items, level, parent))
+                    stack.append((iter(item), level, parent))
+                    break
+                if item in seen:
+                    continue
+                seen.add(item)
+
+                position = len(uids)
+                uids.append(item)
+                parents.append(parent)
+                levels.append(level)
+                first_child.append(NONE)
+                next_sibling.append(NONE)
+                last_child.append(NONE)
+                if parent == NONE:
+                    roots.append(position)
+                else:
+                    last = last_child[parent]
+                    if last == NONE:
+                        first_child[parent] = position
+                    else:
+                        next_sibling[last] = position
+                    last_child[parent] = position
+
+                parent = position
+                level += 1
+
+        self.uids = array('I', uids)
+        self.parent = array('i', parents)
+        self.level = array('i', levels)
+        self.first_child = array('i', first_child)
+        self.next_sibling = array('i', next_sibling)
+        self.roots = array('i', roots)
+
+    def build_map(self):
+        '''Builds the UID to position map.
+        '''
+        uids = self.uids
+        order = sorted(range(len(uids)), key=uids.__getitem__)
+        self.sorted_uids = array('I', [ uids[position]
+                                        for position in order ])
+        self.sorted_positions = array('i', order)
+
+    # Flat list changes
+
+    def extend(self, uid_list):
+        '''Adds messages to the end of a flat list.
+        '''
+        self.uids.extend(uid_list)
+        self.build_map()
+
+    def insert(self, positions):
+        '''Inserts messages on a flat list.
+
+        @param positions: list of (position, UID) tuples, sorted, the
+            positions are the ones before the insertion.
+        '''
+        uids = []
+        previous = 0
+        for position, uid in positions:
+            uids.extend(self.uids[previous:position])
+            uids.append(uid)
+            previous = position
+        uids.extend(self.uids[previous:])
+        self.uids = array('I', uids)
+        self.build_map()
+
+    def remove(self, uid_list):
+        '''Removes messages from a flat list.
+        '''
+        gone = set(uid_list)
+        self.uids = array('I', [ uid for uid in self.uids
+                                 if uid not in gone ])
+        for uid in gone:
+            self.data.pop(uid, None)
+            self.prefetched.discard(uid)
+        self.build_map()
+
+    # Queries
+
+    def position(self, uid):
+        '''Returns the position of a message on the list, or -1.
+        '''
+        index = bisect_left(self.sorted_uids, uid)
+        if index < len(self.sorted_uids) and self.sorted_uids[index] == uid:
+            return self.sorted_positions[index]
+        return NONE
+
+    def children(self, position):
+        '''Returns the UIDs of the children of a message.
+        '''
+        children = []
+        if self.threaded:
+            child = self.first_child[position]
+            while child != NONE:
+                children.append(self.uids[child])
+                child = self.next_sibling[child]
+        return children
+
+    def root_list(self):
+        if self.threaded:
+            return [ self.uids[position] for position in self.roots ]
+        return self.uids
+
+    def __len__(self):
+        return len(self.uids)
+
+# Compatibility with the dict of dicts
+
+class MessageEntry(object):
+    '''Information about a message on the list, used as a dict with the
+    keys 'children', 'parent', 'level' and 'data'. Only 'data' (and
+    'prefetched') can be changed.
+    '''
+    __slots__ = ('index', 'uid', 'pos')
+
+    def __init__(self, index, uid, position):
+        self.index = index
+        self.uid = uid
+        self.pos = position
+
+    def __getitem__(self, key):
+        index = self.index
+        if key == 'data':
+            return index.data[self.uid]
+        elif key == 'prefetched':
+            return self.uid in index.prefetched
+        elif key == 'children':
+            return index.children(self.pos)
+        elif key == 'parent':
+            if not index.threaded or index.parent[self.pos] == NONE:
+                return None
+            return index.uids[index.parent[self.pos]]
+        elif key == 'level':
+            if not index.threaded:
+                return 0
+            return index.level[self.pos]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key == 'data':
+            self.index.data[self.uid] = value
+        elif key == 'prefetched':
+            if value:
+                self.index.prefetched.add(self.uid)
+            else:
+                self.index.prefetched.discard(self.uid)
+        else:
+            raise KeyError('%s can not be changed' % key)
+
+    def __contains__(self, key):
+        if key == 'data':
+            return self.uid in self.index.data
+        elif key == 'prefetched':
+            return self.uid in self.index.prefetched
+        return key in ('children', 'parent', 'level')
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, default=None):
+        value = self.get(key, default)
+        if key == 'data':
+            self.index.data.pop(self.uid, None)
+        elif key == 'prefetched':
+            self.index.prefetched.discard(self.uid)
+        return value
+
+class MessageDict(object):
+    '''Read only mapping { UID: L{MessageEntry}, ... } over a
+    L{MessageIndex}.
+    '''
+
+    def __init__(self, index):
+        self.index = index
+
+    def __getitem__(self, uid):
+        position = self.index.position(uid)
+        if position == NONE:
+            raise KeyError(uid)
+        return MessageEntry(self.index, uid, position)
+
+    def get(self, uid, default=None):
+        try:
+            return self[uid]
+        except KeyError:
+            return default
+
+    def __contains__(self, uid):
+        return self.index.position(uid) != NONE
+
+    has_key = __contains__
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        return iter(self.index.uids)
+
+    def keys(self):
+        return list(self.index.uids)
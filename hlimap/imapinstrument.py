@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of hlimap.
+##
+## hlimap is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## hlimap is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+
+'''High Level IMAP Lib - instrumentation
+
+This module is part of the hlimap lib.
+
+Notes
+=====
+
+The observers registered with
+L{ImapServer.add_observer<imapserver.ImapServer.add_observer>} are called
+after each command sent on the server connections, with a L{CommandEvent}.
+An observer is any callable, L{MetricsSink} keeps totals for each command::
+
+    >>> metrics = MetricsSink()
+    >>> M.add_observer(metrics)
+    >>> M.login('user', 'password')
+    >>> for message in M['INBOX']:
+    ...     pass
+    >>> metrics.summary()['FETCH']
+    {'count': 1, 'errors': 0, 'items': 50, 'bytes_in': 31337, ...}
+
+Each call to an IMAP4P method (login, select, status, fetch_smart,
+sort_smart, ...) is one command. The commands sent by
+L{imapext<imapext>} (the pipelined STATUS, ESEARCH, MOVE, ...) are reported
+by their name, from the moment they are sent until their responses are
+read.
+
+The bytes are counted on the low level connection (IMAP4P._imap): the
+command lines and literals sent, and the response lines read.
+
+The connections are only wrapped while there are observers registered, so
+there's no overhead otherwise.
+'''
+
+# Imports
+import sys
+import time
+import weakref
+import threading
+
+# Utils
+
+# Item counters, they get the arguments and the result of a call
+def requested(args, result):
+    '''Number of messages on the first argument.'''
+    if args and hasattr(args[0], '__len__') and not isinstance(args[0],
+        str):
+        return len(args[0])
+    return 1
+
+def returned(args, result):
+    '''Number of results.'''
+    if hasattr(result, '__len__') and not isinstance(result, str):
+        return len(result)
+    return 0
+
+def one(args, result):
+    return 1
+
+def exists(args, result):
+    try:
+        return int(result['EXISTS'])
+    except (KeyError, TypeError, ValueError):
+        return 0
+
+def none(args, result):
+    return 0
+
+# Constants:
+
+# IMAP4P methods timed: { method: (command name, item counter), ... }
+METHODS = {
+    'login': ('LOGIN', none),
+    'logout': ('LOGOUT', none),
+    'select': ('SELECT', exists),
+    'examine': ('EXAMINE', exists),
+    'unselect': ('UNSELECT', none),
+    'close': ('CLOSE', none),
+    'status': ('STATUS', one),
+    'list': ('LIST', returned),
+    'lsub': ('LSUB', returned),
+    'fetch_smart': ('FETCH', requested),
+    'store_smart': ('STORE', requested),
+    'search_smart': ('SEARCH', returned),
+    'sort_smart': ('SORT', returned),
+    'thread_smart': ('THREAD', returned),
+    'append': ('APPEND', one),
+    'expunge': ('EXPUNGE', none),
+    }
+
+class CommandEvent(object):
+    '''A command sent to the server.
+
+    @ivar command: command name, upper case: SELECT, FETCH, UID SORT, ...
+    @ivar folder: mailbox selected or named on the command, or None
+    @ivar items: messages requested (FETCH, STORE), results returned
+        (SEARCH, SORT, THREAD, LIST) or messages on the mailbox (SELECT)
+    @ivar bytes_in: bytes read from the server
+    @ivar bytes_out: bytes sent to the server
+    @ivar elapsed: wall time, in seconds
+    @ivar error: the exception raised, or None
+    '''
+    __slots__ = ( 'command', 'folder', 'items', 'bytes_in', 'bytes_out',
+                  'elapsed', 'error' )
+
+    def __init__(self, command, folder, items, bytes_in, bytes_out, elapsed,
+        error=None):
+        self.command = command
+        self.folder = folder
+        self.items = items
+        self.bytes_in = bytes_in
+        self.bytes_out = bytes_out
+        self.elapsed = elapsed
+        self.error = error
+
+    def __repr__(self):
+        return '<CommandEvent %s %s %d items %d/%d bytes %.3fs>' % (
+            self.command, self.folder, self.items, self.bytes_in,
+            self.bytes_out, self.elapsed)
+
+class MetricsSink(object):
+    '''Observer that keeps totals for each command name.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def __call__(self, event):
+        with self.lock:
+            metrics = self.metrics.get(event.command)
+            if metrics is None:
+                metrics = self.metrics[event.command] = { 'count': 0,
+                    'errors': 0, 'items': 0, 'bytes_in': 0, 'bytes_out': 0,
+                    'elapsed': 0.0, 'max_elapsed': 0.0 }
+            metrics['count'] += 1
+            if event.error is not None:
+                metrics['errors'] += 1
+            metrics['items'] += event.items
+            metrics['bytes_in'] += event.bytes_in
+            metrics['bytes_out'] += event.bytes_out
+            metrics['elapsed'] += event.elapsed
+            metrics['max_elapsed'] = max(metrics['max_elapsed'],
+                event.elapsed)
+
+    def summary(self):
+        '''Returns a copy of the totals.
+
+        @return: dict in the form { command name: { 'count': n, 'errors': n,
+            'items': n, 'bytes_in': n, 'bytes_out': n, 'elapsed': seconds,
+            'max_elapsed': seconds }, ... }
+        '''
+        with self.lock:
+            return dict([ (command, dict(metrics))
+                          for command, metrics in self.metrics.items() ])
+
+    def reset(self):
+        with self.lock:
+            self.metrics.clear()
+
+class RawConnection(object):
+    '''Wraps the low level connection (IMAP4P._imap) to count the bytes,
+    and to time the commands sent directly with send_command.
+    '''
+
+    def __init__(self, connection, proxy):
+        self.connection = connection
+        self.proxy = proxy
+        self.local = threading.local()
+        # { tag: (command name, start time, bytes sent), ... }
+        self.pending = {}
+
+    def counters(self):
+        local = self.local
+        if not hasattr(local, 'bytes_in'):
+            local.bytes_in = 0
+            local.bytes_out = 0
+            # IMAP4P method calls in progress on this thread
+            local.depth = 0
+        return local
+
+    def send_command(self, command, *args, **kwargs):
+        local = self.counters()
+        start = time.time()
+        local.bytes_out += len(command) + 2
+        result = self.connection.send_command(command, *args, **kwargs)
+        if kwargs.get('read_resp', True) is False:
+            if not local.depth:
+                # Completed by read_responses
+                self.pending[result] = (command_name(command), start,
+                    len(command) + 2)
+        elif isinstance(result, list):
+            local.bytes_in += lines_size(result)
+        return result
+
+    def read_responses(self, tag, *args, **kwargs):
+        local = self.counters()
+        lines = self.connection.read_responses(tag, *args, **kwargs)
+        size = lines_size(lines)
+        local.bytes_in += size
+        command = self.pending.pop(tag, None)
+        if command is not None:
+            name, sent, bytes_out = command
+            self.proxy.instrumentation.notify(CommandEvent(name,
+                self.proxy.selected, untagged(lines), size, bytes_out,
+                time.time() - sent))
+        return lines
+
+    def send(self, data, *args, **kwargs):
+        self.counters().bytes_out += len(data)
+        return self.connection.send(data, *args, **kwargs)
+
+    def readline(self, *args, **kwargs):
+        line = self.connection.readline(*args, **kwargs)
+        self.counters().bytes_in += len(line)
+        return line
+
+    def read(self, *args, **kwargs):
+        data = self.connection.read(*args, **kwargs)
+        self.counters().bytes_in += len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+def command_name(command):
+    words = command.split(' ', 2)
+    if words[0].upper() == 'UID' and len(words) > 1:
+        return 'UID %s' % words[1].upper()
+    return words[0].upper()
+
+def lines_size(lines):
+    if not isinstance(lines, list):
+        return 0
+    return sum([ len(line) + 2 for line in lines
+                 if hasattr(line, '__len__') ])
+
+def untagged(lines):
+    return len([ line for line in lines if line[:1] == '*' ])
+
+class InstrumentedIMAP4P(object):
+    '''Wraps an IMAP4P instance, the calls to the methods in L{METHODS} are
+    reported to the observers. The other attributes are the ones of the
+    wrapped instance.
+    '''
+
+    def __init__(self, imap, instrumentation):
+        self.imap = imap
+        self.instrumentation = instrumentation
+        # Mailbox selected on this connection
+        self.selected = None
+        self.raw = RawConnection(imap._imap, self)
+        # Replaced on the wrapped instance too, to count the bytes of
+        # the commands sent by imaplibii
+        imap._imap = self.raw
+
+    def _get_raw(self):
+        return self.raw
+    _imap = property(_get_raw)
+
+    def call(self, method, args, kwargs):
+        command, counter = METHODS[method]
+        local = self.raw.counters()
+        bytes_in = local.bytes_in
+        bytes_out = local.bytes_out
+        local.depth += 1
+        start = time.time()
+        result = None
+        error = None
+        try:
+            result = getattr(self.imap, method)(*args, **kwargs)
+            return result
+        except Exception:
+            error = sys.exc_info()[1]
+            raise
+        finally:
+            elapsed = time.time() - start
+            local.depth -= 1
+            folder = self.selected
+            if method in ('select', 'examine', 'status', 'append') and args:
+                folder = args[0]
+                if method in ('select', 'examine'):
+                    self.selected = error is None and folder or None
+            elif method in ('unselect', 'close'):
+                self.selected = None
+            items = 0
+            if error is None:
+                items = counter(args, result)
+            self.instrumentation.notify(CommandEvent(command, folder, items,
+                local.bytes_in - bytes_in, local.bytes_out - bytes_out,
+                elapsed, error))
+
+    def unwrap(self):
+        '''Restores the low level connection of the wrapped instance.
+        '''
+        if self.imap._imap is self.raw:
+            self.imap._imap = self.raw.connection
+        return self.imap
+
+    def __getattr__(self, name):
+        return getattr(self.imap, name)
+
+def instrumented(method):
+    def call(self, *args, **kwargs):
+        return self.call(method, args, kwargs)
+    call.__name__ = method
+    return call
+
+for method in METHODS:
+    setattr(InstrumentedIMAP4P, method, instrumented(method))
+
+class Instrumentation(object):
+    '''The observers of a server, and the connections wrapped.
+    '''
+
+    def __init__(self):
+        self.observers = []
+        self.lock = threading.Lock()
+        # { IMAP4P: InstrumentedIMAP4P, ... }
+        self.wrapped = weakref.WeakKeyDictionary()
+
+    def add(self, observer):
+        with self.lock:
+            if observer not in self.observers:
+                self.observers = self.observers + [ observer ]
+
+    def remove(self, observer):
+        with self.lock:
+            self.observers = [ item for item in self.observers
+                               if item != observer ]
+
+    def notify(self, event):
+        for observer in self.observers:
+            try:
+                observer(event)
+            except Exception:
+                # The observers can't break the IMAP operations
+                pass
+
+    def wrap(self, imap):
+        '''Returns the instrumented version of a connection, the same
+        one each time.
+        '''
+        if isinstance(imap, InstrumentedIMAP4P):
+            return imap
+        with self.lock:
+            proxy = self.wrapped.get(imap)
+            if proxy is None:
+                proxy = self.wrapped[imap] = InstrumentedIMAP4P(imap, self)
+            return proxy
+
+    def unwrap(self, imap):
+        '''Returns the original connection, and restores all the wrapped
+        connections.
+        '''
+        with self.lock:
+            for proxy in list(self.wrapped.values()):
+                proxy.unwrap()
+            self.wrapped.clear()
+        if isinstance(imap, InstrumentedIMAP4P):
+            return imap.imap
+        return imap
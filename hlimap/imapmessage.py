@@ -24,7 +24,7 @@
 # $Id: imapmessage.py 20 2010-01-15 20:44:48Z hguerreiro $
 #
 
-'''High Level IMAP Lib - message handling
+r'''High Level IMAP Lib - message handling
 
 This module is part of the hlimap lib.
 
@@ -105,7 +105,18 @@ Please note the THREAD command response is in the form:
 '''
 
 # Imports
-import quopri, base64
+import quopri, base64, binascii
+import re
+import threading
+
+from .imapsort import SORT_KEYS, SortProgError, sort_messages, \
+    decode_header_text, insert_positions
+from .imapthread import thread_messages, sort_threads
+from .imapindex import MessageIndex, MessageDict
+from .imapext import send_command, read_response, extended_search, \
+    literal_segments, search_command
+from .utils import split_message_list, sequence_set, sequence_sets, \
+    MAX_SET_LENGTH, address_fields
 
 # Utils
 
@@ -133,17 +144,94 @@ def threaded_tree( nested_list, base_level = 0, parent = None ):
             level += 1
             parent = item
 
+def envelope_field(envelope, name):
+    '''Returns a field of an envelope. The envelope can be an imaplibii
+    envelope (the fields are the env_* attributes) or a parsed list, as
+    returned by the asyncio API.
+    '''
+    if isinstance(envelope, (list, tuple)):
+        return envelope[ENVELOPE_FIELDS.index(name)]
+    return getattr(envelope, 'env_%s' % name, None)
+
+def flag_property(flag):
+    bit = FLAG_BITS[flag]
+    def get_flag(self):
+        return bool(self.flag_bits & bit)
+    def set_flag(self, value):
+        if value:
+            self.flag_bits |= bit
+        else:
+            self.flag_bits &= ~bit
+    return property(get_flag, set_flag, None, 'Is the %s flag set?' % flag)
+
+def octets(data):
+    '''Message data as bytes. The text read from the connection has one
+    character per octet (latin-1).
+    '''
+    if not data:
+        return b''
+    if isinstance(data, bytes):
+        return data
+    try:
+        return data.encode('latin-1')
+    except UnicodeEncodeError:
+        return data.encode('utf-8')
+
+def section_data(response, uid):
+    '''Returns the data of a BODY[section]<offset> fetch response, as
+    bytes.
+    '''
+    for msg_info in response.fetch_responses():
+        if msg_info.get('UID') != uid:
+            continue
+        for key, value in msg_info.items():
+            if isinstance(key, str) and key.upper().startswith('BODY['):
+                return octets(value)
+    return b''
+
+class StreamDecoder(object):
+    '''Decodes a content transfer encoding incrementally, the data can be
+    split anywhere.
+    '''
+
+    def __init__(self, encoding=None):
+        self.encoding = (encoding or '').upper()
+        # Data that can't be decoded before the next chunk
+        self.pending = b''
+
+    def decode(self, data):
+        if self.encoding == 'BASE64':
+            data = self.pending + b''.join(data.split())
+            end = len(data) - len(data) % 4
+            self.pending = data[end:]
+            return base64.b64decode(data[:end])
+        elif self.encoding == 'QUOTED-PRINTABLE':
+            # Decode only full lines, a soft line break can't be split
+            data = self.pending + data
+            end = data.rfind(b'\n') + 1
+            self.pending = data[end:]
+            return quopri.decodestring(data[:end])
+        return data
+
+    def flush(self):
+        data, self.pending = self.pending, b''
+        if not data:
+            return b''
+        if self.encoding == 'BASE64':
+            try:
+                return base64.b64decode(data + b'=' * (-len(data) % 4))
+            except (binascii.Error, TypeError):
+                return b''
+        return quopri.decodestring(data)
+
 # Exceptions:
 
-class SortProgError(Exception): pass
 class PaginatorError(Exception): pass
 class MessageNotFound(Exception): pass
 class NotImplementedYet(Exception): pass
 
 # Constants:
 
-SORT_KEYS = ( 'ARRIVAL', 'CC', 'DATE', 'FROM', 'SIZE', 'SUBJECT', 'TO' )
-
 THREADED = 7
 SORTED   = 3
 UNSORTED = 1
@@ -156,6 +244,22 @@ FLAGGED = r'\Flagged'
 DRAFT = r'\Draft'
 RECENT = r'\Recent'
 
+# Bits used to keep the system flags of a message
+FLAG_BITS = { SEEN: 1, DELETED: 2, ANSWERED: 4, FLAGGED: 8, DRAFT: 16,
+              RECENT: 32 }
+
+# Size of the chunks when streaming message parts
+CHUNK_SIZE = 1024 * 1024
+
+# Maximum number of envelopes fetched at once to complete the search index
+INDEX_FETCH_LIMIT = 1000
+
+_SECTION = re.compile(r'\[(.*)\]')
+
+# Envelope fields, RFC 3501 section 7.4.2
+ENVELOPE_FIELDS = ( 'date', 'subject', 'from', 'sender', 'reply_to', 'to',
+                    'cc', 'bcc', 'in_reply_to', 'message_id' )
+
 class Paginator(object):
     def __init__(self, msg_list):
         self.msg_list = msg_list
@@ -220,6 +324,82 @@ class Paginator(object):
     def is_not_first(self):
         return self.current_page > 1
 
+class Prefetcher(object):
+    '''Loads the messages of the pages around the current one in the
+    background, so that moving to the next or previous page is served from
+    memory.
+
+    The background fetch uses a connection of its own, so the server must
+    be able to use several connections (see
+    L{PooledImapServer<imappool.PooledImapServer>}). Otherwise the pages
+    around are fetched on the same FETCH command as the current page, or
+    alone when the current page is already loaded and a page around was
+    never fetched.
+    '''
+
+    def __init__(self, msg_list, depth=1):
+        '''
+        @param msg_list: MessageList instance
+        @param depth: number of pages to load after and before the current
+            page
+        '''
+        self.msg_list = msg_list
+        self.depth = depth
+        self.thread = None
+        # Incremented when the message list changes, the results of the
+        # fetches started before are discarded
+        self.generation = 0
+
+    def page_ids(self):
+        '''Returns the ids of the messages to load.
+        '''
+        msg_list = self.msg_list
+        paginator = msg_list.paginator
+        if paginator.msg_per_page == -1:
+            return []
+
+        current = paginator.current_page
+        pages = []
+        for distance in range(1, self.depth + 1):
+            for page in (current + distance, current - distance):
+                if 1 <= page <= paginator.max_page and page not in pages:
+                    pages.append(page)
+
+        message_dict = msg_list.message_dict
+        return [ msg_id for page in pages
+                 for msg_id in msg_list.page_list(page)
+                 if not message_dict[msg_id].get('prefetched') ]
+
+    def start(self, message_list):
+        '''Fetches the messages on a background thread.
+        '''
+        self.thread = threading.Thread(target=self.run,
+            args=(message_list, self.generation))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, message_list, generation):
+        msg_list = self.msg_list
+        try:
+            try:
+                response = msg_list.fetch_envelopes(message_list)
+            except Exception:
+                # The messages will be fetched when needed
+                return
+            if generation == self.generation:
+                msg_list.add_messages(response, message_list)
+        finally:
+            msg_list.server.release()
+
+    def wait(self):
+        '''Waits for the background fetch in progress, if any.
+        '''
+        thread = self.thread
+        if thread and thread.is_alive():
+            thread.join()
+
+    def cancel(self):
+        self.generation += 1
 
 class MessageList(object):
     def __init__(self, server, folder, threaded=False):
@@ -228,32 +408,48 @@ class MessageList(object):
         @param folder: Folder instance this message list is associated with
         @param threaded: should we show a threaded message list?
         '''
-        self._imap  = server._imap
         self.server = server
         self.folder = folder
+        self.prefetcher = None
+        imap = server._imap
 
         # Sort capabilities:
         self.search_capability = UNSORTED
 
-        sort   = self._imap.has_capability('SORT')
-        thread = (self._imap.has_capability('THREAD=ORDEREDSUBJECT') or
-                  self._imap.has_capability('THREAD=REFERENCES'))
+        sort   = imap.has_capability('SORT')
+        thread = (imap.has_capability('THREAD=ORDEREDSUBJECT') or
+                  imap.has_capability('THREAD=REFERENCES'))
+        # A server might have THREAD without SORT, so we keep track of the
+        # SORT extension separately
+        self.server_sort = sort
         if thread:
             self.search_capability = THREADED
         elif sort:
             self.search_capability = SORTED
 
         if thread:
-            if self._imap.has_capability('THREAD=REFERENCES'):
+            if imap.has_capability('THREAD=REFERENCES'):
                 self.thread_alg = 'REFERENCES'
             else:
                 self.thread_alg = 'ORDEREDSUBJECT'
+        else:
+            # Client side threading
+            self.thread_alg = 'REFERENCES'
 
         self.set_sort_program('-DATE')
         self.set_search_expression('ALL')
+        self.set_thread_sort(False)
 
         # Message list options
         self.message_list = False
+        self.message_dict = {}
+        self.flat_message_list = []
+        # UIDs of all the messages of the folder, for the local search, in
+        # the form ((MESSAGES, UIDNEXT), UID list)
+        self.mailbox_uids = None
+        # Position of flat_message_list on the whole list, when only a
+        # window of the list is known (see load_window)
+        self.window_start = None
         self.refresh = True # Get the message list and their headers
 
         # Pagination options
@@ -262,6 +458,10 @@ class MessageList(object):
         self._number_messages = None
         self.paginator = Paginator(self)
 
+    def _get_imap(self):
+        return self.folder._imap
+    _imap = property(_get_imap)
+
     # Sort program:
     def sort_string(self):
         sort_program = ''
@@ -299,10 +499,142 @@ class MessageList(object):
         '''
         self.test_sort_program( sort_list )
         self.sort_program = sort_list
+        self.cancel_prefetch()
+
+    def set_thread_sort(self, sort=True, latest=False):
+        '''On the threaded view, sort the threads using the sort program.
+        By default the threads are ordered by date, as returned by the THREAD
+        command.
+
+        @param sort: should the threads be sorted?
+        @param latest: rank each thread by its most recent message, this way
+            we get the most recently active threads first with '-DATE'.
+        '''
+        self.thread_sort = sort
+        self.thread_latest = latest
 
     # Search expression:
     def set_search_expression(self, search_expression ):
+        '''Defines the messages shown.
+
+        @param search_expression: IMAP search keys, or a
+            L{Query<imapquery.Query>}
+        '''
+        self.query = None
+        self.search_charset = None
+        if hasattr(search_expression, 'criteria'):
+            self.query = search_expression
+            self.search_charset = search_expression.charset()
+            search_expression = search_expression.criteria(
+                self.server._imap.has_capability('LITERAL+'))
         self.search_expression = search_expression
+        self.cancel_prefetch()
+
+    def refine(self, query):
+        '''Narrows the current message list with more search keys.
+
+        The new keys are evaluated locally on the messages of the current
+        list, if the data of all of them is loaded (or is on the envelope
+        cache) and the keys don't need anything else. Otherwise the server
+        searches only the messages of the current list. The list keeps its
+        order, except for threaded lists which are rebuilt.
+
+        @param query: L{Query<imapquery.Query>} instance
+        '''
+        if (self.refresh or self._number_messages is None or
+            self.window_start is not None):
+            uid_list = None
+        else:
+            uid_list = list(self.flat_message_list)
+
+        if self.query is not None:
+            self.set_search_expression(self.query & query)
+        elif self.search_expression.upper() == 'ALL':
+            self.set_search_expression(query)
+        else:
+            self.search_expression = '(%s) %s' % (self.search_expression,
+                query.criteria(self.server._imap.has_capability('LITERAL+')))
+            self.search_charset = self.search_charset or query.charset()
+            self.cancel_prefetch()
+
+        if uid_list is None or self.show_style == THREADED:
+            self.reset()
+            return
+
+        matches = query.filter(self.message_data(uid_list))
+        if matches is None and uid_list:
+            search_expression = 'UID %s %s' % (sequence_set(uid_list),
+                query.criteria(self.server._imap.has_capability('LITERAL+')))
+            if len(search_expression) > MAX_SET_LENGTH:
+                self.reset()
+                return
+            matches = self.search_messages(search_expression,
+                query.charset())
+        matches = set(matches or [])
+        self.set_message_list([ msg_id for msg_id in uid_list
+                                if msg_id in matches ])
+
+    def message_data(self, uid_list):
+        '''Returns the data of the messages for the local evaluation of the
+        queries: the data of the messages loaded, and the envelope and size
+        of the messages on the envelope cache.
+
+        @return: list of dicts with the fetch response items
+        '''
+        result = []
+        missing = []
+        for msg_id in uid_list:
+            entry = self.message_dict.get(msg_id)
+            if entry is not None and 'data' in entry:
+                result.append(entry['data'].msg_info())
+            else:
+                missing.append(msg_id)
+        cache = self.server.envelope_cache
+        if missing and cache is not None:
+            cached = cache.get(self.folder.path, self.folder.uid_validity(),
+                missing)
+            for msg_id, (envelope, size) in cached.items():
+                result.append({ 'UID': msg_id, 'ENVELOPE': envelope,
+                                'RFC822.SIZE': size })
+            missing = [ msg_id for msg_id in missing
+                        if msg_id not in cached ]
+        if missing:
+            # Only the UID is known
+            result.extend([ { 'UID': msg_id } for msg_id in missing ])
+        return result
+
+    def search_messages(self, search_expression, charset=None):
+        '''SEARCH command, with the CHARSET argument if needed.
+        '''
+        charset = charset or self.search_charset
+        if charset:
+            search_expression = 'CHARSET %s %s' % (charset,
+                search_expression)
+        if literal_segments(search_expression)[1:]:
+            # Synchronizing literals, imaplibii can't send them
+            return search_command(self._imap, 'UID SEARCH %s' %
+                search_expression)
+        return self._imap.search_smart(search_expression)
+
+    # Prefetch
+    def set_prefetch(self, depth=1):
+        '''Load the messages of the pages around the current one in the
+        background, see L{Prefetcher}.
+
+        @param depth: number of pages to load after and before the current
+            page, 0 disables the prefetch.
+        '''
+        self.cancel_prefetch()
+        if depth:
+            self.prefetcher = Prefetcher(self, depth)
+        else:
+            self.prefetcher = None
+
+    def cancel_prefetch(self):
+        '''The messages being fetched in the background are discarded.
+        '''
+        if self.prefetcher:
+            self.prefetcher.cancel()
 
     # Information retrieval
     def _get_number_messages(self):
@@ -314,20 +646,106 @@ class MessageList(object):
     def have_messages(self):
         return bool(self.number_messages)
 
+    def local_search(self):
+        '''Evaluates the search expression on the server search index, see
+        L{imapsearch<imapsearch>}. The envelopes missing from the index are
+        fetched first, if there are not too many.
+
+        @return: list of UIDs, or None if the search has to be done by the
+            server.
+        '''
+        index = self.server.search_index
+        if index is None or self.search_expression.upper() == 'ALL':
+            return None
+        path = self.folder.path
+        uid_validity = self.folder.uid_validity()
+        uid_list = self.all_uids()
+        missing = index.missing(path, uid_validity, uid_list)
+        if len(missing) > INDEX_FETCH_LIMIT:
+            return None
+        if missing:
+            self.fetch_envelopes(missing)
+        return index.search(path, uid_validity, self.search_expression,
+            uid_list)
+
+    def all_uids(self):
+        '''UIDs of all the messages of the folder. They are searched again
+        only when the number of messages or the UIDNEXT of the folder
+        change, the folder status is updated each time it's selected.
+        '''
+        folder = self.folder
+        state = (folder.messages(), folder.uid_next())
+        if self.mailbox_uids is None or self.mailbox_uids[0] != state:
+            self.mailbox_uids = (state, self._imap.search_smart('ALL'))
+        return self.mailbox_uids[1]
+
+    def update_search_index(self):
+        '''Adds all the messages of the folder to the server search index.
+        '''
+        index = self.server.search_index
+        if index is None:
+            return
+        missing = index.missing(self.folder.path, self.folder.uid_validity(),
+            self.all_uids())
+        for first in range(0, len(missing), INDEX_FETCH_LIMIT):
+            self.fetch_envelopes(missing[first:first + INDEX_FETCH_LIMIT])
+
     def get_message_list(self):
+        '''Gets the message list on the form needed by the show_style. The
+        server extensions are used when available, otherwise the work is
+        done client side.
+        '''
         use = self.search_capability & self.show_style
 
-        if use == THREADED:
-            # We have the THREAD extension:
-            message_list = self._imap.thread_smart(self.thread_alg,
-                'utf-8', self.search_expression)
-        elif use == SORTED:
-            # We have the SORT extension on the server:
-            message_list = self._imap.sort_smart(self.sort_string(),
-                'utf-8', self.search_expression)
+        search_expression = self.search_expression
+        uid_list = self.local_search()
+        if uid_list is not None:
+            if not uid_list:
+                return []
+            search_expression = 'UID %s' % sequence_set(uid_list)
+            if len(search_expression) > MAX_SET_LENGTH:
+                uid_list = None
+                search_expression = self.search_expression
+
+        def search():
+            if uid_list is not None:
+                return uid_list
+            return self.search_messages(search_expression)
+
+        if self.show_style == THREADED:
+            if use == THREADED and literal_segments(search_expression)[1:]:
+                # Synchronizing literals, imaplibii can't send them
+                message_list = search_command(self._imap,
+                    'UID THREAD %s UTF-8 %s' % (self.thread_alg,
+                    search_expression))
+            elif use == THREADED:
+                # We have the THREAD extension:
+                message_list = self._imap.thread_smart(self.thread_alg,
+                    'utf-8', search_expression)
+            else:
+                # Thread client side:
+                message_list = thread_messages(self._imap, search(),
+                    self.thread_alg)
+            if self.thread_sort:
+                # The threads are ordered by date, we sort them client side
+                message_list = sort_threads(self._imap, message_list,
+                    self.sort_program, self.thread_latest)
+        elif self.show_style == SORTED:
+            if self.server_sort and literal_segments(search_expression)[1:]:
+                message_list = search_command(self._imap,
+                    'UID SORT %s UTF-8 %s' % (self.sort_string(),
+                    search_expression))
+            elif self.server_sort:
+                # We have the SORT extension on the server:
+                message_list = self._imap.sort_smart(self.sort_string(),
+                    'utf-8', search_expression)
+            else:
+                # Sort client side:
+                message_list = sort_messages(self._imap, search(),
+                    self.sort_program)
         else:
             # Just get the list.
-            message_list = self._imap.search_smart(self.search_expression)
+            message_list = search()
 
         return message_list
 
@@ -338,80 +756,340 @@ class MessageList(object):
         #self.search_capability = UNSORTED
         #self.show_style = SORTED
 
-        # Obtain the message list
-        message_list = self.get_message_list()
+        # Obtain the message list, get_message_list does by hand whatever
+        # the server is unable to do.
+        #
+        # PROBLEM: the THREAD command only sorts by date which is not
+        # the best choice IMO, I may want a threaded list and have it
+        # sorted by subject. So we have to do all the sorting client side
+        # even if we have the SORT extension when the user wants a threaded
+        # view. arrrgghhh! Even on this case it's good to have the threading
+        # extension, since we can get the threaded list, and only do the
+        # sorting client side (see set_thread_sort)...
+        if self.use_partial():
+            self.load_window(self.paginator.current_page)
+        else:
+            self.set_message_list(self.get_message_list())
 
-        use = self.search_capability & self.show_style
-        if use != self.show_style:
-            # We have to do some stuff by hand
-            #
-
-            # If we have to sort or thread on the client side, then
-            # we have to get the envelope info from all the messages.
-            #
-            # PROBLEM: the THREAD command only sorts by date which is not
-            # the best choice IMO, I may want a threaded list and have it
-            # sorted by subject. So we have to do all the sorting client side
-            # even if we have the SORT extension when the user wants a threaded
-            # view. arrrgghhh! Even on this case it's good to have the threading
-            # extension, since we can get the threaded list, and only do the
-            # sorting client side...
-
-            raise NotImplementedYet('Capability to be implemented')
+    def use_partial(self):
+        '''Can the server return just the pages shown? It needs ESEARCH with
+        PARTIAL (RFC 5267 CONTEXT=SEARCH, or the PARTIAL extension) for the
+        unsorted lists, and ESORT (CONTEXT=SORT) for the sorted ones.
+        '''
+        if (self.paginator.msg_per_page == -1 or
+            self.show_style == THREADED):
+            return False
+        if (self.server.search_index is not None and
+            self.search_expression.upper() != 'ALL'):
+            # The local search gets the whole list
+            return False
+        imap = self.server._imap
+        if self.show_style == SORTED:
+            return self.server_sort and imap.has_capability('CONTEXT=SORT')
+        return imap.has_capability('ESEARCH') and (
+            imap.has_capability('CONTEXT=SEARCH') or
+            imap.has_capability('PARTIAL'))
+
+    def load_window(self, page):
+        '''Gets the number of messages and the UIDs of a page, and of the
+        pages around it that the prefetcher loads, using RETURN (COUNT
+        PARTIAL first:last). Only this window of the list is kept.
+        '''
+        per_page = self.paginator.msg_per_page
+        depth = 0
+        if self.prefetcher:
+            depth = self.prefetcher.depth
+        first = (max(1, page - depth) - 1) * per_page
+        last = (page + depth) * per_page
+        options = 'RETURN (COUNT PARTIAL %d:%d)' % (first + 1, last)
+
+        if self.show_style == SORTED:
+            command_line = 'UID SORT %s %s UTF-8 %s' % (options,
+                self.sort_string(), self.search_expression)
         else:
-            if self.show_style == THREADED:
-                flat_message_list = list(flaten_nested(message_list))
-                self.root_list = []
-            else:
-                flat_message_list = message_list
-                self.root_list = message_list
+            charset = ''
+            if self.search_charset:
+                charset = 'CHARSET %s ' % self.search_charset
+            command_line = 'UID SEARCH %s %s%s' % (options, charset,
+                self.search_expression)
+        result = extended_search(self._imap, command_line)
+
+        old_index = getattr(self, 'index', None)
+        self.set_message_list(result.get('PARTIAL', []))
+        if old_index is not None:
+            # Keep the messages already loaded
+            index = self.index
+            for msg_id in index.uids:
+                if msg_id in old_index.data:
+                    index.data[msg_id] = old_index.data[msg_id]
+                if msg_id in old_index.prefetched:
+                    index.prefetched.add(msg_id)
+        self.window_start = first
+        self._number_messages = result.get('COUNT', 0)
+
+    def in_window(self, page):
+        '''Are the ids of a page on the window loaded?
+        '''
+        per_page = self.paginator.msg_per_page
+        first = (page - 1) * per_page
+        last = min(page * per_page, self.number_messages)
+        return (self.window_start <= first and
+                last <= self.window_start + len(self.flat_message_list))
+
+    def set_message_list(self, message_list):
+        '''Builds the message index from the result of get_message_list.
+        '''
+        index = MessageIndex(message_list, self.show_style == THREADED)
+
+        self.index = index
+        self.root_list = index.root_list()
+        self._number_messages = len(index)
+        # message_dict is in the form:
+        #   { MSG_ID: { 'children': [...], 'parent': MSG_ID, 'level': N,
+        #               'data': Message }, ... }
+        self.message_dict = MessageDict(index)
+        self.flat_message_list = index.uids
+        self.window_start = None
+        self.cancel_prefetch()
+
+        self.refresh = False
 
-        self._number_messages = len(flat_message_list)
+    def reset(self):
+        '''Forces a full refresh of the message list on the next access.
+        '''
+        self.refresh = True
+        self._number_messages = None
+        self.cancel_prefetch()
 
-        # Create here a message dict in the form:
-        #   { MSG_ID: { ... }, ... }
-        message_dict = {}
-        for msg_id in flat_message_list:
-            if msg_id not in message_dict:
-                message_dict[msg_id] = { 'children': [],
-                                         'parent': None,
-                                         'level': 0 }
+    def apply_changes(self, vanished=(), changed=None):
+        '''Updates the message list incrementally.
 
-        if self.show_style == THREADED:
-            for msg_id, level, parent in threaded_tree(message_list):
-                if level == 0:
-                    self.root_list.append(msg_id)
-                else:
-                    if msg_id not in message_dict[parent]['children']:
-                        message_dict[parent]['children'].append(msg_id)
-                    message_dict[msg_id]['parent'] = parent
-                    message_dict[msg_id]['level'] = level
-
-        self.message_dict = message_dict
-        self.flat_message_list = flat_message_list
+        The new messages are placed on sorted lists with a binary search on
+        their sort keys, see L{insert_positions<imapsort.insert_positions>}.
+        When the changes can't be applied to the current list, for instance
+        on a threaded list, a full refresh is scheduled instead.
 
-        self.refresh = False
+        @param vanished: list of expunged UIDs
+        @param changed: dict in the form { UID: flag list, ... } with the
+            messages whose flags changed, and the new messages.
+        '''
+        if self.refresh or self._number_messages == None:
+            # Nothing to update
+            return
+        changed = changed or {}
+        if self.window_start is not None and (vanished or [ msg_id
+            for msg_id in changed if msg_id not in self.message_dict ]):
+            # Only a window of the list is known, we can't tell where the
+            # messages are
+            self.reset()
+            return
+
+        vanished = [ msg_id for msg_id in vanished
+                     if msg_id in self.message_dict ]
+        new = sorted([ msg_id for msg_id in changed
+                       if msg_id not in self.message_dict ])
+        if new and self.search_expression.upper() != 'ALL':
+            # Do the new messages match the search expression?
+            matches = []
+            for message_set in sequence_sets(new):
+                matches.extend(self.search_messages('UID %s %s' % (
+                    message_set, self.search_expression)))
+            new = sorted(set(matches))
+
+        if (new or vanished) and self.show_style == THREADED:
+            # We can't place the messages on the list
+            self.reset()
+            return
+
+        if vanished:
+            self.index.remove(vanished)
+        if new and self.show_style == SORTED:
+            self.index.insert(insert_positions(self._imap, self.index.uids,
+                new, self.sort_program))
+        elif new:
+            self.index.extend(new)
+        if vanished or new:
+            self.flat_message_list = self.index.uids
+            self.root_list = self.flat_message_list
+            self._number_messages = len(self.index)
+
+        for msg_id, flags in changed.items():
+            try:
+                self.message_dict[msg_id]['data'].get_flags(flags)
+            except KeyError:
+                pass
+
+    def page_list(self, page=None):
+        '''Returns the message ids on a page.
+
+        @param page: page number, by default the current page.
+        '''
+        if self.paginator.msg_per_page == -1:
+            return list(self.flat_message_list)
+        if page is None:
+            page = self.paginator.current_page
+        first_msg = ( page - 1 ) * self.paginator.msg_per_page
+        last_message = first_msg + self.paginator.msg_per_page - 1
+        if self.window_start is not None:
+            if not self.in_window(page):
+                self.load_window(page)
+            first_msg -= self.window_start
+            last_message -= self.window_start
+        return list(self.flat_message_list[first_msg:last_message+1])
 
     def add_messages_range(self):
-        '''Adds the current page of messages to the message_dict
+        '''Adds the current page of messages to the message_dict. The
+        messages already loaded by the prefetcher are not fetched again.
         '''
-        use = self.search_capability & self.show_style
-        if use != self.show_style:
-            raise SortProgError('')
+        prefetcher = self.prefetcher
+        if prefetcher:
+            prefetcher.wait()
+            page = self.paginator.current_page
+            if self.window_start is not None and [ near for near in
+                range(max(1, page - prefetcher.depth),
+                      min(self.paginator.max_page, page + prefetcher.depth) + 1)
+                if not self.in_window(near) ]:
+                # The pages around are loaded with the current page
+                self.load_window(page)
 
         # Get the message headers and construct
-        if self.paginator.msg_per_page == -1:
-            message_list = self.flat_message_list
-        else:
-            first_msg = ( self.paginator.current_page - 1 ) * self.paginator.msg_per_page
-            last_message = first_msg + self.paginator.msg_per_page - 1
-            message_list = self.flat_message_list[first_msg:last_message+1]
+        message_list = [ msg_id for msg_id in self.page_list()
+            if not self.message_dict[msg_id].pop('prefetched', False) ]
+
+        prefetch = []
+        if prefetcher:
+            prefetch = prefetcher.page_ids()
+            if prefetch and not self.server.concurrent:
+                # No other connection to use, the pages around are fetched
+                # with the current page. If it's already loaded, only the
+                # messages never fetched are, the others are shown as they
+                # were loaded.
+                if not message_list:
+                    prefetch = [ msg_id for msg_id in prefetch
+                        if 'data' not in self.message_dict[msg_id] ]
+                if message_list or prefetch:
+                    self.add_messages(self.fetch_envelopes(
+                        message_list + prefetch), prefetch)
+                return
 
         if message_list:
-            for msg_id,msg_info in  self._imap.fetch_smart(message_list,
-                        '(ENVELOPE RFC822.SIZE FLAGS)').iteritems():
-                self.message_dict[msg_id]['data'] = Message(
-                    self.server, self.folder, msg_info )
+            self.add_messages(self.fetch_envelopes(message_list))
+        if prefetch:
+            prefetcher.start(prefetch)
+
+    def add_messages(self, msg_dict, prefetched=()):
+        '''Adds the messages to the message_dict.
+
+        @param msg_dict: dict in the form returned by fetch_smart
+        @param prefetched: ids of the messages loaded before being shown
+        '''
+        message_dict = self.message_dict
+        for msg_id, msg_info in msg_dict.items():
+            if msg_id in message_dict:
+                message_dict[msg_id]['data'] = Message(self.server,
+                    self.folder, msg_info)
+        for msg_id in prefetched:
+            entry = message_dict.get(msg_id)
+            if entry is not None and 'data' in entry:
+                entry['prefetched'] = True
+
+    def fetch_envelopes(self, message_list):
+        '''Gets the envelope, size and flags of the messages. If the server
+        has an envelope cache, only the flags are fetched for the cached
+        messages.
+
+        @return: a dict in the form returned by fetch_smart.
+        '''
+        cache = self.server.envelope_cache
+        if cache is None:
+            return self.index_envelopes(self.fetch_messages(message_list,
+                '(ENVELOPE RFC822.SIZE FLAGS)'))
+
+        path = self.folder.path
+        uid_validity = self.folder.uid_validity()
+        cached = cache.get(path, uid_validity, message_list)
+
+        response = {}
+        if cached:
+            for msg_id, msg_info in self.fetch_messages(sorted(cached),
+                '(FLAGS)').items():
+                envelope, size = cached[msg_id]
+                msg_info['ENVELOPE'] = envelope
+                msg_info['RFC822.SIZE'] = size
+                msg_info.setdefault('UID', msg_id)
+                response[msg_id] = msg_info
+
+        missing = [ msg_id for msg_id in message_list
+                    if msg_id not in cached ]
+        if missing:
+            fetched = self.fetch_messages(missing,
+                '(ENVELOPE RFC822.SIZE FLAGS)')
+            cache.set(path, uid_validity, dict(
+                (msg_id, (msg_info['ENVELOPE'], msg_info['RFC822.SIZE']))
+                for msg_id, msg_info in fetched.items()))
+            response.update(fetched)
+
+        return self.index_envelopes(response)
+
+    def index_envelopes(self, response):
+        '''Adds the envelopes fetched to the server search index.
+        '''
+        index = self.server.search_index
+        if index is not None and response:
+            index.add_envelopes(self.folder.path, self.folder.uid_validity(),
+                dict([ (msg_id, msg_info['ENVELOPE'])
+                       for msg_id, msg_info in response.items() ]))
+        return response
+
+    def fetch_messages(self, message_list, query):
+        '''fetch_smart, split on several commands if the message list is
+        too long for a single command line.
+        '''
+        response = {}
+        for part in split_message_list(message_list):
+            response.update(self._imap.fetch_smart(part, query))
+        return response
+
+    # Flags
+    def set_flags(self, message_list, *flags):
+        '''Sets flags on several messages, see L{store_flags}.
+        '''
+        return self.store_flags(message_list, '+FLAGS.SILENT', flags)
+
+    def reset_flags(self, message_list, *flags):
+        '''Removes flags from several messages, see L{store_flags}.
+        '''
+        return self.store_flags(message_list, '-FLAGS.SILENT', flags)
+
+    def store_flags(self, message_list, command, flags):
+        '''Changes the flags of several messages with silent STORE commands,
+        a single round trip, and updates the flags of the messages already
+        loaded without reading them back.
+
+        @param command: +FLAGS.SILENT, -FLAGS.SILENT or FLAGS.SILENT
+        @return: dict in the form { UID: flag list, ... } with the FETCH
+            responses received
+        '''
+        changed = self.folder.store_flags(message_list, command, flags)
+        self.update_flags(message_list, command, flags, changed)
+        return changed
+
+    def update_flags(self, message_list, command, flags, changed=None):
+        '''Updates the local flags of the loaded messages.
+
+        @param changed: FETCH responses received, in the form
+            { UID: flag list, ... }. They are applied after the change, so
+            the server has the last word.
+        '''
+        message_dict = self.message_dict
+        for msg_id in message_list:
+            entry = message_dict.get(msg_id)
+            if entry is not None and 'data' in entry:
+                entry['data'].update_flags(command, flags)
+        for msg_id, flag_list in (changed or {}).items():
+            entry = message_dict.get(msg_id)
+            if entry is not None and 'data' in entry:
+                entry['data'].get_flags(flag_list)
 
     # Handle a request for a single message:
     def get_message(self, message_id ):
@@ -420,8 +1098,7 @@ class MessageList(object):
         # We need to get the msg envelope to initialize the
         # Message object
         try:
-            msg_info = self._imap.fetch_smart(message_id,
-                '(ENVELOPE RFC822.SIZE FLAGS)')[message_id]
+            msg_info = self.fetch_envelopes([message_id])[message_id]
         except KeyError:
             raise MessageNotFound('%s message not found' % message_id)
 
@@ -435,14 +1112,7 @@ class MessageList(object):
             self.refresh_messages()
         self.add_messages_range()
 
-        if self.paginator.msg_per_page == -1:
-            message_list = self.flat_message_list
-        else:
-            first_msg = ( self.paginator.current_page - 1 ) * self.paginator.msg_per_page
-            last_message = first_msg + self.paginator.msg_per_page - 1
-            message_list = self.flat_message_list[first_msg:last_message+1]
-
-        for msg_id in message_list:
+        for msg_id in self.page_list():
             yield self.message_dict[msg_id]['data']
 
 
@@ -452,9 +1122,11 @@ class MessageList(object):
 
 
 class Message(object):
+    # With msg_per_page = -1 there can be many instances
+    __slots__ = ( 'folder', 'envelope', 'size', 'uid', 'flag_bits',
+                  '__bodystructure', '__subject', '__from_name' )
+
     def __init__(self, server, folder, msg_info):
-        self.server = server
-        self._imap = server._imap
         self.folder = folder
         self.envelope = msg_info['ENVELOPE']
         self.size = msg_info['RFC822.SIZE']
@@ -462,12 +1134,91 @@ class Message(object):
         self.get_flags( msg_info['FLAGS'] )
 
         self.__bodystructure = None
+        # Decoded on first use
+        self.__subject = None
+        self.__from_name = None
+
+    def _get_server(self):
+        return self.folder.server
+    server = property(_get_server)
+
+    def _get_imap(self):
+        return self.folder._imap
+    _imap = property(_get_imap)
+
+    # Envelope
+    def _get_subject(self):
+        if self.__subject is None:
+            self.__subject = decode_header_text(envelope_field(
+                self.envelope, 'subject'))
+        return self.__subject
+    subject = property(_get_subject, None, None,
+        'Decoded subject of the message.')
+
+    def _get_from_address(self):
+        addresses = envelope_field(self.envelope, 'from')
+        if not addresses:
+            return u''
+        name, mailbox, host = address_fields(addresses[0])
+        if host:
+            return u'%s@%s' % (mailbox, host)
+        return mailbox or u''
+    from_address = property(_get_from_address, None, None,
+        'Address of the first sender.')
+
+    def _get_from_name(self):
+        if self.__from_name is None:
+            addresses = envelope_field(self.envelope, 'from')
+            name = None
+            if addresses:
+                name = address_fields(addresses[0])[0]
+            if name:
+                self.__from_name = decode_header_text(name)
+            else:
+                self.__from_name = self.from_address
+        return self.__from_name
+    from_name = property(_get_from_name, None, None,
+        'Decoded name of the first sender, or its address if there is no '
+        'name.')
 
     # Fetch messages
+    def cache_key(self, section):
+        '''Key of a message section on the server body cache.
+
+        @return: the key, or None if the UIDVALIDITY of the folder isn't
+            known and the section can't be cached.
+        '''
+        folder = self.folder
+        try:
+            uid_validity = folder.uid_validity()
+        except KeyError:
+            # Not sent by the server
+            return None
+        if not uid_validity:
+            return None
+        return (folder.path, int(uid_validity), self.uid, section)
+
+    def cached_fetch(self, section, query):
+        '''Fetches a message section, using the server body cache if there
+        is one.
+        '''
+        cache = self.server.body_cache
+        key = None
+        if cache is not None:
+            key = self.cache_key(section)
+        if key is not None:
+            value = cache.get(key)
+            if value is not None:
+                return value
+        value = self._imap.fetch_smart(self.uid, query)[self.uid][section]
+        if key is not None:
+            cache.set(key, value)
+        return value
+
     def get_bodystructure(self):
         if not self.__bodystructure:
-            self.__bodystructure = self._imap.fetch_smart(self.uid,
-                '(BODYSTRUCTURE)')[self.uid]['BODYSTRUCTURE']
+            self.__bodystructure = self.cached_fetch('BODYSTRUCTURE',
+                '(BODYSTRUCTURE)')
         return self.__bodystructure
     bodystructure = property(get_bodystructure)
 
@@ -475,67 +1226,156 @@ class Message(object):
         '''Get a part from the server.
         '''
         query = part.query()
-        text = self.fetch(query)
+        text = octets(self.fetch(query))
 
         if part.body_fld_enc == 'BASE64':
             text = base64.b64decode(text )
         elif part.body_fld_enc == 'QUOTED-PRINTABLE':
             text = quopri.decodestring(text)
 
-        if part.media == 'TEXT' and part.media_subtype != 'HTML':
+        if part.media != 'TEXT':
+            return text
+
+        try:
+            unicode_text = text.decode(part.charset() or 'us-ascii')
+        except (UnicodeDecodeError, LookupError):
+            # Some times the messages have the wrong encoding, for instance
+            # PHPMailer sends a text/plain with charset utf-8 but the actual
+            # contents are iso-8859-1. Here we can try to guess the encoding
+            # on a case by case basis.
+            unicode_text = text.decode('iso-8859-1')
+        index = self.server.search_index
+        if index is not None:
+            index.add_text(self.folder.path, self.folder.uid_validity(),
+                self.uid, unicode_text, part.media_subtype == 'HTML')
+
+        if part.media_subtype == 'HTML':
             # The HTML should have a meta tag with the correct charset encoding
-            try:
-                return unicode(text, part.charset())
-            except (UnicodeDecodeError, LookupError):
-                # Some times the messages have the wrong encoding, for instance
-                # PHPMailer sends a text/plain with charset utf-8 but the actual
-                # contents are iso-8859-1. Here we can try to guess the encoding
-                # on a case by case basis.
-                try:
-                    return unicode(text, 'iso-8859-1')
-                except:
-                    raise
-
-        return text
+            return text
+        return unicode_text
+
+    def write_part(self, part, output, chunk_size=CHUNK_SIZE):
+        '''Writes a part, decoded, to a file like object. The part is
+        fetched in chunks, so the memory used doesn't depend on the part
+        size. The text parts are not converted to unicode.
+
+        @param part: part object, as used by L{part}
+        @param output: object with a write method
+        @param chunk_size: bytes fetched on each FETCH command
+
+        @return: number of bytes fetched
+        '''
+        section = _SECTION.search(part.query()).group(1)
+        return self.write_section(section, output, part.body_fld_enc,
+            chunk_size)
+
+    def write_source(self, output, chunk_size=CHUNK_SIZE):
+        '''Writes the message source to a file like object, without
+        keeping it in memory.
+
+        @return: number of bytes fetched
+        '''
+        return self.write_section('', output, None, chunk_size)
+
+    def write_section(self, section, output, encoding=None,
+        chunk_size=CHUNK_SIZE):
+        '''Fetches a body section using partial fetches
+        (BODY.PEEK[section]<offset.length>) and writes it decoded to output.
+        The next chunk is requested before writing the current one.
+        '''
+        imap = self._imap
+        query = 'UID FETCH %d (BODY.PEEK[%s]<%%d.%d>)' % (self.uid, section,
+            chunk_size)
+        decoder = StreamDecoder(encoding)
+
+        offset = 0
+        tag = send_command(imap, query % offset)
+        while tag:
+            data = section_data(read_response(imap, tag).check(), self.uid)
+            offset += len(data)
+            if len(data) == chunk_size:
+                tag = send_command(imap, query % offset)
+            else:
+                tag = None
+            output.write(decoder.decode(data))
+        output.write(decoder.flush())
+
+        return offset
 
     def fetch(self, query ):
         '''Returns the fetch response for the query
         '''
-        return self._imap.fetch_smart(self.uid,query)[self.uid][query]
+        return self.cached_fetch(query, query)
 
     def source(self):
-        '''Returns the message source, untreated.
+        '''Returns the message source, untreated. The text parts are added to
+        the search index, if there's one indexing the text.
         '''
-        return self.fetch('BODY[]')
+        source = self.fetch('BODY[]')
+        index = self.server.search_index
+        if index is not None:
+            index.add_source(self.folder.path, self.folder.uid_validity(),
+                self.uid, octets(source))
+        return source
 
     def part_header(self, part = None):
         '''Get a part header from the server.
         '''
         if part:
-            query = 'BODY[%s.HEADER]'
+            query = 'BODY[%s.HEADER]' % part
         else:
             query = 'BODY[HEADER]'
 
-        text = self._imap.fetch_smart(self.uid,query)[self.uid][query]
+        return self.fetch(query)
 
-        return text
+    def msg_info(self):
+        '''Returns the message data in the form of a fetch response, for
+        the local evaluation of queries. Only the system flags are known.
+        '''
+        return { 'UID': self.uid, 'ENVELOPE': self.envelope,
+                 'RFC822.SIZE': self.size, 'FLAGS': [ flag
+                 for flag, bit in FLAG_BITS.items() if self.flag_bits & bit ] }
 
     # Flags:
     def get_flags(self, flags):
-        self.seen = SEEN in flags
-        self.deleted = DELETED in flags
-        self.answered = ANSWERED  in flags
-        self.flagged = FLAGGED in flags
-        self.draft = DRAFT in flags
-        self.recent = RECENT in flags
+        flag_bits = 0
+        for flag in flags:
+            flag_bits |= FLAG_BITS.get(flag, 0)
+        self.flag_bits = flag_bits
+
+    seen = flag_property(SEEN)
+    deleted = flag_property(DELETED)
+    answered = flag_property(ANSWERED)
+    flagged = flag_property(FLAGGED)
+    draft = flag_property(DRAFT)
+    recent = flag_property(RECENT)
+
+    def update_flags(self, command, flags):
+        '''Applies a flag change locally.
+
+        @param command: STORE command, +FLAGS, -FLAGS or FLAGS
+        '''
+        flag_bits = 0
+        for flag in flags:
+            flag_bits |= FLAG_BITS.get(flag, 0)
+        if command.startswith('+'):
+            self.flag_bits |= flag_bits
+        elif command.startswith('-'):
+            self.flag_bits &= ~flag_bits
+        else:
+            self.flag_bits = flag_bits
+
+    def store_flags(self, command, flags):
+        changed = self.folder.store_flags([ self.uid ], command, flags)
+        self.update_flags(command, flags)
+        if self.uid in changed:
+            self.get_flags(changed[self.uid])
 
     def set_flags(self, *args ):
-        self._imap.store_smart(self.uid, '+FLAGS', args)
-        self.get_flags( self._imap.sstatus['fetch_response'][self.uid]['FLAGS'] )
+        self.store_flags('+FLAGS.SILENT', args)
 
     def reset_flags(self, *args ):
-        self._imap.store_smart(self.uid, '-FLAGS', args)
-        self.get_flags( self._imap.sstatus['fetch_response'][self.uid]['FLAGS'] )
+        self.store_flags('-FLAGS.SILENT', args)
 
     # Special methods
     def __repr__(self):
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of hlimap.
+##
+## hlimap is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## hlimap is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+
+'''High Level IMAP Lib - connection pool
+
+This module is part of the hlimap lib.
+
+Notes
+=====
+
+A L{PooledImapServer} keeps several authenticated connections to the same
+account. The folder operations are routed to a connection that already has
+the folder selected, so that jumping between folders doesn't cost a SELECT
+each time, and several threads can work on different folders at the same
+time.
+
+The connections are leased per thread: the first time a thread uses a folder
+a connection is taken from the pool (preferably one with the folder already
+selected) and it stays with the thread until L{PooledImapServer.release} is
+called, typically at the end of each request. A thread holds at most one
+connection, when it moves to another folder the folder is selected on the
+connection it already has::
+
+    >>> M = PooledImapServer('example.com', size=4)
+    >>> M.login('user', 'password')
+    >>> try:
+    ...     for message in M['INBOX']:
+    ...         print(message.uid)
+    ... finally:
+    ...     M.release()
+
+When a connection is taken from the pool with the folder still selected a
+NOOP is sent instead of the SELECT, to get the changes made meanwhile by the
+other connections (see L{Folder.noop<imapfolder.Folder.noop>}).
+
+The folder list operations (LIST, LSUB, STATUS, APPEND) don't need a selected
+mailbox and use the main connection, as with L{ImapServer<ImapServer>}.
+'''
+
+# Imports
+import time
+import threading
+
+from .imapserver import ImapServer
+from .imapext import enable
+
+# Exceptions:
+
+class PoolExhausted(Exception): pass
+
+class PooledConnection(object):
+    '''A connection on the pool.
+    '''
+
+    def __init__(self, imap):
+        self.imap = imap
+        # Mailbox selected on this connection
+        self.selected = None
+        self.last_used = time.time()
+        self.in_use = False
+
+    def __repr__(self):
+        return '<PooledConnection selected "%s">' % self.selected
+
+class ConnectionPool(object):
+    '''Bounded pool of connections with selected mailbox affinity.
+    '''
+
+    def __init__(self, factory, size=4, idle_timeout=300, wait_timeout=None):
+        '''
+        @param factory: callable that returns a new authenticated IMAP4P
+            instance
+        @param size: maximum number of connections
+        @param idle_timeout: the connections not used for this number of
+            seconds are closed
+        @param wait_timeout: how long to wait for a free connection when the
+            pool is exhausted, None means wait forever.
+        '''
+        self.factory = factory
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+        self.connections = []
+        self.condition = threading.Condition()
+
+    def acquire(self, mailbox=None):
+        '''Takes a connection from the pool. The preferred connection is an
+        idle connection with the mailbox selected, then the idle connection
+        that was not used for longer, and only then a new connection.
+        '''
+        deadline = None
+        if self.wait_timeout is not None:
+            deadline = time.time() + self.wait_timeout
+
+        self.condition.acquire()
+        try:
+            while True:
+                self.close_idle()
+                idle = [ connection for connection in self.connections
+                         if not connection.in_use ]
+                if idle:
+                    selected = [ connection for connection in idle
+                                 if connection.selected == mailbox ]
+                    if selected and mailbox is not None:
+                        connection = selected[0]
+                    else:
+                        connection = min(idle,
+                            key=lambda connection: connection.last_used)
+                    break
+                if len(self.connections) < self.size:
+                    connection = PooledConnection(self.factory())
+                    self.connections.append(connection)
+                    break
+                if deadline is None:
+                    self.condition.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise PoolExhausted('No free connections on the pool')
+                    self.condition.wait(remaining)
+            connection.in_use = True
+            connection.last_used = time.time()
+            return connection
+        finally:
+            self.condition.release()
+
+    def release(self, connection):
+        '''Returns a connection to the pool.
+        '''
+        self.condition.acquire()
+        try:
+            connection.in_use = False
+            connection.last_used = time.time()
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def discard(self, connection):
+        '''Removes a broken connection from the pool.
+        '''
+        self.condition.acquire()
+        try:
+            if connection in self.connections:
+                self.connections.remove(connection)
+            self.condition.notify()
+        finally:
+            self.condition.release()
+        self.logout(connection)
+
+    def close_idle(self):
+        '''Closes the connections that are idle for too long. Must be called
+        with the lock held.
+        '''
+        if self.idle_timeout is None:
+            return
+        limit = time.time() - self.idle_timeout
+        for connection in self.connections[:]:
+            if not connection.in_use and connection.last_used < limit:
+                self.connections.remove(connection)
+                self.logout(connection)
+
+    def logout(self, connection):
+        try:
+            connection.imap.logout()
+        except Exception:
+            pass
+
+    def close(self):
+        '''Closes all the idle connections.
+        '''
+        self.condition.acquire()
+        try:
+            for connection in self.connections[:]:
+                if not connection.in_use:
+                    self.connections.remove(connection)
+                    self.logout(connection)
+        finally:
+            self.condition.release()
+
+class PooledImapServer(ImapServer):
+    '''ImapServer that keeps a pool of connections to the account.
+    '''
+
+    def __init__(self, host='localhost', port=None, ssl=False,
+        keyfile=None, certfile=None, size=4, idle_timeout=300,
+        wait_timeout=None):
+        '''
+        @param size: maximum number of pooled connections, the main
+            connection is not included
+        @param idle_timeout: the pooled connections not used for this number
+            of seconds are closed
+        @param wait_timeout: how long to wait for a free connection, None
+            means wait forever
+
+        The other parameters are the same as on L{ImapServer<ImapServer>}.
+        '''
+        ImapServer.__init__(self, host, port, ssl, keyfile, certfile)
+        self.connection_args = dict(host=host, port=port, ssl=ssl,
+            keyfile=keyfile, certfile=certfile, autologout=False)
+        self.credentials = None
+        self.pool = ConnectionPool(self.new_connection, size, idle_timeout,
+            wait_timeout)
+        self.lease = threading.local()
+        self.concurrent = True
+
+    def login(self, username, password):
+        result = ImapServer.login(self, username, password)
+        self.credentials = (username, password)
+        return result
+
+    def new_connection(self):
+        '''Creates a new authenticated connection for the pool.
+        '''
+        imap = self.connection_class(**self.connection_args)
+        imap.login(*self.credentials)
+        if self.enabled:
+            enable(imap, *self.enabled)
+        return imap
+
+    def connection(self, folder=None):
+        '''Returns the connection leased by the current thread, with the
+        folder selected. If there's no lease a connection is taken from the
+        pool, and the folder is selected on it if needed.
+        '''
+        if folder is None:
+            return self._imap
+        connection = getattr(self.lease, 'connection', None)
+        reused = False
+        if connection is None:
+            connection = self.pool.acquire(folder.path)
+            self.lease.connection = connection
+            reused = connection.selected == folder.path
+        try:
+            if connection.selected != folder.path:
+                connection.selected = folder.path
+                folder.select()
+            elif reused:
+                # Changes made meanwhile by the other connections
+                folder.noop()
+        except Exception:
+            self.lease.connection = None
+            self.pool.discard(connection)
+            raise
+        return self.instrument(connection.imap)
+
+    def select_folder(self, folder):
+        '''Leases a connection with the folder selected. The SELECT is only
+        sent if no pooled connection has the folder selected already.
+        '''
+        self.connection(folder)
+
+    def release(self):
+        '''Returns to the pool the connection leased by the current thread.
+        '''
+        connection = getattr(self.lease, 'connection', None)
+        if connection is not None:
+            self.lease.connection = None
+            self.pool.release(connection)
+
+    def __del__(self):
+        self.pool.close()
+        ImapServer.__del__(self)
@@ -0,0 +1,450 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of hlimap.
+##
+## hlimap is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## hlimap is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+
+'''High Level IMAP Lib - search queries
+
+This module is part of the hlimap lib.
+
+Notes
+=====
+
+Search queries are built with the functions of this module, named after the
+IMAP search keys, and combined with &, | and ~::
+
+    >>> query = SUBJECT('report') & UNSEEN & SINCE(datetime.date(2010, 1, 1))
+    >>> query.compile()
+    'SUBJECT "report" UNSEEN SINCE 1-Jan-2010'
+    >>> query = FROM(u'Jos\\xe9') | LARGER(1000000)
+    >>> query.compile()
+    'CHARSET UTF-8 OR FROM {5}\\r\\nJos\\xc3\\xa9 LARGER 1000000'
+
+A query can be given to
+L{MessageList.set_search_expression<imapmessage.MessageList.set_search_expression>},
+and L{MessageList.refine<imapmessage.MessageList.refine>} narrows the
+current list with more keys.
+
+The strings with non ASCII characters are sent in UTF-8 literals, and the
+CHARSET UTF-8 argument is added to the SEARCH command. The literals are non
+synchronizing if the server has LITERAL+, otherwise the command waits for
+the server before sending each one (see
+L{send_command<imapext.send_command>}), 8-bit text isn't allowed on quoted
+strings.
+
+Local evaluation
+----------------
+
+L{Query.match} evaluates a query on the data of a message, a dict with the
+fetch response items (UID, FLAGS, ENVELOPE, RFC822.SIZE, INTERNALDATE). The
+keys that need data not available (BODY, TEXT, KEYWORD, INTERNALDATE if
+missing, ...) raise L{NotEvaluable}, and L{Query.filter} returns None, so
+the server has to be asked.
+'''
+
+# Imports
+import datetime
+from abc import ABCMeta, abstractmethod
+from email.utils import parsedate_tz
+
+from .imapext import quote, parse_sequence_set
+from .imapsort import decode_header_text
+from .utils import sequence_set, address_text, MONTHS
+from .imapmessage import envelope_field
+
+# Exceptions:
+
+class NotEvaluable(Exception): pass
+
+# Utils
+
+def is_ascii(text):
+    try:
+        if isinstance(text, type(u'')):
+            text.encode('ascii')
+        else:
+            text.decode('ascii')
+    except (UnicodeEncodeError, UnicodeDecodeError):
+        return False
+    return True
+
+def astring(text, literal_plus=False):
+    '''Formats a string argument: quoted if it's ASCII, otherwise UTF-8 in a
+    literal, non synchronizing with LITERAL+.
+    '''
+    if isinstance(text, type(u'')):
+        if is_ascii(text):
+            # The command lines are native strings
+            text = str(text)
+        else:
+            text = text.encode('utf-8')
+            if str is not bytes:
+                # Python 3, the command lines are str
+                text = text.decode('latin-1')
+    if not is_ascii(text):
+        return '{%d%s}\r\n%s' % (len(text), literal_plus and '+' or '', text)
+    return quote(text)
+
+def imap_date(date):
+    '''Formats a date as an IMAP date, '1-Feb-1994'.
+    '''
+    if isinstance(date, str):
+        return date
+    return '%d-%s-%d' % (date.day, MONTHS[date.month - 1], date.year)
+
+def parse_date(text):
+    '''Parses an IMAP date or date-time, returns a datetime.date.
+    '''
+    day, month, year = text.strip().split(' ')[0].split('-')
+    return datetime.date(int(year), MONTHS.index(month.capitalize()) + 1,
+        int(day))
+
+def as_date(date):
+    if isinstance(date, datetime.datetime):
+        return date.date()
+    if isinstance(date, datetime.date):
+        return date
+    return parse_date(date)
+
+def text_of(value):
+    if value is None:
+        return u''
+    if not isinstance(value, type(u'')):
+        value = str(value)
+        if isinstance(value, bytes):
+            value = value.decode('utf-8', 'replace')
+    return value
+
+# Message data
+
+def internal_date(msg_info):
+    if not msg_info.get('INTERNALDATE'):
+        raise NotEvaluable('INTERNALDATE')
+    return parse_date(msg_info['INTERNALDATE'])
+
+def sent_date(msg_info):
+    date = parsedate_tz(envelope_field(msg_info['ENVELOPE'], 'date') or '')
+    if not date:
+        return None
+    return datetime.date(*date[:3])
+
+def header_text(msg_info, field):
+    envelope = msg_info['ENVELOPE']
+    if field == 'SUBJECT':
+        return decode_header_text(envelope_field(envelope, 'subject'))
+    return address_text(envelope_field(envelope, field.lower()))
+
+def flags_of(msg_info):
+    return set([ flag.upper() for flag in msg_info['FLAGS'] ])
+
+# Queries
+
+# Base class with ABCMeta as metaclass, on Python 2 and 3
+_Abstract = ABCMeta('_Abstract', (object,), {})
+
+class Query(_Abstract):
+    '''Search query, the subclasses define L{criteria}.
+    '''
+
+    @abstractmethod
+    def criteria(self, literal_plus=False):
+        '''Returns the search keys, without the CHARSET argument.
+        '''
+
+    def strings(self):
+        '''Returns the string arguments of the query.
+        '''
+        return []
+
+    def charset(self):
+        '''Charset for the CHARSET argument of the SEARCH command, None if
+        all the strings are ASCII.
+        '''
+        for text in self.strings():
+            if not is_ascii(text):
+                return 'UTF-8'
+        return None
+
+    def compile(self, literal_plus=False):
+        '''Returns the arguments of the SEARCH command.
+        '''
+        criteria = self.criteria(literal_plus)
+        charset = self.charset()
+        if charset:
+            return 'CHARSET %s %s' % (charset, criteria)
+        return criteria
+
+    def test(self, msg_info):
+        raise NotEvaluable(self.criteria())
+
+    def match(self, msg_info):
+        '''Does the message match the query? L{NotEvaluable} is raised if
+        the message data isn't enough to know.
+
+        @param msg_info: dict with the items of a fetch response
+        '''
+        try:
+            return self.test(msg_info)
+        except (KeyError, IndexError, TypeError, ValueError):
+            raise NotEvaluable(self.criteria())
+
+    def filter(self, msg_info_list):
+        '''Returns the UIDs of the messages matching the query, or None if
+        some message can't be evaluated.
+        '''
+        try:
+            return [ msg_info['UID'] for msg_info in msg_info_list
+                     if self.match(msg_info) ]
+        except NotEvaluable:
+            return None
+
+    def __and__(self, other):
+        return And(self, other)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+    def __str__(self):
+        return self.compile()
+
+    def __repr__(self):
+        return '<Query %s>' % self.compile()
+
+class Key(Query):
+    '''A search key with its arguments.
+    '''
+
+    def __init__(self, name, arguments=(), texts=(), test=None):
+        '''
+        @param arguments: arguments already formatted (atoms, numbers,
+            dates)
+        @param texts: string arguments, after the other arguments
+        @param test: function that evaluates the key on the message data
+        '''
+        self.name = name
+        self.arguments = list(arguments)
+        self.texts = list(texts)
+        self.test_function = test
+
+    def criteria(self, literal_plus=False):
+        return ' '.join([ self.name ] + self.arguments +
+            [ astring(text, literal_plus) for text in self.texts ])
+
+    def strings(self):
+        return self.texts
+
+    def test(self, msg_info):
+        if self.test_function is None:
+            raise NotEvaluable(self.name)
+        return self.test_function(msg_info)
+
+class Raw(Query):
+    '''Search keys already in the IMAP syntax, they can't be evaluated
+    locally.
+    '''
+
+    def __init__(self, expression):
+        self.expression = expression
+
+    def criteria(self, literal_plus=False):
+        return self.expression
+
+class And(Query):
+    def __init__(self, *query_list):
+        self.query_list = []
+        for query in query_list:
+            if isinstance(query, And):
+                self.query_list.extend(query.query_list)
+            else:
+                self.query_list.append(query)
+
+    def criteria(self, literal_plus=False):
+        if not self.query_list:
+            return 'ALL'
+        return ' '.join([ group(query, literal_plus)
+                          for query in self.query_list ])
+
+    def strings(self):
+        return sum([ query.strings() for query in self.query_list ], [])
+
+    def test(self, msg_info):
+        for query in self.query_list:
+            if not query.match(msg_info):
+                return False
+        return True
+
+class Or(Query):
+    def __init__(self, *query_list):
+        self.query_list = list(query_list)
+
+    def criteria(self, literal_plus=False):
+        # OR takes two keys, OR a OR b c
+        result = group(self.query_list[-1], literal_plus)
+        for query in reversed(self.query_list[:-1]):
+            result = 'OR %s %s' % (group(query, literal_plus), result)
+        return result
+
+    def strings(self):
+        return sum([ query.strings() for query in self.query_list ], [])
+
+    def test(self, msg_info):
+        # All the keys are evaluated, so that a key that can't be
+        # evaluated isn't hidden
+        results = [ query.match(msg_info) for query in self.query_list ]
+        return True in results
+
+class Not(Query):
+    def __init__(self, query):
+        self.query = query
+
+    def criteria(self, literal_plus=False):
+        return 'NOT %s' % group(self.query, literal_plus)
+
+    def strings(self):
+        return self.query.strings()
+
+    def test(self, msg_info):
+        return not self.query.match(msg_info)
+
+def group(query, literal_plus):
+    '''Search keys of a query, parenthesized if there's more than one.
+    '''
+    if (isinstance(query, And) and len(query.query_list) > 1 or
+        isinstance(query, Raw)):
+        return '(%s)' % query.criteria(literal_plus)
+    return query.criteria(literal_plus)
+
+# Search keys
+
+def flag_key(name, flag, present=True):
+    return Key(name, test=lambda msg_info:
+        (flag in flags_of(msg_info)) == present)
+
+ALL = Key('ALL', test=lambda msg_info: True)
+ANSWERED = flag_key('ANSWERED', '\\ANSWERED')
+DELETED = flag_key('DELETED', '\\DELETED')
+DRAFT = flag_key('DRAFT', '\\DRAFT')
+FLAGGED = flag_key('FLAGGED', '\\FLAGGED')
+RECENT = flag_key('RECENT', '\\RECENT')
+SEEN = flag_key('SEEN', '\\SEEN')
+UNANSWERED = flag_key('UNANSWERED', '\\ANSWERED', False)
+UNDELETED = flag_key('UNDELETED', '\\DELETED', False)
+UNDRAFT = flag_key('UNDRAFT', '\\DRAFT', False)
+UNFLAGGED = flag_key('UNFLAGGED', '\\FLAGGED', False)
+UNSEEN = flag_key('UNSEEN', '\\SEEN', False)
+OLD = flag_key('OLD', '\\RECENT', False)
+NEW = Key('NEW', test=lambda msg_info:
+    '\\RECENT' in flags_of(msg_info) and '\\SEEN' not in flags_of(msg_info))
+
+def header_key(name):
+    def key(text):
+        text = text_of(text)
+        return Key(name, texts=[ text ], test=lambda msg_info:
+            text.lower() in header_text(msg_info, name).lower())
+    key.__name__ = name
+    key.__doc__ = 'Messages with the string on the %s field.' % name
+    return key
+
+FROM = header_key('FROM')
+TO = header_key('TO')
+CC = header_key('CC')
+BCC = header_key('BCC')
+SUBJECT = header_key('SUBJECT')
+
+def BODY(text):
+    return Key('BODY', texts=[ text_of(text) ])
+
+def TEXT(text):
+    return Key('TEXT', texts=[ text_of(text) ])
+
+def HEADER(field, text):
+    '''Messages with the string on a header field. Only the Message-ID and
+    In-Reply-To fields can be evaluated locally, from the envelope.
+    '''
+    text = text_of(text)
+    test = None
+    name = field.lower().replace('-', '_')
+    if name in ('message_id', 'in_reply_to'):
+        test = lambda msg_info: text.lower() in text_of(envelope_field(
+            msg_info['ENVELOPE'], name)).lower()
+    return Key('HEADER', texts=[ field, text ], test=test)
+
+def KEYWORD(flag):
+    return Key('KEYWORD', [ flag ])
+
+def UNKEYWORD(flag):
+    return Key('UNKEYWORD', [ flag ])
+
+def date_key(name, compare, sent=False):
+    def key(date):
+        date = as_date(date)
+        get_date = sent and sent_date or internal_date
+        def test(msg_info):
+            message_date = get_date(msg_info)
+            return message_date is not None and compare(message_date, date)
+        return Key(name, [ imap_date(date) ], test=test)
+    key.__name__ = name
+    return key
+
+BEFORE = date_key('BEFORE', lambda a, b: a < b)
+ON = date_key('ON', lambda a, b: a == b)
+SINCE = date_key('SINCE', lambda a, b: a >= b)
+SENTBEFORE = date_key('SENTBEFORE', lambda a, b: a < b, True)
+SENTON = date_key('SENTON', lambda a, b: a == b, True)
+SENTSINCE = date_key('SENTSINCE', lambda a, b: a >= b, True)
+
+def LARGER(size):
+    return Key('LARGER', [ '%d' % size ], test=lambda msg_info:
+        msg_info['RFC822.SIZE'] > size)
+
+def SMALLER(size):
+    return Key('SMALLER', [ '%d' % size ], test=lambda msg_info:
+        msg_info['RFC822.SIZE'] < size)
+
+def UID(uid_list):
+    '''Messages with the UIDs given, a list or a sequence set string. The
+    sequence sets with * can't be evaluated locally.
+    '''
+    if isinstance(uid_list, str):
+        message_set = uid_list
+        uids = None
+        if '*' not in message_set:
+            uids = set(parse_sequence_set(message_set))
+    else:
+        uids = set(uid_list)
+        message_set = sequence_set(uids)
+    test = None
+    if uids is not None:
+        test = lambda msg_info: msg_info['UID'] in uids
+    return Key('UID', [ message_set ], test=test)
+
+def AND(*query_list):
+    return And(*query_list)
+
+def OR(*query_list):
+    return Or(*query_list)
+
+def NOT(query):
+    return Not(query)
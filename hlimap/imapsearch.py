@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of hlimap.
+##
+## hlimap is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## hlimap is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+
+'''High Level IMAP Lib - local search index
+
+This module is part of the hlimap lib.
+
+Notes
+=====
+
+A L{SearchIndex} answers SEARCH criteria on the client, without asking the
+server to go through the messages. It's built from the envelopes the
+message lists fetch and, optionally, from the text of the messages whose
+source is read with L{Message.source<imapmessage.Message.source>}::
+
+    >>> M.set_search_index(SearchIndex(index_text=True))
+
+The index is kept for each mailbox and UIDVALIDITY. For each of the SUBJECT,
+FROM, TO, CC and BCC fields there's an inverted index, word -> UIDs, and
+the decoded field text. A search looks for the index words containing the
+words searched, and checks the candidates against the field text, so the
+result is the same as the server's (case insensitive substring).
+
+The text only has the inverted index. All the text parts of a message are
+indexed from its source, the HTML ones without the markup. The parts read
+with L{Message.part<imapmessage.Message.part>} add their words too, but
+BODY is only answered locally when the text of all the messages searched
+was indexed from the source. Even then it must be a single word, since a
+substring made of word characters can only be found inside a word of the
+text. Other BODY strings are left to the server, and so is TEXT, which
+looks at all the header fields.
+
+The criteria understood are ALL, SUBJECT, FROM, TO, CC, BCC, BODY, UID,
+NOT, OR and parenthesized lists. For anything else (TEXT, flags, dates,
+sizes, ...) L{SearchIndex.search} returns None and the server is used. The
+results of the last searches are kept until the mailbox index changes.
+'''
+
+# Imports
+import re
+import email
+import threading
+
+try:
+    from html import unescape
+except ImportError:
+    # Python 2
+    from HTMLParser import HTMLParser
+    unescape = HTMLParser().unescape
+
+from .imapext import parse_response, parse_sequence_set
+from .imapsort import decode_header_text
+from .imapmessage import envelope_field
+from .utils import address_text
+
+# Exceptions:
+
+class NotIndexed(Exception): pass
+
+# Constants:
+
+HEADER_FIELDS = ( 'SUBJECT', 'FROM', 'TO', 'CC', 'BCC' )
+# Number of search results kept for each mailbox
+RESULT_CACHE_SIZE = 32
+
+_WORD = re.compile(r'\w+', re.UNICODE)
+_SINGLE_WORD = re.compile(r'\w+\Z', re.UNICODE)
+_HIDDEN = re.compile(r'<!--.*?-->|<(script|style)\b.*?</\1\s*>',
+    re.IGNORECASE | re.DOTALL)
+_TAG = re.compile(r'<[^>]*>')
+
+def words(text):
+    return set(_WORD.findall(text.lower()))
+
+def html_text(html):
+    '''Text of an HTML document, without the markup.
+    '''
+    return unescape(_TAG.sub(' ', _HIDDEN.sub(' ', html)))
+
+def message_text(source):
+    '''Text of the text parts of a message, the HTML ones without the
+    markup.
+
+    @param source: message source, octets
+    @return: list of unicode strings, one for each part
+    '''
+    if hasattr(email, 'message_from_bytes'):
+        message = email.message_from_bytes(source)
+    else:
+        message = email.message_from_string(source)
+    text_list = []
+    for part in message.walk():
+        if part.get_content_maintype() != 'text':
+            continue
+        payload = part.get_payload(decode=True) or b''
+        try:
+            text = payload.decode(part.get_content_charset() or 'us-ascii')
+        except (UnicodeDecodeError, LookupError):
+            text = payload.decode('iso-8859-1')
+        if part.get_content_subtype() == 'html':
+            text = html_text(text)
+        text_list.append(text)
+    return text_list
+
+class MailboxIndex(object):
+    '''Search index of a mailbox with a given UIDVALIDITY.
+    '''
+
+    def __init__(self, uid_validity):
+        self.uid_validity = uid_validity
+        # Messages with the envelope indexed
+        self.uids = set()
+        # Messages with the text of all the parts indexed
+        self.text_uids = set()
+        # { field: { UID: lower case text, ... }, ... }
+        self.fields = dict([ (field, {}) for field in HEADER_FIELDS ])
+        # { field: { word: set of UIDs, ... }, ... }, 'BODY' for the text
+        self.postings = dict([ (field, {}) for field in
+                               HEADER_FIELDS + ('BODY',) ])
+        self.results = {}
+
+    def add(self, field, uid, text):
+        postings = self.postings[field]
+        for word in words(text):
+            postings.setdefault(word, set()).add(uid)
+
+    def add_envelope(self, uid, envelope):
+        fields = (
+            ('SUBJECT', decode_header_text(envelope_field(envelope,
+                'subject'))),
+            ('FROM', address_text(envelope_field(envelope, 'from'))),
+            ('TO', address_text(envelope_field(envelope, 'to'))),
+            ('CC', address_text(envelope_field(envelope, 'cc'))),
+            ('BCC', address_text(envelope_field(envelope, 'bcc'))) )
+        for field, text in fields:
+            self.fields[field][uid] = text.lower()
+            self.add(field, uid, text)
+        self.uids.add(uid)
+        self.results.clear()
+
+    def add_text(self, uid, text):
+        '''Adds the text of a part. The message isn't searched locally
+        until all the text parts are added, see L{add_message}.
+        '''
+        self.add('BODY', uid, text)
+
+    def add_message(self, uid, text_list):
+        '''Adds the text of all the parts of a message.
+        '''
+        for text in text_list:
+            self.add('BODY', uid, text)
+        self.text_uids.add(uid)
+        self.results.clear()
+
+    def remove(self, uid_list):
+        '''The postings aren't changed, the UIDs not on the mailbox are
+        removed from the results.
+        '''
+        for uid in uid_list:
+            self.uids.discard(uid)
+            self.text_uids.discard(uid)
+            for field_text in self.fields.values():
+                field_text.pop(uid, None)
+        self.results.clear()
+
+    # Search
+
+    def matching_words(self, field, word):
+        '''UIDs with an index word containing word.
+        '''
+        uids = set()
+        for index_word, word_uids in self.postings[field].items():
+            if word in index_word:
+                uids |= word_uids
+        return uids
+
+    def search_words(self, field, text):
+        '''UIDs with all the words of text, None if text has no words.
+        '''
+        result = None
+        for word in words(text):
+            uids = self.matching_words(field, word)
+            if result is None:
+                result = uids
+            else:
+                result &= uids
+            if not result:
+                break
+        return result
+
+    def search_field(self, field, text, uid_set):
+        text = text.lower()
+        candidates = self.search_words(field, text)
+        if candidates is None:
+            candidates = uid_set
+        field_text = self.fields[field]
+        return set([ uid for uid in candidates & uid_set
+                     if text in field_text.get(uid, '') ])
+
+    def search_body(self, text, uid_set):
+        if not uid_set <= self.text_uids:
+            raise NotIndexed('The text of some messages is not indexed')
+        text = text.lower()
+        if not text:
+            return set(uid_set)
+        if not _SINGLE_WORD.match(text):
+            # Not a single word, the index can't tell where it's found
+            raise NotIndexed('BODY %s' % text)
+        return self.matching_words('BODY', text) & uid_set
+
+    def criterion(self, tokens, position, uid_set):
+        '''Evaluates the search key at position.
+
+        @return: a tuple (set of UIDs, position of the next key)
+        '''
+        token = tokens[position]
+        if isinstance(token, list):
+            return self.criteria(token, uid_set), position + 1
+        key = str(token).upper()
+        if key == 'ALL':
+            return set(uid_set), position + 1
+        elif key == 'NOT':
+            result, position = self.criterion(tokens, position + 1, uid_set)
+            return uid_set - result, position
+        elif key == 'OR':
+            first, position = self.criterion(tokens, position + 1, uid_set)
+            second, position = self.criterion(tokens, position, uid_set)
+            return first | second, position
+        elif key == 'UID':
+            sequence_set = str(tokens[position + 1])
+            if '*' in sequence_set:
+                raise NotIndexed(key)
+            return (uid_set & set(parse_sequence_set(sequence_set)),
+                position + 2)
+
+        if position + 1 >= len(tokens):
+            raise NotIndexed(key)
+        text = tokens[position + 1]
+        if text is None:
+            text = ''
+        elif not isinstance(text, type(u'')):
+            text = str(text)
+            if isinstance(text, bytes):
+                text = text.decode('utf-8', 'replace')
+        if key in HEADER_FIELDS:
+            return self.search_field(key, text, uid_set), position + 2
+        elif key == 'BODY':
+            return self.search_body(text, uid_set), position + 2
+        raise NotIndexed(key)
+
+    def criteria(self, tokens, uid_set):
+        '''Evaluates a list of search keys, all of them must match.
+        '''
+        result = set(uid_set)
+        position = 0
+        while position < len(tokens):
+            matches, position = self.criterion(tokens, position, uid_set)
+            result &= matches
+        return result
+
+    def search(self, expression, uid_list):
+        key = (expression, len(uid_list), uid_list and uid_list[-1] or 0)
+        if key in self.results:
+            return self.results[key]
+        tokens = parse_response(expression)
+        if tokens and str(tokens[0]).upper() == 'CHARSET':
+            tokens = tokens[2:]
+        uid_set = set(uid_list)
+        result = sorted(self.criteria(tokens, uid_set))
+        if len(self.results) >= RESULT_CACHE_SIZE:
+            self.results.clear()
+        self.results[key] = result
+        return result
+
+class SearchIndex(object):
+    '''Local search index for all the mailboxes of an account.
+    '''
+
+    def __init__(self, index_text=False):
+        '''
+        @param index_text: index the text parts read from the server too
+        '''
+        self.index_text = index_text
+        self.lock = threading.RLock()
+        # { mailbox: MailboxIndex, ... }
+        self.mailboxes = {}
+
+    def mailbox(self, mailbox, uid_validity):
+        '''Returns the index of a mailbox, a new one if the UIDVALIDITY
+        changed.
+        '''
+        index = self.mailboxes.get(mailbox)
+        if index is None or index.uid_validity != uid_validity:
+            index = self.mailboxes[mailbox] = MailboxIndex(uid_validity)
+        return index
+
+    def add_envelopes(self, mailbox, uid_validity, envelope_dict):
+        '''Adds messages to the index.
+
+        @param envelope_dict: dict in the form { UID: envelope, ... }
+        '''
+        with self.lock:
+            index = self.mailbox(mailbox, uid_validity)
+            for uid, envelope in envelope_dict.items():
+                index.add_envelope(uid, envelope)
+
+    def add_text(self, mailbox, uid_validity, uid, text, html=False):
+        '''Adds the text of a message part to the index. BODY is only
+        answered locally for the messages added with L{add_source}.
+
+        @param html: the text is an HTML document
+        '''
+        if not self.index_text:
+            return
+        if html:
+            text = html_text(text)
+        with self.lock:
+            self.mailbox(mailbox, uid_validity).add_text(uid, text)
+
+    def add_source(self, mailbox, uid_validity, uid, source):
+        '''Adds the text of all the text parts of a message to the index.
+
+        @param source: message source, octets
+        '''
+        if not self.index_text:
+            return
+        with self.lock:
+            if uid in self.mailbox(mailbox, uid_validity).text_uids:
+                return
+        text_list = message_text(source)
+        with self.lock:
+            self.mailbox(mailbox, uid_validity).add_message(uid, text_list)
+
+    def missing(self, mailbox, uid_validity, uid_list):
+        '''Returns the UIDs whose envelopes are not on the index.
+        '''
+        with self.lock:
+            uids = self.mailbox(mailbox, uid_validity).uids
+            return [ uid for uid in uid_list if uid not in uids ]
+
+    def remove(self, mailbox, uid_list):
+        with self.lock:
+            index = self.mailboxes.get(mailbox)
+            if index is not None:
+                index.remove(uid_list)
+
+    def search(self, mailbox, uid_validity, expression, uid_list):
+        '''Evaluates a search expression.
+
+        @param uid_list: UIDs of all the messages on the mailbox, they must
+            be on the index, see L{missing}
+        @return: sorted list of UIDs, or None if the expression can't be
+            evaluated locally.
+        '''
+        with self.lock:
+            index = self.mailbox(mailbox, uid_validity)
+            try:
+                return index.search(expression, uid_list)
+            except (NotIndexed, IndexError):
+                return None
@@ -25,15 +25,30 @@
 #
 
 import socket
-from imapfolder import FolderTree
-from imaplibii.imapp import IMAP4P
+from .imapfolder import FolderTree
+from .imapext import enable, ExtensionError
+from .imapinstrument import Instrumentation
+try:
+    from imaplibii.imapp import IMAP4P
+except ImportError as error:
+    # Without imaplibii a connection_class has to be given. Any other
+    # import error is a real one (Python 2 has no ImportError.name, only
+    # the message).
+    missing = getattr(error, 'name', None) or str(error).split()[-1]
+    if missing.split('.')[0] != 'imaplibii':
+        raise
+    IMAP4P = None
 
 class NoFolderListError(Exception): pass
 class NoSuchFolder(Exception): pass
+class NoConnectionClass(Exception): pass
 
 class ImapServer(object):
     '''Establishes the server connection, and does the authentication.
     '''
+    # Class of the IMAP connections, it can be replaced by any class with
+    # the IMAP4P interface, for instance the fake server on benchmarks/
+    connection_class = IMAP4P
 
     def __init__(self, host='localhost', port=None, ssl=False,
         keyfile=None, certfile=None):
@@ -48,8 +63,11 @@ class ImapServer(object):
         '''
         object.__init__(self)
 
+        if self.connection_class is None:
+            self.connected = False
+            raise NoConnectionClass('imaplibii is not installed')
         try:
-            self._imap = IMAP4P(host=host, port=port, ssl=ssl,
+            self._imap = self.connection_class(host=host, port=port, ssl=ssl,
                 keyfile=keyfile,certfile=certfile,  autologout=False )
             self.connected = True
         except socket.gaierror:
@@ -59,6 +77,18 @@ class ImapServer(object):
         self.special_folders = []
         self.expand_list = []
         self.folder_tree = None
+        self.envelope_cache = None
+        self.body_cache = None
+        self.search_index = None
+        # Can several threads work on the folders at the same time?
+        self.concurrent = False
+
+        # Observers of the commands sent, see add_observer
+        self.instrumentation = Instrumentation()
+
+        # Extensions enabled on the connection
+        self.enabled = []
+        self.condstore = False
 
     # IMAP methods
     def login(self, username, password):
@@ -70,7 +100,109 @@ class ImapServer(object):
         @return: it returns the LOGIN imap4 command response on the format
             defined on the imaplibii library.
         '''
-        return self._imap.login(username, password)
+        result = self._imap.login(username, password)
+        self.enable_extensions()
+        return result
+
+    def enable_extensions(self):
+        '''Enables the extensions that change the server behavior, this has
+        to be done before selecting a mailbox.
+
+        With CONDSTORE (RFC 7162) the folders are resynchronized
+        incrementally when selected again, see L{Folder.resync}. QRESYNC is
+        never enabled, imaplibii doesn't understand the VANISHED responses
+        that replace EXPUNGE once it is.
+        '''
+        try:
+            self.enabled = enable(self._imap, 'CONDSTORE')
+        except ExtensionError:
+            self.enabled = []
+        # CONDSTORE is enabled implicitly by the first CHANGEDSINCE, but
+        # without ENABLE the SELECT command doesn't send HIGHESTMODSEQ
+        self.condstore = 'CONDSTORE' in self.enabled
+
+    # Instrumentation
+
+    def add_observer(self, observer):
+        '''Registers an observer of the commands sent to the server, see
+        L{imapinstrument<imapinstrument>}. Register it before the login to
+        see the LOGIN command too.
+
+        @param observer: callable, called as observer(event) after each
+            command with a L{CommandEvent<imapinstrument.CommandEvent>},
+            for instance a L{MetricsSink<imapinstrument.MetricsSink>}
+        '''
+        self.instrumentation.add(observer)
+        self._imap = self.instrumentation.wrap(self._imap)
+
+    def remove_observer(self, observer):
+        '''Removes an observer. Without observers the connections are not
+        wrapped anymore.
+        '''
+        self.instrumentation.remove(observer)
+        if not self.instrumentation.observers:
+            self._imap = self.instrumentation.unwrap(self._imap)
+
+    def instrument(self, imap):
+        '''Returns the connection to use, wrapped if there are observers.
+        '''
+        if self.instrumentation.observers:
+            return self.instrumentation.wrap(imap)
+        return imap
+
+    # Connections
+
+    def connection(self, folder=None):
+        '''Returns the IMAP4P instance to use with a folder. There's only
+        one connection here, see L{PooledImapServer<imappool.PooledImapServer>}
+        for a server with several connections.
+        '''
+        return self._imap
+
+    def select_folder(self, folder):
+        '''Selects a folder, closing the previously selected one.
+        '''
+        tree = self.folder_tree
+        if tree.selected and self._imap.has_capability('UNSELECT'):
+            self._imap.unselect()
+            tree.selected = None
+        tree.selected = folder.select()
+
+    def release(self):
+        '''Releases the connections used by the current thread. Nothing to
+        do when there's only one connection.
+        '''
+        pass
+
+    # Caches
+
+    def set_envelope_cache(self, cache):
+        '''Defines a persistent cache for the message envelopes and sizes,
+        see L{imapcache<imapcache>}. With the cache only the flags are
+        fetched for messages already seen.
+
+        @param cache: L{EnvelopeCache<imapcache.EnvelopeCache>} instance, or
+            None to disable the cache.
+        '''
+        self.envelope_cache = cache
+
+    def set_body_cache(self, cache):
+        '''Defines a cache for the message sources, parts and body
+        structures, shared by all the messages, see
+        L{BodyCache<imapcache.BodyCache>}.
+
+        @param cache: BodyCache instance, or None to disable the cache.
+        '''
+        self.body_cache = cache
+
+    def set_search_index(self, index):
+        '''Defines a local index used to search the messages without asking
+        the server, see L{imapsearch<imapsearch>}.
+
+        @param index: L{SearchIndex<imapsearch.SearchIndex>} instance, or
+            None to always search on the server.
+        '''
+        self.search_index = index
 
     # Folder list management
 
@@ -86,14 +218,17 @@ class ImapServer(object):
         '''
         self.expand_list = folder_list
 
-    def refresh_folders(self, subscribed = True):
+    def refresh_folders(self, subscribed = True, lazy = False):
         '''This method extracts the folder list from the
         server.
+
+        @param lazy: list the sub folders only when needed, see
+            L{FolderTree.refresh_folders<imapfolder.FolderTree.refresh_folders>}
         '''
         if not self.folder_tree:
             self.folder_tree = FolderTree( self )
 
-        self.folder_tree.refresh_folders( subscribed )
+        self.folder_tree.refresh_folders( subscribed, lazy )
 
         self.folder_tree.set_properties(self.expand_list,
                                         self.special_folders)
@@ -0,0 +1,570 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of hlimap.
+##
+## hlimap is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## hlimap is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+
+'''High Level IMAP Lib - client side sorting
+
+This module is part of the hlimap lib.
+
+Notes
+=====
+
+When the server does not have the SORT extension we have to sort the
+messages our selfs. The rules used are the ones defined on RFC 5256, so that
+the result is the same we would get from the server:
+
+    * ARRIVAL - the INTERNALDATE of the message;
+    * CC, FROM, TO - the addr-mailbox of the first address, compared
+      using the i;ascii-casemap collation;
+    * DATE - the Date: header, normalized to UTC. If the header is missing
+      or can't be parsed, the INTERNALDATE is used instead;
+    * SIZE - the RFC822.SIZE of the message;
+    * SUBJECT - the base subject, as defined on section 2.1 of the RFC.
+
+Messages that match exactly on all the sort criteria are kept on the
+mailbox order (which is the same as the UID order).
+
+New messages are placed on a list already sorted with a binary search, see
+L{insert_positions}, only the keys of the messages compared are fetched.
+
+To keep things fast on big folders we only fetch the attributes needed by the
+sort program, in large batches, and we compute a compact key for each
+message only once. The sort it self is then done on a list of integer
+indexes.
+'''
+
+# Imports
+import re
+import time
+import calendar
+from email.header import decode_header
+from email.utils import parsedate_tz, mktime_tz, getaddresses
+
+# Exceptions:
+
+class SortProgError(Exception): pass
+
+# Constants:
+
+SORT_KEYS = ( 'ARRIVAL', 'CC', 'DATE', 'FROM', 'SIZE', 'SUBJECT', 'TO' )
+
+# Number of messages fetched on each FETCH command
+BATCH_SIZE = 5000
+
+# Message attributes needed by each sort key, apart from the headers
+KEY_ITEMS = {
+    'ARRIVAL': ('INTERNALDATE',),
+    'DATE':    ('INTERNALDATE',),
+    'SIZE':    ('RFC822.SIZE',),
+    }
+
+# Headers needed by each sort key
+KEY_HEADERS = {
+    'CC':      'CC',
+    'DATE':    'DATE',
+    'FROM':    'FROM',
+    'SUBJECT': 'SUBJECT',
+    'TO':      'TO',
+    }
+
+_WSP = re.compile(r'\s+')
+_TRAILER = re.compile(r'(?:\(fwd\)|\s)$', re.I)
+_LEADER = re.compile(r'^(?:(?:\[[^\[\]]*\]\s*)*(?:re|fwd?)\s*'
+                     r'(?:\[[^\[\]]*\]\s*)?:|\s)', re.I)
+_BLOB = re.compile(r'^\[[^\[\]]*\]\s*')
+
+_DATE = re.compile(r'\s*(?:[a-z]{3},\s*)?(\d{1,2})\s+([a-z]{3})\s+(\d{4})\s+'
+                   r'(\d{1,2}):(\d{2})(?::(\d{2}))?\s+([+-])(\d{2})(\d{2})', re.I)
+_MONTHS = dict((name, number + 1) for number, name in enumerate(('jan',
+    'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov',
+    'dec')))
+_ADDRESS = re.compile(r'(?:[^<>",]*<([^<>@",\s]+)@[^<>]*>|'
+                      r'\s*([^<>@",\s]+)@[^<>",\s]+)\s*(?:,|$)')
+
+_ASCII_UPPER = dict((c, c - 32) for c in range(ord('a'), ord('z') + 1))
+
+# Utils
+
+def casemap(text):
+    '''i;ascii-casemap collation, only the ASCII letters are upper cased.
+
+    @param text: unicode, the headers are decoded before, see
+        L{decode_header_text}
+    '''
+    return text.translate(_ASCII_UPPER)
+
+def decode_header_text(text):
+    '''Decodes the RFC 2047 encoded words on a header, returns unicode.
+    '''
+    if not text:
+        return u''
+    if isinstance(text, bytes):
+        text = text.decode('iso-8859-1')
+    if '=?' not in text:
+        return text
+    parts = []
+    try:
+        decoded = decode_header(text)
+    except Exception:
+        return text
+    for data, charset in decoded:
+        if isinstance(data, bytes):
+            try:
+                data = data.decode(charset or 'iso-8859-1', 'replace')
+            except LookupError:
+                data = data.decode('iso-8859-1', 'replace')
+        parts.append(data)
+    return u''.join(parts)
+
+def parse_header_fields(text):
+    '''Parses the response to a BODY[HEADER.FIELDS (...)] fetch.
+
+    @return: a dict with the lower case header name as key. Only the first
+        instance of each header is kept.
+    '''
+    headers = {}
+    if not text:
+        return headers
+    if isinstance(text, bytes):
+        text = text.decode('iso-8859-1')
+    name = None
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        if line[0] in ' \t':
+            # Folded header
+            if name is not None and headers.get(name) is not None:
+                headers[name] += ' ' + line.strip()
+            continue
+        name, sep, value = line.partition(':')
+        if not sep:
+            name = None
+            continue
+        name = name.strip().lower()
+        if name in headers:
+            # Ignore repeated headers, but not their continuation lines
+            name = None
+            continue
+        headers[name] = value.strip()
+    return headers
+
+def header_text(msg_info):
+    '''Returns the text of the BODY[...] item on a fetch response.
+    '''
+    for name, value in msg_info.items():
+        if name.upper().startswith('BODY['):
+            return value
+    return ''
+
+def extract_subject(subject):
+    '''Extracts the base subject as defined on RFC 5256 section 2.1.
+
+    @return: a tuple (base subject, is reply or forward)
+    '''
+    subject = _WSP.sub(' ', decode_header_text(subject))
+    refwd = False
+    while True:
+        # Remove the subj-trailer
+        while True:
+            stripped = _TRAILER.sub('', subject)
+            if stripped == subject:
+                break
+            if stripped != subject.rstrip():
+                refwd = True
+            subject = stripped
+        # Remove the subj-leader and the subj-blob
+        while True:
+            stripped = _LEADER.sub('', subject, 1)
+            if stripped != subject.lstrip() and stripped != subject:
+                refwd = True
+            blob = _BLOB.match(stripped)
+            if blob and stripped[blob.end():].strip():
+                stripped = stripped[blob.end():]
+            if stripped == subject:
+                break
+            subject = stripped
+        # Remove the subj-fwd-hdr and subj-fwd-trl
+        if subject[:5].lower() == '[fwd:' and subject[-1:] == ']':
+            subject = subject[5:-1]
+            refwd = True
+            continue
+        return subject, refwd
+
+def base_subject(subject):
+    '''Extracts the base subject as defined on RFC 5256 section 2.1.
+    '''
+    return extract_subject(subject)[0]
+
+def address_mailbox(value):
+    '''Returns the addr-mailbox of the first address on an address header.
+    '''
+    if not value:
+        return u''
+    try:
+        addresses = getaddresses([decode_header_text(value)])
+    except Exception:
+        return u''
+    for name, address in addresses:
+        if address:
+            return address.rsplit('@', 1)[0]
+    return u''
+
+_DAYS = {}
+
+def day_value(year, month, day):
+    '''Seconds since the epoch at the start of a day, in UTC.
+    '''
+    key = (year, month, day)
+    try:
+        return _DAYS[key]
+    except KeyError:
+        if len(_DAYS) > 100000:
+            _DAYS.clear()
+        value = _DAYS[key] = calendar.timegm((year, month, day, 0, 0, 0))
+        return value
+
+def date_value(value):
+    '''Converts a Date: header to seconds since the epoch, in UTC.
+
+    @return: None if the date can't be parsed.
+    '''
+    if not value:
+        return None
+    # Fast path for the usual RFC 5322 date format
+    match = _DATE.match(value)
+    if match:
+        day, month, year, hour, minute, second, sign, tzh, tzm = \
+            match.groups()
+        month = _MONTHS.get(month.lower())
+        if month:
+            offset = int(tzh) * 3600 + int(tzm) * 60
+            if sign == '-':
+                offset = -offset
+            try:
+                day = day_value(int(year), month, int(day))
+            except ValueError:
+                day = None
+            if day is not None:
+                return (day + int(hour) * 3600 + int(minute) * 60 +
+                        int(second or 0) - offset)
+    try:
+        parsed = parsedate_tz(value)
+        if parsed:
+            return mktime_tz(parsed)
+    except (TypeError, ValueError, OverflowError):
+        pass
+    return None
+
+def internaldate_value(value):
+    '''Converts an INTERNALDATE to seconds since the epoch, in UTC.
+    '''
+    if value is None:
+        return 0
+    if hasattr(value, 'utctimetuple'):
+        if value.tzinfo is None:
+            return calendar.timegm(value.timetuple())
+        return calendar.timegm(value.utctimetuple())
+    if isinstance(value, (tuple, time.struct_time)):
+        return int(time.mktime(value))
+    # '17-Jul-1996 02:44:25 -0700'
+    return date_value(value.strip('"').replace('-', ' ', 2)) or 0
+
+def cached(function):
+    '''Memoizes a one argument function. On mailing list folders the same
+    subjects and addresses show up over and over.
+    '''
+    cache = {}
+    def convert(value):
+        try:
+            return cache[value]
+        except KeyError:
+            result = cache[value] = function(value)
+            return result
+        except TypeError:
+            return function(value)
+    return convert
+
+# Sort keys
+
+def subject_key(value):
+    return casemap(base_subject(value or u''))
+
+def address_key(value):
+    if value and '=?' not in value:
+        # Fast path for the usual address formats
+        match = _ADDRESS.match(value)
+        if match:
+            return casemap(match.group(1) or match.group(2))
+    return casemap(address_mailbox(value))
+
+def key_builders(keys):
+    '''Returns a list of functions that build the key for each message from
+    the fetch response and the parsed headers. The functions are on the same
+    order as keys.
+    '''
+    builders = []
+    for key in keys:
+        if key == 'ARRIVAL':
+            arrival = cached(internaldate_value)
+            def build(msg_info, headers, arrival=arrival):
+                return arrival(msg_info.get('INTERNALDATE'))
+        elif key == 'DATE':
+            sent = cached(date_value)
+            arrival = cached(internaldate_value)
+            def build(msg_info, headers, sent=sent, arrival=arrival):
+                value = sent(headers.get('date'))
+                if value is None:
+                    value = arrival(msg_info.get('INTERNALDATE'))
+                return value
+        elif key == 'SIZE':
+            def build(msg_info, headers):
+                return int(msg_info.get('RFC822.SIZE') or 0)
+        elif key == 'SUBJECT':
+            subject = cached(subject_key)
+            def build(msg_info, headers, subject=subject):
+                return subject(headers.get('subject'))
+        else:
+            address = cached(address_key)
+            def build(msg_info, headers, address=address,
+                header=KEY_HEADERS[key].lower()):
+                return address(headers.get(header))
+        builders.append(build)
+    return builders
+
+KEY_DEFAULTS = {
+    'ARRIVAL': 0,
+    'CC':      u'',
+    'DATE':    0,
+    'FROM':    u'',
+    'SIZE':    0,
+    'SUBJECT': u'',
+    'TO':      u'',
+    }
+
+# Classes
+
+class FetchedMessages(object):
+    '''Replaces the IMAP4P instance when the messages were fetched
+    beforehand, for instance by the asyncio API. Only fetch_smart is
+    available.
+    '''
+
+    def __init__(self, msg_dict):
+        '''
+        @param msg_dict: dict in the form returned by fetch_smart, it must
+            have all the items needed.
+        '''
+        self.msg_dict = msg_dict
+
+    def fetch_smart(self, message_list, query):
+        return self.msg_dict
+
+class SortKey(object):
+    '''Sort key of a message. The keys compare like the messages on the
+    sorted list: by the sort program, then by UID.
+    '''
+    __slots__ = ( 'values', 'reverse', 'uid' )
+
+    def __init__(self, values, reverse, uid):
+        '''
+        @param values: tuple of key values, on the sort program order
+        @param reverse: tuple of booleans, is each key reversed?
+        '''
+        self.values = values
+        self.reverse = reverse
+        self.uid = uid
+
+    def __lt__(self, other):
+        for value, other_value, reverse in zip(self.values, other.values,
+            self.reverse):
+            if value != other_value:
+                if reverse:
+                    return value > other_value
+                return value < other_value
+        return self.uid < other.uid
+
+# Functions
+
+def parse_sort_program(sort_list):
+    '''Converts a sort program in the form ('-DATE', 'SUBJECT') to a list of
+    (KEY, reverse) tuples.
+    '''
+    program = []
+    for keyword in sort_list:
+        reverse = keyword[0] == '-'
+        if reverse:
+            keyword = keyword[1:]
+        keyword = keyword.upper()
+        if keyword not in SORT_KEYS:
+            raise SortProgError('Sort key unknown.')
+        program.append((keyword, reverse))
+    return program
+
+def sort_query(keys):
+    '''Returns the FETCH query needed to obtain the sort keys.
+    '''
+    items = []
+    headers = []
+    for key in keys:
+        for item in KEY_ITEMS.get(key, ()):
+            if item not in items:
+                items.append(item)
+        header = KEY_HEADERS.get(key)
+        if header and header not in headers:
+            headers.append(header)
+    if headers:
+        items.append('BODY.PEEK[HEADER.FIELDS (%s)]' % ' '.join(headers))
+    return '(%s)' % ' '.join(items)
+
+def fetch_sort_keys(imap, uid_list, keys, batch_size=BATCH_SIZE):
+    '''Fetches the sort keys for the messages.
+
+    @param imap: IMAP4P instance
+    @param uid_list: list of message UIDs
+    @param keys: list of sort keys, from SORT_KEYS
+
+    @return: a dict with the key name as key, the values are lists of
+        computed keys on the same order as uid_list.
+    '''
+    keys = [ key for key in SORT_KEYS if key in keys ]
+    columns = dict((key, []) for key in keys)
+    if not keys:
+        return columns
+    functions = [ (columns[key].append, build, KEY_DEFAULTS[key])
+                  for key, build in zip(keys, key_builders(keys)) ]
+    use_headers = [ key for key in keys if key in KEY_HEADERS ]
+    query = sort_query(keys)
+
+    for first in range(0, len(uid_list), batch_size):
+        batch = uid_list[first:first + batch_size]
+        response = imap.fetch_smart(batch, query)
+        for uid in batch:
+            msg_info = response.get(uid)
+            if msg_info is None:
+                # The message was expunged in the mean time
+                for append, function, default in functions:
+                    append(default)
+                continue
+            if use_headers:
+                headers = parse_header_fields(header_text(msg_info))
+            else:
+                headers = {}
+            for append, function, default in functions:
+                append(function(msg_info, headers))
+
+    return columns
+
+def sort_keys(imap, uid_list, program, batch_size=BATCH_SIZE):
+    '''Fetches the sort keys for the messages.
+
+    @param program: the sort program as returned by L{parse_sort_program}
+
+    @return: dict in the form { UID: L{SortKey}, ... }
+    '''
+    keys = [ key for key, reverse in program ]
+    reverse = tuple([ reverse for key, reverse in program ])
+    columns = fetch_sort_keys(imap, uid_list, keys, batch_size)
+    return dict([ (uid, SortKey(tuple([ columns[key][index]
+        for key in keys ]), reverse, uid))
+        for index, uid in enumerate(uid_list) ])
+
+def order_by_keys(count, columns, program):
+    '''Computes the order of the messages.
+
+    @param count: number of messages
+    @param columns: dict of key columns as returned by L{fetch_sort_keys}
+    @param program: the sort program as returned by L{parse_sort_program}
+
+    @return: list of indexes into the key columns, in sorted order.
+    '''
+    order = list(range(count))
+
+    # Group the consecutive keys with the same direction, so that we can
+    # sort with a single pass for each group.
+    groups = []
+    for key, reverse in program:
+        if groups and groups[-1][1] == reverse:
+            groups[-1][0].append(key)
+        else:
+            groups.append(([key], reverse))
+
+    # Python's sort is stable, so we sort from the least significant group
+    # to the most significant one. The ties end up on the original order.
+    for keys, reverse in reversed(groups):
+        if len(keys) == 1:
+            column = columns[keys[0]]
+        else:
+            column = list(zip(*[ columns[key] for key in keys ]))
+        order.sort(key=column.__getitem__, reverse=reverse)
+
+    return order
+
+def sort_messages(imap, message_list, sort_program, batch_size=BATCH_SIZE):
+    '''Sorts a message list client side.
+
+    @param imap: IMAP4P instance
+    @param message_list: list of UIDs, as returned by the SEARCH command
+    @param sort_program: list of sort keys, as used by
+        L{MessageList.set_sort_program}
+
+    @return: the list of UIDs, sorted.
+    '''
+    uid_list = sorted(message_list)
+    program = parse_sort_program(sort_program)
+    columns = fetch_sort_keys(imap, uid_list, [ key for key, reverse
+        in program ], batch_size)
+    return [ uid_list[index] for index in order_by_keys(len(uid_list),
+        columns, program) ]
+
+def insert_positions(imap, uid_list, new_list, sort_program,
+    batch_size=BATCH_SIZE):
+    '''Finds where new messages go on a sorted message list, with a binary
+    search. The searches of all the new messages advance together, each
+    step fetches the keys of the messages compared in one go.
+
+    @param uid_list: list of UIDs, sorted by sort_program
+    @param new_list: list of UIDs to insert, not on uid_list
+    @param sort_program: see L{sort_messages}
+
+    @return: list of (position, UID) tuples, sorted, the message goes
+        before the message on that position of uid_list.
+    '''
+    program = parse_sort_program(sort_program)
+    keys = sort_keys(imap, new_list, program, batch_size)
+    bounds = dict([ (uid, [ 0, len(uid_list) ]) for uid in new_list ])
+    while True:
+        probes = [ (uid, (low + high) // 2)
+                   for uid, (low, high) in bounds.items() if low < high ]
+        if not probes:
+            break
+        missing = sorted(set([ uid_list[middle] for uid, middle in probes
+                               if uid_list[middle] not in keys ]))
+        if missing:
+            keys.update(sort_keys(imap, missing, program, batch_size))
+        for uid, middle in probes:
+            if keys[uid_list[middle]] < keys[uid]:
+                bounds[uid][0] = middle + 1
+            else:
+                bounds[uid][1] = middle
+    return [ (bounds[uid][0], uid) for uid in sorted(new_list,
+        key=lambda uid: (bounds[uid][0], keys[uid])) ]
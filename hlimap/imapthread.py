@@ -0,0 +1,484 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of hlimap.
+##
+## hlimap is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## hlimap is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+
+'''High Level IMAP Lib - client side threading
+
+This module is part of the hlimap lib.
+
+Notes
+=====
+
+When the server does not have the THREAD extension we have to thread the
+messages our selfs. Both algorithms defined on RFC 5256 are available:
+
+    * ORDEREDSUBJECT - the messages are grouped by base subject, the first
+      message of each group is the parent of the others;
+    * REFERENCES - the algorithm by Jamie Zawinski, using the Message-ID,
+      References and In-Reply-To headers.
+
+The result has the same nested list form returned by the imaplibii
+thread_smart method, so that it can be used directly by
+L{threaded_tree<imapmessage.threaded_tree>} and
+L{flaten_nested<imapmessage.flaten_nested>}. For instance::
+
+    S: * THREAD (2)(3 6 (4 23)(44 7 96))
+
+Is represented as::
+
+    [[2], [3, 6, [4, 23], [44, 7, 96]]]
+
+The headers are fetched in large batches and all the tree walks are done
+without recursion, the threads on big mailing list folders can be very deep.
+
+Sorted threads
+--------------
+
+The THREAD command only sorts the threads by date. With L{sort_threads} the
+threads, whether they come from the server or from L{thread_messages}, can
+be ordered using any sort program. Only the sort keys are fetched from the
+server. Optionally each sub thread can be ranked by its most recent message,
+which gives the usual "most recently active thread first" view.
+'''
+
+# Imports
+import re
+
+from .imapsort import BATCH_SIZE, parse_header_fields, header_text, \
+    extract_subject, date_value, internaldate_value, casemap, cached, \
+    parse_sort_program, fetch_sort_keys
+
+# Exceptions:
+
+class ThreadAlgError(Exception): pass
+
+# Constants:
+
+THREAD_ALGORITHMS = ( 'ORDEREDSUBJECT', 'REFERENCES' )
+
+THREAD_QUERY = ('(INTERNALDATE BODY.PEEK[HEADER.FIELDS (MESSAGE-ID REFERENCES '
+                'IN-REPLY-TO SUBJECT DATE)])')
+
+_MSG_ID = re.compile(r'<([^<>\s]+)>')
+
+# Classes
+
+class Container(object):
+    '''A node on the thread tree. Dummy containers have uid set to None.
+    '''
+    __slots__ = ('uid', 'date', 'subject', 'refwd', 'parent', 'children')
+
+    def __init__(self, uid=None):
+        self.uid = uid
+        self.date = 0
+        self.subject = u''
+        self.refwd = False
+        self.parent = None
+        self.children = []
+
+    def is_dummy(self):
+        return self.uid is None
+
+    def is_ancestor_of(self, container):
+        '''Is self an ancestor of container (or container it self)?
+        '''
+        if not self.children:
+            # Avoid walking up long threads
+            return container is self
+        while container is not None:
+            if container is self:
+                return True
+            container = container.parent
+        return False
+
+    def add_child(self, child):
+        if child.parent is not None:
+            child.parent.children.remove(child)
+        child.parent = self
+        self.children.append(child)
+
+    def sort_key(self):
+        '''Dummies are sorted using their first child.
+        '''
+        if self.uid is None and self.children:
+            return self.children[0].sort_key()
+        return (self.date, self.uid)
+
+# Functions
+
+def fetch_thread_info(imap, uid_list, batch_size=BATCH_SIZE):
+    '''Fetches the headers needed to thread the messages.
+
+    @return: an iterator of (uid, headers, sent date) tuples, on the same
+        order as uid_list.
+    '''
+    for first in range(0, len(uid_list), batch_size):
+        batch = uid_list[first:first + batch_size]
+        response = imap.fetch_smart(batch, THREAD_QUERY)
+        for uid in batch:
+            msg_info = response.get(uid)
+            if msg_info is None:
+                # The message was expunged in the mean time
+                continue
+            headers = parse_header_fields(header_text(msg_info))
+            date = date_value(headers.get('date'))
+            if date is None:
+                date = internaldate_value(msg_info.get('INTERNALDATE'))
+            yield uid, headers, date
+
+def thread_subject_info():
+    '''Returns a function to set the date and subject of a container.
+    '''
+    def subject_info(subject):
+        subject, refwd = extract_subject(subject)
+        return casemap(subject), refwd
+    subject_info = cached(subject_info)
+
+    def set_message_info(container, headers, date):
+        container.date = date
+        container.subject, container.refwd = subject_info(
+            headers.get('subject', u''))
+    return set_message_info
+
+def nested_list(root_list):
+    '''Converts a list of root containers to the nested list form.
+    '''
+    threads = []
+    stack = []
+    for root in root_list:
+        thread = []
+        threads.append(thread)
+        stack.append((root, thread))
+        while stack:
+            container, target = stack.pop()
+            while True:
+                if container.uid is not None:
+                    target.append(container.uid)
+                children = container.children
+                if len(children) == 1:
+                    # Single child, the thread continues on the same list
+                    container = children[0]
+                    continue
+                branches = []
+                for child in children:
+                    branch = []
+                    target.append(branch)
+                    branches.append((child, branch))
+                branches.reverse()
+                stack.extend(branches)
+                break
+    return threads
+
+def sort_siblings(root_list):
+    '''Sorts the children of every container by sent date, and then the
+    root list it self.
+    '''
+    stack = [ (container, False) for container in root_list ]
+    while stack:
+        container, visited = stack.pop()
+        if visited:
+            container.children.sort(key=Container.sort_key)
+        elif container.children:
+            # Sort the children before the parent, since the dummies
+            # are sorted using their first child
+            stack.append((container, True))
+            stack.extend([ (child, False) for child in container.children ])
+    root_list.sort(key=Container.sort_key)
+
+def thread_orderedsubject(imap, uid_list, batch_size=BATCH_SIZE):
+    '''ORDEREDSUBJECT threading algorithm, RFC 5256 section 3.
+    '''
+    set_message_info = thread_subject_info()
+    messages = []
+    for uid, headers, date in fetch_thread_info(imap, sorted(uid_list),
+        batch_size):
+        container = Container(uid)
+        set_message_info(container, headers, date)
+        messages.append(container)
+    messages.sort(key=lambda container: (container.subject, container.date,
+        container.uid))
+
+    root_list = []
+    parent = None
+    for container in messages:
+        if parent is not None and parent.subject == container.subject:
+            parent.children.append(container)
+            container.parent = parent
+        else:
+            parent = container
+            root_list.append(container)
+
+    root_list.sort(key=Container.sort_key)
+    return nested_list(root_list)
+
+def thread_references(imap, uid_list, batch_size=BATCH_SIZE):
+    '''REFERENCES threading algorithm, RFC 5256 section 3.
+    '''
+    set_message_info = thread_subject_info()
+    id_table = {}
+    for uid, headers, date in fetch_thread_info(imap, sorted(uid_list),
+        batch_size):
+        # (1) Link the messages
+        message_id = _MSG_ID.findall(headers.get('message-id', u''))
+        message_id = message_id and message_id[0] or None
+        container = id_table.get(message_id)
+        if container is None or container.uid is not None:
+            # Missing or duplicated message id, we have to use an unique id
+            if container is not None or message_id is None:
+                message_id = ('UID', uid)
+            container = Container(uid)
+            id_table[message_id] = container
+        else:
+            container.uid = uid
+        set_message_info(container, headers, date)
+
+        references = _MSG_ID.findall(headers.get('references', u''))
+        if not references:
+            references = _MSG_ID.findall(
+                headers.get('in-reply-to', u''))[:1]
+
+        parent = None
+        for reference in references:
+            ref_container = id_table.get(reference)
+            if ref_container is None:
+                ref_container = id_table[reference] = Container()
+            if (parent is not None and ref_container.parent is None and
+                not ref_container.is_ancestor_of(parent)):
+                parent.add_child(ref_container)
+            parent = ref_container
+
+        if parent is not None and container.is_ancestor_of(parent):
+            parent = None
+        if container.parent is not parent:
+            if container.parent is not None:
+                container.parent.children.remove(container)
+                container.parent = None
+            if parent is not None:
+                parent.add_child(container)
+
+    # (2) Find the root set
+    root = Container()
+    root.children = [ container for container in id_table.values()
+                      if container.parent is None ]
+    # (3) Discard the id table
+    del id_table
+
+    # (4) Prune the dummy messages
+    stack = [ (root, False) ]
+    while stack:
+        container, visited = stack.pop()
+        if not visited:
+            stack.append((container, True))
+            stack.extend([ (child, False) for child in container.children ])
+            continue
+        children = []
+        for child in container.children:
+            if child.uid is None:
+                if not child.children:
+                    continue
+                if container is root and len(child.children) > 1:
+                    children.append(child)
+                    continue
+                # Promote the children
+                for grand_child in child.children:
+                    grand_child.parent = container
+                children.extend(child.children)
+            else:
+                children.append(child)
+        container.children = children
+    root_list = root.children
+    for container in root_list:
+        container.parent = None
+
+    # (5) Sort the root set by sent date, the dummies by their first child.
+    # The subjects are gathered on this order.
+    for container in root_list:
+        if container.uid is None:
+            container.children.sort(key=Container.sort_key)
+    root_list.sort(key=Container.sort_key)
+
+    # (6) Gather together the messages with the same base subject
+    def thread_subject(container):
+        if container.uid is None:
+            container = container.children[0]
+        return container.subject, container.refwd
+
+    subject_table = {}
+    for container in root_list:
+        subject, refwd = thread_subject(container)
+        if not subject:
+            continue
+        old = subject_table.get(subject)
+        if (old is None or
+            (container.uid is None and old.uid is not None) or
+            (old.uid is not None and container.uid is not None and
+             old.refwd and not refwd)):
+            subject_table[subject] = container
+
+    new_root_list = []
+    for container in root_list:
+        subject, refwd = thread_subject(container)
+        old = subject_table.get(subject)
+        if not subject or old is container:
+            new_root_list.append(container)
+            continue
+        if old.uid is None and container.uid is None:
+            for child in container.children:
+                child.parent = old
+            old.children.extend(container.children)
+        elif old.uid is None:
+            old.children.append(container)
+            container.parent = old
+        elif refwd and not old.refwd:
+            old.children.append(container)
+            container.parent = old
+        else:
+            dummy = Container()
+            dummy.children = [ old, container ]
+            old.parent = container.parent = dummy
+            subject_table[subject] = dummy
+    # The dummies on the subject table are preferred, and the non replies
+    # over the replies, so the table message is never made a child of the
+    # current one. It might have been moved to a new dummy though.
+    root_list = []
+    seen = set()
+    for container in new_root_list:
+        if container.parent is not None:
+            container = container.parent
+        if id(container) not in seen:
+            seen.add(id(container))
+            root_list.append(container)
+
+    # (7) Sort the threads
+    sort_siblings(root_list)
+
+    return nested_list(root_list)
+
+def thread_messages(imap, message_list, algorithm='REFERENCES',
+    batch_size=BATCH_SIZE):
+    '''Threads a message list client side.
+
+    @param imap: IMAP4P instance
+    @param message_list: list of UIDs, as returned by the SEARCH command
+    @param algorithm: REFERENCES or ORDEREDSUBJECT
+
+    @return: nested list of UIDs, on the form returned by thread_smart.
+    '''
+    algorithm = algorithm.upper()
+    if algorithm == 'REFERENCES':
+        return thread_references(imap, message_list, batch_size)
+    elif algorithm == 'ORDEREDSUBJECT':
+        return thread_orderedsubject(imap, message_list, batch_size)
+    raise ThreadAlgError('Unknown thread algorithm: %s' % algorithm)
+
+def parse_nested(nested):
+    '''Converts a nested list, as returned by thread_smart, to a list of
+    root containers. The threads without a root message (the server sends
+    them as '((3)(5))') get a dummy root.
+    '''
+    root_list = []
+    for thread in nested:
+        if not thread:
+            continue
+        if type(thread[0]) in (list, tuple):
+            parent = Container()
+            root_list.append(parent)
+        else:
+            parent = None
+        stack = [ (iter(thread), parent) ]
+        while stack:
+            items, parent = stack.pop()
+            for item in items:
+                if type(item) in (list, tuple):
+                    # Branch, the following items are siblings of this one
+                    stack.append((items, parent))
+                    stack.append((iter(item), parent))
+                    break
+                container = Container(item)
+                if parent is None:
+                    root_list.append(container)
+                else:
+                    container.parent = parent
+                    parent.children.append(container)
+                parent = container
+    return root_list
+
+def sort_threads(imap, nested, sort_program, latest=False,
+    batch_size=BATCH_SIZE):
+    '''Sorts the roots and the siblings of a threaded message list.
+
+    @param imap: IMAP4P instance
+    @param nested: nested list of UIDs, on the form returned by thread_smart
+    @param sort_program: list of sort keys, as used by
+        L{MessageList.set_sort_program}
+    @param latest: if True each sub thread is ranked using the keys of its
+        most recent message (by sent date), instead of the keys of its first
+        message.
+
+    @return: nested list of UIDs, on the same form.
+    '''
+    root_list = parse_nested(nested)
+    program = parse_sort_program(sort_program)
+    keys = [ key for key, reverse in program ]
+    if latest and 'DATE' not in keys:
+        keys.append('DATE')
+
+    # Collect the containers, parents first
+    containers = []
+    stack = list(root_list)
+    while stack:
+        container = stack.pop()
+        containers.append(container)
+        stack.extend(container.children)
+
+    uid_list = sorted([ container.uid for container in containers
+                        if container.uid is not None ])
+    columns = fetch_sort_keys(imap, uid_list, keys, batch_size)
+    position = dict((uid, index) for index, uid in enumerate(uid_list))
+
+    # Each container is ranked by a representative message, its own
+    # message, or the most recent one on the sub thread.
+    rank = {}
+    dates = columns.get('DATE')
+    def sort_children(children):
+        children.sort(key=lambda child: rank[id(child)])
+        for key, reverse in reversed(program):
+            column = columns[key]
+            children.sort(key=lambda child: column[rank[id(child)]],
+                reverse=reverse)
+
+    for container in reversed(containers):
+        sort_children(container.children)
+        if container.uid is not None:
+            index = position[container.uid]
+        else:
+            index = rank[id(container.children[0])]
+        if latest:
+            for child in container.children:
+                child_index = rank[id(child)]
+                if (dates[child_index], child_index) > (dates[index], index):
+                    index = child_index
+        rank[id(container)] = index
+    sort_children(root_list)
+
+    return nested_list(root_list)
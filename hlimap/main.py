@@ -35,8 +35,8 @@ Here we make the connection to the server.
 from imaplibii.imapp import IMAP4P
 
 # Local Imports
-from utils import *
-from imapfolder import FolderTree
+from .utils import *
+from .imapfolder import FolderTree
 
 class ImapServer(object):
     '''Establishes the server connection, and does the authentication. 
@@ -35,6 +35,18 @@ Utilities.
 
 import textwrap
 
+from .imapsort import decode_header_text
+
+# Constants
+
+# Maximum length of a sequence set on a command, RFC 7162 section 4
+# recommends to keep the command lines under 8192 octets
+MAX_SET_LENGTH = 8000
+
+# Month names of the IMAP and mbox dates
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep',
+    'Oct', 'Nov', 'Dec')
+
 # Classes
 
 class HLError(Exception): pass
@@ -46,6 +58,95 @@ def quote( str ):
 def quote( str ):
     return '"' + str + '"'
     
+def sequence_ranges(uid_list):
+    '''Collapses the consecutive ids on ranges: [1, 2, 3, 5] gives
+    ['1:3', '5'].
+    '''
+    if not hasattr(uid_list, '__iter__'):
+        # A single id
+        uid_list = [ uid_list ]
+    ids = sorted(set(uid_list))
+    ranges = []
+    index = 0
+    while index < len(ids):
+        first = last = ids[index]
+        index += 1
+        while index < len(ids) and ids[index] == last + 1:
+            last = ids[index]
+            index += 1
+        if first == last:
+            ranges.append('%d' % first)
+        else:
+            ranges.append('%d:%d' % (first, last))
+    return ranges
+
+def sequence_set(uid_list):
+    '''Encodes a list of ids as an IMAP sequence set, the consecutive ids
+    are collapsed on ranges: [1, 2, 3, 5] gives '1:3,5'.
+    '''
+    return ','.join(sequence_ranges(uid_list))
+
+def sequence_sets(uid_list, max_length = MAX_SET_LENGTH):
+    '''Like sequence_set, but split in several sequence sets no longer
+    than max_length, to be used on several commands.
+    '''
+    sets = []
+    current = []
+    length = 0
+    for item in sequence_ranges(uid_list):
+        if current and length + 1 + len(item) > max_length:
+            sets.append(','.join(current))
+            current = []
+        if current:
+            length += 1 + len(item)
+        else:
+            length = len(item)
+        current.append(item)
+    if current:
+        sets.append(','.join(current))
+    return sets
+
+def split_message_list(uid_list, max_length = MAX_SET_LENGTH):
+    '''Splits a list of ids, so that each part written as a comma separated
+    list is no longer than max_length. For the methods that take lists of
+    ids, like imaplibii's fetch_smart.
+    '''
+    parts = []
+    current = []
+    length = 0
+    for uid in uid_list:
+        size = len(str(uid)) + 1
+        if current and length + size > max_length:
+            parts.append(current)
+            current = []
+            length = 0
+        current.append(uid)
+        length += size
+    if current:
+        parts.append(current)
+    return parts
+
+def address_fields(address):
+    '''Returns the name, mailbox and host of an envelope address.
+    '''
+    if isinstance(address, (list, tuple)):
+        return address[0], address[2], address[3]
+    return ( getattr(address, 'addr_name', None),
+             getattr(address, 'addr_mailbox', None),
+             getattr(address, 'addr_host', None) )
+
+def address_text(address_list):
+    '''Text of an envelope address list, 'Name <mailbox@host>, ...'.
+    '''
+    result = []
+    for address in address_list or []:
+        name, mailbox, host = address_fields(address)
+        text = '%s@%s' % (mailbox or '', host or '')
+        if name:
+            text = u'%s <%s>' % (decode_header_text(name), text)
+        result.append(text)
+    return u', '.join(result)
+
 def wrap_lines(text, colnum = 72):
     ln_list = text.split('\n')
     new_list = []
@@ -8,7 +8,11 @@ setup(name='hlimap',
       description="High-level IMAP abstraction library for use with imaplibii",
       long_description="""\
 long_desc _morelater_""",
-      classifiers=[], # Get strings from http://pypi.python.org/pypi?%3Aaction=list_classifiers
+      classifiers=[
+          'Programming Language :: Python :: 2',
+          'Programming Language :: Python :: 2.7',
+          'Programming Language :: Python :: 3',
+          ], # Get strings from http://pypi.python.org/pypi?%3Aaction=list_classifiers
       keywords='imap library',
       author='Helder Guerreiro',
       author_email='hguerreiro@gmail.com',
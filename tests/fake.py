@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of hlimap.
+##
+## hlimap is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## hlimap is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+
+'''Servers connected to the fake server on benchmarks/.
+'''
+
+from hlimap.imapserver import ImapServer
+
+from fakeimap import Account, connection_class, CAPABILITIES
+
+def server_class(capabilities='modern', base=ImapServer, **account_args):
+    '''Returns an ImapServer sub class using the fake server.
+
+    @param capabilities: name of the capability set, see fakeimap, or a
+        list of capabilities
+    @param account_args: Account arguments, 10 folders and 100 messages
+        by default
+    '''
+    if isinstance(capabilities, str):
+        capabilities = CAPABILITIES[capabilities]
+    account_args.setdefault('folders', 10)
+    account_args.setdefault('messages', 100)
+    return type('TestServer', (base,), {
+        'connection_class': connection_class(Account(**account_args),
+            capabilities, 0.0) })
+
+def connect(capabilities='modern', base=ImapServer, **account_args):
+    '''Returns a server, logged in.
+    '''
+    server = server_class(capabilities, base, **account_args)()
+    server.login('user', 'password')
+    return server
+
+class Commands(object):
+    '''Commands received by the fake server of a server class, from the
+    moment this object is created or reset.
+    '''
+
+    def __init__(self, server):
+        self.log = server.connection_class.stats['commands']
+        self.reset()
+
+    def reset(self):
+        self.start = len(self.log)
+
+    def summary(self):
+        '''Totals for each command name.
+
+        @return: dict in the form { command name: { 'count': n,
+            'items': n }, ... }
+        '''
+        summary = {}
+        for command, items in self.log[self.start:]:
+            totals = summary.setdefault(command, { 'count': 0, 'items': 0 })
+            totals['count'] += 1
+            totals['items'] += items
+        return summary
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of hlimap.
+##
+## hlimap is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## hlimap is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+
+'''Scripted IMAP server for the asyncio API tests.
+
+Each command is answered by a handler, called with the command arguments and
+returning the untagged response lines and the tagged response text, for
+instance ([ '* SEARCH 1 2' ], 'OK SEARCH completed').
+'''
+
+import re
+import asyncio
+
+_LITERAL = re.compile(r'\{(\d+)(\+?)\}$')
+
+class ScriptedServer(object):
+    '''Listens on a local port, the commands received are kept on
+    self.commands.
+    '''
+
+    def __init__(self, capabilities, handlers):
+        self.capabilities = capabilities
+        self.handlers = handlers
+        self.commands = []
+        self.literals = []
+        self.server = None
+        self.port = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.session, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def session(self, reader, writer):
+        writer.write(b'* OK scripted server ready\r\n')
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            line = line.decode('latin-1').rstrip('\r\n')
+            # The literals are kept inline, {n}CRLF followed by the data
+            match = _LITERAL.search(line)
+            while match:
+                if not match.group(2):
+                    writer.write(b'+ go ahead\r\n')
+                    await writer.drain()
+                data = await reader.readexactly(int(match.group(1)))
+                self.literals.append(data)
+                rest = (await reader.readline()).decode('latin-1')
+                line += '\r\n%s%s' % (data.decode('latin-1'),
+                    rest.rstrip('\r\n'))
+                match = _LITERAL.search(line)
+            tag, command = line.split(' ', 1)
+            self.commands.append(command)
+            name = command.split(' ')[0].upper()
+            if name == 'UID':
+                name = 'UID ' + command.split(' ')[1].upper()
+            if name == 'CAPABILITY':
+                lines, status = [ '* CAPABILITY %s' % ' '.join(
+                    self.capabilities) ], 'OK done'
+            elif name == 'LOGOUT':
+                lines, status = [ '* BYE' ], 'OK bye'
+            elif name in self.handlers:
+                lines, status = self.handlers[name](command.split(' ')[
+                    name.count(' ') + 1:])
+            else:
+                lines, status = [], 'OK done'
+            for response in lines:
+                writer.write(('%s\r\n' % response).encode('latin-1'))
+            writer.write(('%s %s\r\n' % (tag, status)).encode('latin-1'))
+            await writer.drain()
+            if name == 'LOGOUT':
+                break
+        writer.close()
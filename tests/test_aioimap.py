@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of hlimap.
+##
+## hlimap is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## hlimap is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+
+'''asyncio API: the methods of the blocking classes that talk with the
+server are coroutines on the async ones.
+'''
+
+import io
+import asyncio
+
+from hlimap.aioimap import AsyncImapServer
+from hlimap.imapquery import FROM, UNSEEN
+from hlimap.imapmessage import UNSORTED
+
+from .scripted import ScriptedServer
+
+SOURCE = 'Subject: a\r\n\r\nHello world'
+
+def fetch_response(uid):
+    return ('* %d FETCH (UID %d FLAGS (%s) RFC822.SIZE %d ENVELOPE (NIL '
+        '"Message %d" NIL NIL NIL NIL NIL NIL NIL "<%d@example.com>"))' % (
+        uid, uid, uid == 1 and r'\Seen' or '', 100 + uid, uid, uid))
+
+def uid_fetch(args):
+    if args[1].startswith('(BODY.PEEK['):
+        # Partial fetch of the source, in chunks of 8 octets
+        offset = int(args[1].split('<')[1].split('.')[0])
+        data = SOURCE[offset:offset + 8]
+        return ([ '* %s FETCH (UID %s BODY[]<%d> {%d}\r\n%s)' % (args[0],
+            args[0], offset, len(data), data) ], 'OK done')
+    if args[1] == '(BODY[1])':
+        return ([ '* %s FETCH (UID %s BODY[1] {5}\r\nHello)' % (args[0],
+            args[0]) ], 'OK done')
+    return ([ fetch_response(uid) for uid in (1, 2, 3) ], 'OK done')
+
+def uid_search(args):
+    if args[0] == 'UNSEEN':
+        return ([ '* SEARCH 2 3' ], 'OK done')
+    return ([ '* SEARCH 1 2 3' ], 'OK done')
+
+def handlers():
+    return {
+        'LSUB': lambda args: ([ '* LSUB () "/" INBOX',
+                                '* LSUB () "/" Archive' ], 'OK done'),
+        'SELECT': lambda args: ([ '* 3 EXISTS', '* 0 RECENT',
+            r'* FLAGS (\Seen \Deleted)', '* OK [UIDVALIDITY 7] ok',
+            '* OK [UIDNEXT 4] ok' ], 'OK [READ-WRITE] done'),
+        'STATUS': lambda args: ([ '* STATUS %s (MESSAGES 3 RECENT 0 '
+            'UIDNEXT 4 UIDVALIDITY 7 UNSEEN 2)' % args[0] ], 'OK done'),
+        'UID SEARCH': uid_search,
+        'UID FETCH': uid_fetch,
+        'UID COPY': lambda args: ([], 'OK [COPYUID 9 1:2 11:12] done'),
+        'UID STORE': lambda args: ([ '* 1 FETCH (UID %s FLAGS (\\Seen))' %
+            args[0].split(':')[0] ], 'OK done'),
+        'APPEND': lambda args: ([], 'OK [APPENDUID 9 20] done'),
+        }
+
+def run(capabilities, test):
+    async def main():
+        scripted = await ScriptedServer(capabilities, handlers()).start()
+        server = AsyncImapServer('127.0.0.1', scripted.port)
+        try:
+            await server.login('user', 'password')
+            await server.refresh_folders()
+            await test(server, scripted)
+        finally:
+            await server.logout()
+            await scripted.stop()
+    asyncio.run(main())
+
+def folder(server, path):
+    return server.folder_tree.folder_dict[path]['data']
+
+def test_server_attributes():
+    server = AsyncImapServer()
+    assert server.body_cache is None
+    assert server.search_index is None
+    assert server.envelope_cache is None
+
+def test_folders_and_messages():
+    async def test(server, scripted):
+        assert [ item.path async for item in server.iter_folders() ] == [
+            'Archive', 'INBOX' ]
+        await server.folder_tree.refresh_status()
+        assert await folder(server, 'Archive').unseen() == 2
+        inbox = await server.get_folder('INBOX')
+        msg_list = inbox.message_list
+        msg_list.show_style = UNSORTED
+        messages = [ message async for message in inbox ]
+        assert [ message.uid for message in messages ] == [ 1, 2, 3 ]
+        assert messages[0].seen and not messages[1].seen
+        assert [ command for command in scripted.commands
+                 if command.startswith('STATUS') ] == [
+            'STATUS "Archive" (MESSAGES RECENT UIDNEXT UIDVALIDITY UNSEEN)',
+            'STATUS "INBOX" (MESSAGES RECENT UIDNEXT UIDVALIDITY UNSEEN)' ]
+    run([ 'IMAP4rev1' ], test)
+
+def test_write_source():
+    async def test(server, scripted):
+        inbox = await server.get_folder('INBOX')
+        message = await inbox.get_message(2)
+        output = io.BytesIO()
+        assert await message.write_source(output, chunk_size=8) == 25
+        assert output.getvalue() == SOURCE.encode('latin-1')
+        assert 'UID FETCH 2 (BODY.PEEK[]<24.8>)' in scripted.commands
+    run([ 'IMAP4rev1' ], test)
+
+class TextPart(object):
+    media = 'TEXT'
+    media_subtype = 'PLAIN'
+    body_fld_enc = '7BIT'
+
+    def query(self):
+        return 'BODY[1]'
+
+    def charset(self):
+        return None
+
+def test_part_without_charset():
+    async def test(server, scripted):
+        inbox = await server.get_folder('INBOX')
+        message = await inbox.get_message(2)
+        assert await message.part(TextPart()) == u'Hello'
+    run([ 'IMAP4rev1' ], test)
+
+def test_concurrent_searches():
+    async def test(server, scripted):
+        await server.get_folder('INBOX')
+        unseen, everything = await asyncio.gather(
+            server._imap.search('UNSEEN'), server._imap.search('ALL'))
+        # Each search gets only its own results
+        assert unseen == [ 2, 3 ]
+        assert everything == [ 1, 2, 3 ]
+    run([ 'IMAP4rev1' ], test)
+
+def test_move_without_move_extension():
+    async def test(server, scripted):
+        inbox = await server.get_folder('INBOX')
+        uid_map = await inbox.move_to(folder(server, 'Archive'), [ 1, 2 ])
+        assert uid_map == { 1: 11, 2: 12 }
+        assert 'UID COPY 1:2 "Archive"' in scripted.commands
+        assert r'UID STORE 1:2 +FLAGS.SILENT (\Deleted)' in scripted.commands
+        assert 'UID EXPUNGE 1:2' in scripted.commands
+    run([ 'IMAP4rev1', 'UIDPLUS' ], test)
+
+def test_move_extension():
+    async def test(server, scripted):
+        inbox = await server.get_folder('INBOX')
+        await inbox.move_to(folder(server, 'Archive'), [ 3 ])
+        assert 'UID MOVE 3 "Archive"' in scripted.commands
+        assert not [ command for command in scripted.commands
+                     if command.startswith('UID STORE') ]
+    run([ 'IMAP4rev1', 'UIDPLUS', 'MOVE' ], test)
+
+def test_move_from_a_folder_not_selected():
+    async def test(server, scripted):
+        inbox = await server.get_folder('INBOX')
+        archive = await server.get_folder('Archive')
+        await inbox.move_to(archive, [ 3 ])
+        commands = [ command for command in scripted.commands
+                     if command.startswith(('SELECT', 'UID MOVE')) ]
+        assert commands[-2:] == [ 'SELECT "INBOX"', 'UID MOVE 3 "Archive"' ]
+    run([ 'IMAP4rev1', 'UIDPLUS', 'MOVE' ], test)
+
+def test_store_flags():
+    async def test(server, scripted):
+        inbox = await server.get_folder('INBOX')
+        changed = await inbox.set_flags([ 2, 3 ], r'\Seen')
+        assert r'UID STORE 2:3 +FLAGS.SILENT (\Seen)' in scripted.commands
+        assert changed == { 2: [ r'\Seen' ] }
+    run([ 'IMAP4rev1' ], test)
+
+def test_import_messages():
+    async def test(server, scripted):
+        archive = folder(server, 'Archive')
+        progress = []
+        uid_list = await archive.import_messages([ (b'Subject: a\r\n\r\nA',
+            [ r'\Seen' ], '17-Jul-1996 02:44:25 +0000') ],
+            progress=lambda *totals: progress.append(totals))
+        assert uid_list == [ (9, 20) ]
+        assert progress == [ (1, 15) ]
+        assert scripted.literals == [ b'Subject: a\r\n\r\nA' ]
+        assert [ command for command in scripted.commands
+                 if command.startswith('APPEND') ] == [
+            'APPEND "Archive" (\\Seen) "17-Jul-1996 02:44:25 +0000" '
+            '{15}\r\nSubject: a\r\n\r\nA' ]
+    run([ 'IMAP4rev1', 'UIDPLUS' ], test)
+
+def test_append_text_message():
+    async def test(server, scripted):
+        await folder(server, 'Archive').append(u'Subject: Jos\xe9\n\nA')
+        assert scripted.literals == [ b'Subject: Jos\xc3\xa9\r\n\r\nA' ]
+    run([ 'IMAP4rev1', 'UIDPLUS' ], test)
+
+def test_async_synchronizing_literals():
+    handlers = {
+        'SELECT': lambda args: ([ '* 3 EXISTS' ], 'OK done'),
+        'LSUB': lambda args: ([ '* LSUB () "/" INBOX' ], 'OK done'),
+        'UID SEARCH': lambda args: ([ '* SEARCH 2' ], 'OK done'),
+        }
+    async def main():
+        scripted = await ScriptedServer([ 'IMAP4rev1' ], handlers).start()
+        server = AsyncImapServer('127.0.0.1', scripted.port)
+        try:
+            await server.login('user', 'password')
+            folder = await server.get_folder('INBOX')
+            msg_list = folder.message_list
+            msg_list.show_style = UNSORTED
+            msg_list.set_search_expression(FROM(u'Jos\xe9') & UNSEEN)
+            await msg_list.refresh_messages()
+            assert list(msg_list.flat_message_list) == [ 2 ]
+            assert scripted.literals == [ b'Jos\xc3\xa9' ]
+            assert 'UID SEARCH CHARSET UTF-8 FROM {5}\r\nJos\xc3\xa9 UNSEEN' \
+                in scripted.commands
+        finally:
+            await server.logout()
+            await scripted.stop()
+    asyncio.run(main())
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of hlimap.
+##
+## hlimap is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## hlimap is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+
+'''The benchmark suite and its fake server.
+'''
+
+import time
+
+from hlimap.imapext import pipeline
+
+import bench_suite
+from fakeimap import Account, DELIMITER
+
+from .fake import connect, server_class
+
+def test_account_folders():
+    account = Account(folders=30, messages=10)
+    assert len(account.names) == 30
+    assert account.names[0] == 'INBOX'
+    assert len(set(account.names)) == 30
+    assert [ name for name in account.names if DELIMITER in name ]
+    assert account.mailbox('INBOX').exists() == 10
+    assert account.mailbox('Folder0001').exists() == 20
+
+def test_messages_generated_from_uid():
+    first = connect(messages=50)
+    second = connect(messages=50)
+    for server in (first, second):
+        server['INBOX']
+    assert first._imap.fetch_smart([ 7, 8 ], '(ENVELOPE FLAGS)') == \
+        second._imap.fetch_smart([ 7, 8 ], '(ENVELOPE FLAGS)')
+
+def test_server_time_and_round_trips():
+    server = connect('sort', messages=50)
+    stats = server.connection_class.stats
+    trips = stats['round_trips']
+    server['INBOX'].message_list.refresh_messages()
+    assert stats['round_trips'] > trips
+    assert stats['server_time'] > 0
+
+def test_pipelined_commands_wait_once():
+    latency = 0.05
+    cls = server_class('imap4rev1', messages=10)
+    cls.connection_class.latency = latency
+    server = cls()
+    server.login('user', 'password')
+    start = time.time()
+    for response in pipeline(server._imap, [ 'NOOP' ] * 5):
+        response.check()
+    assert time.time() - start < 3 * latency
+
+def test_measure():
+    cls = server_class('modern', messages=100)
+    result = bench_suite.measure(cls, bench_suite.refresh_messages,
+        { 'style': bench_suite.SORTED }, 3)
+    assert result['wall']['min'] <= result['wall']['median'] <= \
+        result['wall']['max']
+    assert result['round_trips'] >= 1
+    assert result['client'] >= 0
+
+def test_median():
+    assert bench_suite.median([ 3, 1, 2 ]) == 2
+    assert bench_suite.median([ 4, 1, 2, 3 ]) == 2.5
+
+def test_run_scenario():
+    results = bench_suite.run_scenario('tiny', dict(folders=10,
+        messages=200), 'imap4rev1', 0.0, 1)
+    assert [ result['operation'] for result in results ] == [ name
+        for name, operation, arguments in bench_suite.OPERATIONS ]
+    for result in results:
+        assert result['scenario'] == 'tiny'
+        assert result['repeat'] == 1
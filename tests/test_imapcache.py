@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of hlimap.
+##
+## hlimap is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## hlimap is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+
+'''Envelope and body caches.
+'''
+
+from hlimap.imapcache import SQLiteEnvelopeCache, BodyCache
+
+from .fake import Commands, connect
+
+ENVELOPES = dict([ (uid, (('date', 'subject %d' % uid), 100 + uid))
+                   for uid in range(1, 1201) ])
+
+def envelope_cache(tmp_path):
+    return SQLiteEnvelopeCache(str(tmp_path / 'envelopes.db'))
+
+def test_envelope_cache(tmp_path):
+    cache = envelope_cache(tmp_path)
+    cache.set('INBOX', 7, ENVELOPES)
+    assert cache.get('INBOX', 7, [ 1, 1200, 1201 ]) == {
+        1: ENVELOPES[1], 1200: ENVELOPES[1200] }
+    cache.close()
+    # Persistent, the UIDVALIDITY can be a string
+    cache = envelope_cache(tmp_path)
+    assert len(cache.get('INBOX', '7', range(1, 1201))) == 1200
+
+def test_envelope_cache_validity(tmp_path):
+    cache = envelope_cache(tmp_path)
+    cache.set('INBOX', 7, ENVELOPES)
+    assert cache.get('INBOX', 8, [ 1 ]) == {}
+    assert cache.get('INBOX', 7, [ 1 ]) == {}
+
+def test_envelope_cache_no_validity(tmp_path):
+    cache = envelope_cache(tmp_path)
+    cache.set('INBOX', 7, ENVELOPES)
+    cache.set('INBOX', None, { 1: (('other',), 1) })
+    assert cache.get('INBOX', None, [ 1 ]) == {}
+    # The data cached with a known UIDVALIDITY is kept
+    assert cache.get('INBOX', 7, [ 1 ]) == { 1: ENVELOPES[1] }
+
+def test_envelope_cache_copy(tmp_path):
+    cache = envelope_cache(tmp_path)
+    cache.set('INBOX', 7, ENVELOPES)
+    cache.copy('INBOX', 7, 'Archive', 9, { 1: 10, 2: 11 })
+    assert cache.get('Archive', 9, [ 10, 11, 12 ]) == {
+        10: ENVELOPES[1], 11: ENVELOPES[2] }
+    cache.invalidate('INBOX', [ 1 ])
+    assert cache.get('INBOX', 7, [ 1, 2 ]) == { 2: ENVELOPES[2] }
+
+def test_message_list_envelope_cache(tmp_path):
+    server = connect(messages=60)
+    server.set_envelope_cache(envelope_cache(tmp_path))
+    msg_list = server['INBOX'].message_list
+    msg_list.refresh_messages()
+    subjects = [ message.subject for message in msg_list.msg_iter_page() ]
+    cached = server.envelope_cache.get('INBOX',
+        server['INBOX'].uid_validity(), range(1, 61))
+    assert len(cached) == len(subjects)
+
+    other = connect(messages=60)
+    other.set_envelope_cache(envelope_cache(tmp_path))
+    msg_list = other['INBOX'].message_list
+    msg_list.refresh_messages()
+    assert [ message.subject for message in msg_list.msg_iter_page()
+             ] == subjects
+
+def test_body_cache_lru(tmp_path):
+    cache = BodyCache(10, spill_dir=str(tmp_path / 'spill'),
+        max_spill_bytes=8)
+    cache.set(('INBOX', 7, 1, 'BODY[]'), b'12345')
+    cache.set(('INBOX', 7, 2, 'BODY[]'), b'12345')
+    # Used, so the second one is evicted first
+    assert cache.get(('INBOX', 7, 1, 'BODY[]')) == b'12345'
+    cache.set(('INBOX', 7, 3, 'BODY[]'), b'1234')
+    assert list(cache.entries) == [ ('INBOX', 7, 1, 'BODY[]'),
+                                    ('INBOX', 7, 3, 'BODY[]') ]
+    assert list(cache.spilled) == [ ('INBOX', 7, 2, 'BODY[]') ]
+    # Read back from the disk
+    assert cache.get(('INBOX', 7, 2, 'BODY[]')) == b'12345'
+    assert cache.size <= 10 and cache.spill_size <= 8
+
+def test_source_from_body_cache():
+    server = connect(messages=30)
+    server.set_body_cache(BodyCache())
+    source = server['INBOX'].message_list.get_message(5).source()
+    # Another instance of the message
+    message = server['INBOX'].message_list.get_message(5)
+    metrics = Commands(server)
+    assert message.source() == source
+    assert 'FETCH' not in metrics.summary()
+
+def test_body_cache_copy():
+    cache = BodyCache()
+    cache.set(('INBOX', 7, 1, 'BODY[]'), b'one')
+    cache.set(('INBOX', 7, 2, 'BODY[]'), b'two')
+    # The UIDVALIDITY of the COPYUID and STATUS responses can be strings
+    cache.copy('INBOX', '7', 'Archive', '9', { 1: 20 })
+    assert cache.get(('Archive', 9, 20, 'BODY[]')) == b'one'
+    cache.copy('INBOX', 7, 'Archive', 9, { 2: 21 }, move=True)
+    assert cache.get(('Archive', 9, 21, 'BODY[]')) == b'two'
+    assert cache.get(('INBOX', 7, 2, 'BODY[]')) is None
+    # Nothing to do without the UIDVALIDITY
+    cache.copy('INBOX', 7, 'Archive', None, { 1: 22 })
+    assert len(cache.entries) == 3
+
+def test_body_cache_without_uid_validity():
+    server = connect(folders=4, messages=30)
+    server.set_body_cache(BodyCache())
+    server.refresh_folders(subscribed=False)
+    archive = server.folder_tree.folder_dict['Folder0001']['data']
+    inbox = server['INBOX']
+    message = inbox.message_list.get_message(5)
+    # A server that doesn't send the UIDVALIDITY
+    inbox.status = { 'MESSAGES': 30 }
+    inbox.refresh_status = lambda: None
+    assert message.cache_key('BODY[]') is None
+    message.source()
+    assert not server.body_cache.entries
+    assert inbox.copy_to(archive, [ 5 ]) == { 5: 21 }
+    assert not server.body_cache.entries
+
+def test_moved_message_from_body_cache():
+    server = connect(folders=4, messages=30)
+    server.set_body_cache(BodyCache())
+    server.refresh_folders(subscribed=False)
+    archive = server.folder_tree.folder_dict['Folder0001']['data']
+    inbox = server['INBOX']
+    source = inbox.message_list.get_message(5).source()
+    uid_map = inbox.move_to(archive, [ 5 ])
+    message = server['Folder0001'].message_list.get_message(uid_map[5])
+    metrics = Commands(server)
+    assert message.source() == source
+    assert 'FETCH' not in metrics.summary()
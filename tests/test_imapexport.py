@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of hlimap.
+##
+## hlimap is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## hlimap is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+
+'''Account export.
+'''
+
+import os
+import mailbox
+
+from hlimap.imapexport import AccountExport, Checkpoint, MBOX, MAILDIR
+from hlimap.imappool import PooledImapServer
+
+from .fake import connect
+
+def test_main_connection_selected_again(tmp_path):
+    server = connect(folders=4, folder_messages=7)
+    server.refresh_folders(subscribed=False)
+    inbox = server['INBOX']
+    assert server._imap.selected.name == 'INBOX'
+    export = AccountExport(server, str(tmp_path), connections=4)
+    result = export.run([ server.folder_tree.folder_dict[path]['data']
+                          for path in ('Folder0001', 'Folder0001/Sub0001') ])
+    assert result == { 'Folder0001': 7, 'Folder0001/Sub0001': 7 }
+    assert server._imap.selected.name == 'INBOX'
+    assert server.folder_tree.selected is inbox
+
+def test_main_connection_nothing_selected(tmp_path):
+    server = connect(folders=4, folder_messages=7)
+    server.refresh_folders(subscribed=False)
+    export = AccountExport(server, str(tmp_path))
+    export.run([ server.folder_tree.folder_dict['Folder0001']['data'] ])
+    assert server._imap.selected is None
+    assert server.folder_tree.selected is None
+
+def test_dedicated_connection(tmp_path):
+    server = connect(folders=4, folder_messages=7, base=PooledImapServer)
+    server.refresh_folders(subscribed=False)
+    server._imap.select('INBOX')
+    export = AccountExport(server, str(tmp_path), MAILDIR, connections=1)
+    result = export.run([
+        server.folder_tree.folder_dict['Folder0001']['data'] ])
+    assert result == { 'Folder0001': 7 }
+    assert server._imap.selected.name == 'INBOX'
+    assert len(mailbox.Maildir(str(tmp_path / 'Folder0001'),
+        create=False)) == 7
+
+def test_checkpoint(tmp_path):
+    checkpoint = str(tmp_path / 'checkpoint')
+    server = connect(folders=1, messages=30)
+    server.refresh_folders(subscribed=False)
+    inbox = server.folder_tree.folder_dict['INBOX']['data']
+    destination = tmp_path / 'export'
+    export = AccountExport(server, str(destination), MBOX,
+        checkpoint=checkpoint, batch_size=10)
+    assert export.run([ inbox ]) == { 'INBOX': 30 }
+    state = Checkpoint(checkpoint).folders['INBOX']
+    assert state['last_uid'] == 30
+    assert state['offset'] == os.path.getsize(str(destination / 'INBOX.mbox'))
+
+    # New messages are appended, the ones exported aren't fetched again
+    server._imap.account.mailbox('INBOX').append(5)
+    export = AccountExport(server, str(destination), MBOX,
+        checkpoint=checkpoint, batch_size=10)
+    assert export.run([ inbox ]) == { 'INBOX': 5 }
+    messages = mailbox.mbox(str(destination / 'INBOX.mbox'))
+    assert len(messages) == 35
+
+def test_checkpoint_truncates(tmp_path):
+    checkpoint = str(tmp_path / 'checkpoint')
+    server = connect(folders=1, messages=20)
+    server.refresh_folders(subscribed=False)
+    inbox = server.folder_tree.folder_dict['INBOX']['data']
+    export = AccountExport(server, str(tmp_path), MBOX,
+        checkpoint=checkpoint, batch_size=10)
+    export.run([ inbox ])
+    # Written after the last checkpoint, the export was interrupted
+    target = str(tmp_path / 'INBOX.mbox')
+    size = os.path.getsize(target)
+    with open(target, 'ab') as mbox_file:
+        mbox_file.write(b'From garbage\n')
+    export = AccountExport(server, str(tmp_path), MBOX,
+        checkpoint=checkpoint)
+    assert export.run([ inbox ]) == { 'INBOX': 0 }
+    assert os.path.getsize(target) == size
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of hlimap.
+##
+## hlimap is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## hlimap is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+
+'''Folder operations.
+'''
+
+from hlimap.imapmessage import UNSORTED
+
+from fakeimap import SORT, MODERN
+
+from .fake import Commands, connect
+
+CONDSTORE = SORT + ( 'ENABLE', 'CONDSTORE', 'UIDPLUS' )
+
+def inbox(capabilities=CONDSTORE, **account_args):
+    server = connect(capabilities, **account_args)
+    folder = server['INBOX']
+    folder.message_list.refresh_messages()
+    return server, folder, server._imap.account.mailbox('INBOX')
+
+# CONDSTORE resynchronization
+
+def test_qresync_not_enabled():
+    server = connect(MODERN)
+    assert server.enabled == [ 'CONDSTORE' ]
+    assert server.condstore
+
+def test_resync_new_messages_and_flags():
+    server, folder, mailbox = inbox()
+    msg_list = folder.message_list
+    for message in msg_list.msg_iter_page():
+        pass
+    mailbox.append(3)
+    mailbox.store([ 100 ], [ r'\Flagged' ])
+    server.select_folder(folder)
+    assert not msg_list.refresh
+    assert list(msg_list.flat_message_list) == list(range(103, 0, -1))
+    assert msg_list.message_dict[100]['data'].flagged
+    assert not msg_list.message_dict[100]['data'].seen
+
+def test_resync_expunged_messages():
+    server, folder, mailbox = inbox()
+    msg_list = folder.message_list
+    mailbox.expunge([ 5, 60 ])
+    mailbox.append(1)
+    server.select_folder(folder)
+    assert not msg_list.refresh
+    assert list(msg_list.flat_message_list) == [ uid for uid in
+        range(101, 0, -1) if uid not in (5, 60) ]
+    assert msg_list.number_messages == 99
+
+def test_resync_nothing_changed():
+    server, folder, mailbox = inbox()
+    msg_list = folder.message_list
+    before = list(msg_list.flat_message_list)
+    server.select_folder(folder)
+    assert not msg_list.refresh
+    assert list(msg_list.flat_message_list) == before
+
+# Folder status
+
+def round_trips(server):
+    return server.connection_class.stats['round_trips']
+
+def statuses(server):
+    return dict([ (folder.path, folder.status)
+                  for folder in server.folder_tree.iter_all() ])
+
+def listed_status(folders):
+    server = connect(MODERN, folders=folders)
+    server.refresh_folders(subscribed=False)
+    server.folder_tree.refresh_status()
+    return server
+
+def test_refresh_status_list_status():
+    server = connect(MODERN, folders=30)
+    server.refresh_folders(subscribed=False)
+    before = round_trips(server)
+    server.folder_tree.refresh_status()
+    assert round_trips(server) - before == 1
+    status = statuses(server)
+    assert len(status) == 30
+    assert status['INBOX']['MESSAGES'] == 100
+    assert status['Folder0001/Sub0001']['MESSAGES'] == 20
+    # Answered from the status loaded
+    before = round_trips(server)
+    assert server.folder_tree.folder_dict['INBOX']['data'].messages() == 100
+    assert round_trips(server) == before
+
+def test_refresh_status_pipelined():
+    server = connect(SORT, folders=30)
+    server.refresh_folders(subscribed=False)
+    before = round_trips(server)
+    server.folder_tree.refresh_status()
+    # One per STATUS command, but sent before any response is read
+    assert round_trips(server) - before == 30
+    assert statuses(server) == statuses(listed_status(30))
+
+# Lazy folder tree
+
+def test_lazy_tree_lists_first_level():
+    server = connect(MODERN, folders=30)
+    server.refresh_folders(subscribed=False, lazy=True)
+    tree = server.folder_tree
+    assert sorted(tree.root_folder) == sorted([ name for name in
+        server._imap.account.names if '/' not in name ])
+    assert 'Folder0001/Sub0001' not in tree.folder_dict
+    folder = tree.folder_dict['Folder0001']['data']
+    assert not folder.children_loaded
+    assert tree.folder_dict['INBOX']['data'].children_loaded
+
+def test_lazy_tree_loads_children():
+    server = connect(MODERN, folders=30)
+    server.refresh_folders(subscribed=False, lazy=True)
+    tree = server.folder_tree
+    tree.load_children('Folder0001')
+    assert tree.folder_dict['Folder0001']['children'] == [ name for name in
+        server._imap.account.names if name.startswith('Folder0001/') ]
+    before = round_trips(server)
+    tree.load_children('Folder0001')
+    assert round_trips(server) == before
+
+def test_lazy_tree_iter_all():
+    full = connect(MODERN, folders=30)
+    full.refresh_folders(subscribed=False)
+    server = connect(MODERN, folders=30)
+    server.refresh_folders(subscribed=False, lazy=True)
+    assert [ folder.path for folder in server.folder_tree.iter_all() ] == \
+        [ folder.path for folder in full.folder_tree.iter_all() ]
+
+def test_lazy_tree_status():
+    server = connect(MODERN, folders=30)
+    server.refresh_folders(subscribed=False, lazy=True)
+    before = round_trips(server)
+    server.folder_tree.refresh_status()
+    # Only the folders listed, with STATUS
+    status = server.folder_tree.folder_dict
+    assert round_trips(server) - before == len(status)
+    assert status['INBOX']['data'].status['MESSAGES'] == 100
+
+# Copy and move
+
+def source_and_destination(capabilities, **account_args):
+    server = connect(capabilities, **account_args)
+    server.refresh_folders(subscribed=False)
+    tree = server.folder_tree
+    inbox = server['INBOX']
+    inbox.message_list.refresh_messages()
+    destination = tree.folder_dict['Folder0001']['data']
+    account = server._imap.account
+    return server, inbox, destination, account
+
+def test_copy_uid_map():
+    server, inbox, destination, account = source_and_destination(MODERN)
+    uid_map = inbox.copy_to(destination, [ 3, 1, 2, 10 ])
+    assert uid_map == { 1: 21, 2: 22, 3: 23, 10: 24 }
+    assert account.mailbox('Folder0001').exists() == 24
+    assert account.mailbox('INBOX').exists() == 100
+    assert inbox.message_list.number_messages == 100
+
+def test_copy_from_a_folder_not_selected():
+    server, inbox, destination, account = source_and_destination(MODERN)
+    server.select_folder(destination)
+    metrics = Commands(server)
+    # Only on the source folder
+    uid_map = inbox.copy_to(destination, [ 50, 60 ])
+    assert metrics.summary()['SELECT']['count'] == 1
+    assert uid_map == { 50: 21, 60: 22 }
+    assert account.mailbox('Folder0001').exists() == 22
+
+def test_copy_without_uidplus():
+    server, inbox, destination, account = source_and_destination(SORT)
+    assert inbox.copy_to(destination, [ 1, 2 ]) == {}
+    assert account.mailbox('Folder0001').exists() == 22
+
+def test_copy_split_commands():
+    server, inbox, destination, account = source_and_destination(MODERN,
+        messages=5000)
+    # Every other message, a sequence set too long for one command
+    uid_list = list(range(1, 5001, 2))
+    metrics = Commands(server)
+    uid_map = inbox.copy_to(destination, uid_list)
+    assert sorted(uid_map) == uid_list
+    assert sorted(uid_map.values()) == list(range(21, 2521))
+    assert metrics.summary()['UID COPY']['count'] > 1
+
+def test_move():
+    server, inbox, destination, account = source_and_destination(MODERN)
+    metrics = Commands(server)
+    uid_map = inbox.move_to(destination, [ 5, 6 ])
+    assert uid_map == { 5: 21, 6: 22 }
+    assert list(metrics.summary()) == [ 'UID MOVE' ]
+    assert not account.mailbox('INBOX').present(5)
+    assert 5 not in list(inbox.message_list.flat_message_list)
+    assert inbox.message_list.number_messages == 98
+
+def test_move_without_move_extension():
+    server, inbox, destination, account = source_and_destination(
+        CONDSTORE)
+    metrics = Commands(server)
+    assert inbox.move_to(destination, [ 5, 6 ]) == { 5: 21, 6: 22 }
+    assert sorted(metrics.summary()) == [ 'UID COPY', 'UID EXPUNGE',
+        'UID STORE' ]
+    assert not account.mailbox('INBOX').present(6)
+    assert inbox.message_list.number_messages == 98
+
+def test_move_without_uidplus():
+    server, inbox, destination, account = source_and_destination(SORT)
+    inbox.move_to(destination, [ 5 ])
+    # Only flagged, there's no UID EXPUNGE
+    assert account.mailbox('INBOX').present(5)
+    assert r'\Deleted' in account.mailbox('INBOX').flags(5)
+    assert account.mailbox('Folder0001').exists() == 21
+
+def test_move_updates_destination_list():
+    # Without ESEARCH the whole destination list is known
+    server, inbox, destination, account = source_and_destination(
+        CONDSTORE)
+    server.select_folder(destination)
+    destination_list = destination.message_list
+    destination_list.show_style = UNSORTED
+    destination_list.refresh_messages()
+    server.select_folder(inbox)
+    inbox.move_to(destination, [ 7, 8 ])
+    # Added without selecting the destination
+    assert sorted(destination_list.flat_message_list) == list(range(1, 23))
+    assert destination.status == {}
+    assert destination.messages() == 22
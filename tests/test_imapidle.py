@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of hlimap.
+##
+## hlimap is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## hlimap is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+
+'''Live updates with IDLE.
+'''
+
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from hlimap.imapidle import IdleListener
+from hlimap.imapmessage import UNSORTED
+
+from fakeimap import IMAP4REV1
+
+from .fake import connect
+
+# Without ESEARCH the whole message list is loaded, and the changes are
+# applied to it
+IDLE = IMAP4REV1 + ( 'IDLE', )
+
+def wait_idle(connection, timeout=5):
+    deadline = time.time() + timeout
+    while connection.idling is None:
+        assert time.time() < deadline, 'IDLE not started'
+        time.sleep(0.001)
+
+def test_idle_listener():
+    server = connect(IDLE, messages=20)
+    folder = server['INBOX']
+    msg_list = folder.message_list
+    msg_list.show_style = UNSORTED
+    msg_list.refresh_messages()
+
+    imap = server.connection_class()
+    connection = imap._imap
+    mailbox = imap.account.mailbox('INBOX')
+    listener = IdleListener(folder, imap)
+    received = queue.Queue()
+    listener.subscribe(received.put)
+    listener.start()
+    try:
+        wait_idle(connection)
+        mailbox.append(2)
+        connection.push('* 22 EXISTS')
+        changes = received.get(timeout=5)
+        assert sorted(changes.changed) == [ 21, 22 ]
+        assert changes.exists == 22
+
+        wait_idle(connection)
+        mailbox.expunge([ 3 ])
+        connection.push('* 3 EXPUNGE')
+        # The fourth message is now UID 5
+        connection.push(r'* 4 FETCH (FLAGS (\Seen \Flagged))')
+        changes = received.get(timeout=5)
+        assert changes.vanished == [ 3 ] and changes.exists == 21
+        changes = received.get(timeout=5)
+        assert changes.changed == { 5: [ r'\Seen', r'\Flagged' ] }
+    finally:
+        listener.stop()
+        listener.join(5)
+    assert not listener.is_alive()
+    assert listener.error is None
+
+    # The message list is only changed by apply, on this thread
+    assert 21 not in msg_list.flat_message_list
+    assert len(listener.apply()) == 3
+    assert not msg_list.refresh
+    assert list(msg_list.flat_message_list) == [ uid for uid in range(1, 23)
+                                                 if uid != 3 ]
+    assert folder.status['MESSAGES'] == 21
+    assert listener.apply() == []
+
+def test_idle_restarted_on_timeout():
+    server = connect(IDLE, messages=5)
+    imap = server.connection_class()
+    listener = IdleListener(server['INBOX'], imap, timeout=0.01)
+    listener.start()
+    try:
+        deadline = time.time() + 5
+        while imap._imap.number < 5:
+            assert time.time() < deadline
+            time.sleep(0.001)
+    finally:
+        listener.stop()
+        listener.join(5)
+    assert listener.error is None
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of hlimap.
+##
+## hlimap is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## hlimap is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+
+'''Bulk import.
+'''
+
+import pytest
+
+from hlimap.imapimport import import_messages, mbox_messages, batches, \
+    message_octets
+from hlimap.imappool import PooledImapServer
+
+from .fake import Commands, connect
+
+MESSAGES = [ (b'Subject: %d\r\n\r\nText %d\r\n' % (number, number),
+              [ r'\Seen' ], '17-Jul-1996 02:44:25 +0000')
+             for number in range(1, 8) ]
+
+def inbox(server):
+    return server._imap.account.mailbox('INBOX')
+
+def test_batches():
+    assert [ len(batch) for batch in batches(MESSAGES, 3) ] == [ 3, 3, 1 ]
+    # A message larger than the limit is sent alone
+    assert [ len(batch) for batch in batches(MESSAGES, 10,
+        2 * len(MESSAGES[0][0])) ] == [ 2, 2, 2, 1 ]
+
+@pytest.mark.parametrize('capabilities', [ 'modern', 'imap4rev1' ])
+def test_import_messages(capabilities):
+    server = connect(capabilities, messages=10)
+    progress = []
+    uid_list = import_messages(server._imap, 'INBOX', MESSAGES, 3,
+        progress=lambda *totals: progress.append(totals))
+    assert inbox(server).messages == 17
+    assert progress[-1] == (7, sum([ len(item[0]) for item in MESSAGES ]))
+    if capabilities == 'modern':
+        validity = inbox(server).uid_validity
+        assert uid_list == [ (validity, uid) for uid in range(11, 18) ]
+        assert len(progress) == 3
+    else:
+        # One message at a time, without UIDPLUS
+        assert uid_list == [ (None, None) ] * 7
+        assert len(progress) == 7
+
+def test_message_octets():
+    assert message_octets(u'Subject: Relat\xf3rio\n\nA\r\nB\n') == \
+        b'Subject: Relat\xc3\xb3rio\r\n\r\nA\r\nB\r\n'
+    assert message_octets(b'A\nB') == b'A\r\nB'
+
+@pytest.mark.parametrize('capabilities', [ 'modern', 'imap4rev1' ])
+def test_import_text_messages(capabilities):
+    server = connect(capabilities, messages=10)
+    messages = [ u'Subject: Relat\xf3rio %d\n\nJos\xe9\n' % number
+                 for number in range(3) ]
+    progress = []
+    import_messages(server._imap, 'INBOX', iter(messages), 2,
+        progress=lambda *totals: progress.append(totals))
+    assert inbox(server).messages == 13
+    # The literal sizes are in octets, after the CRLF conversion
+    assert progress[-1] == (3, 3 * len(message_octets(messages[0])))
+    assert server._imap._imap.pending == {}
+
+def test_import_source_error():
+    server = connect(messages=10)
+    def source():
+        for item in MESSAGES[:5]:
+            yield item
+        raise IOError('Truncated mbox')
+    progress = []
+    with pytest.raises(IOError):
+        import_messages(server._imap, 'INBOX', source(), 2,
+            progress=lambda *totals: progress.append(totals))
+    # The commands sent were completed, nothing is left to read
+    assert server._imap._imap.pending == {}
+    assert inbox(server).messages == 14
+    assert progress[-1][0] == 4
+
+def test_mbox_messages(tmp_path):
+    path = tmp_path / 'mbox'
+    path.write_bytes(b'From a@example.com Sat Jan  3 01:05:34 1996\n'
+        b'Subject: one\nStatus: RO\nX-Status: F\n\n>From here\n\n'
+        b'From b@example.com Sun Jan  4 01:05:34 1996\n'
+        b'Subject: two\n\ntext\n')
+    messages = list(mbox_messages(str(path)))
+    assert messages[0] == (b'Subject: one\r\nStatus: RO\r\nX-Status: F\r\n'
+        b'\r\nFrom here\r\n', [ r'\Seen', r'\Flagged' ],
+        '03-Jan-1996 01:05:34 +0000')
+    assert messages[1][0] == b'Subject: two\r\n\r\ntext\r\n'
+
+def test_folder_import_not_selected():
+    server = connect(messages=10, base=PooledImapServer)
+    server.refresh_folders(subscribed=False)
+    folder = server.folder_tree.folder_dict['INBOX']['data']
+    metrics = Commands(server)
+    assert len(folder.import_messages(MESSAGES)) == 7
+    summary = metrics.summary()
+    assert 'APPEND' in summary
+    assert 'SELECT' not in summary
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of hlimap.
+##
+## hlimap is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## hlimap is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+
+'''Compact message index.
+'''
+
+import pytest
+
+from hlimap.imapindex import MessageIndex, MessageDict, NONE
+
+# Two threads: 1 -> 2 -> 3 -> 4 -> 5, and 6 alone
+THREADS = [ [ 1, 2, 3, [ 4, 5 ] ], 6 ]
+
+def test_flat():
+    index = MessageIndex([ 30, 10, 20 ])
+    assert list(index.root_list()) == [ 30, 10, 20 ]
+    assert [ index.position(uid) for uid in (10, 20, 30, 40) ] == [
+        1, 2, 0, NONE ]
+    assert index.children(0) == []
+
+def test_changes():
+    index = MessageIndex([ 30, 10, 20 ])
+    index.data[10] = 'message'
+    index.prefetched.add(10)
+    index.insert([ (0, 40), (2, 15), (3, 5) ])
+    assert list(index.uids) == [ 40, 30, 10, 15, 20, 5 ]
+    index.remove([ 10, 40 ])
+    assert list(index.uids) == [ 30, 15, 20, 5 ]
+    assert index.data == {} and index.prefetched == set()
+    index.extend([ 50 ])
+    assert index.position(50) == 4
+    assert index.position(10) == NONE
+
+def test_threaded():
+    index = MessageIndex(THREADS, threaded=True)
+    assert list(index.root_list()) == [ 1, 6 ]
+    assert index.children(index.position(3)) == [ 4 ]
+    assert [ index.level[index.position(uid)] for uid in range(1, 7) ] == [
+        0, 1, 2, 3, 4, 0 ]
+    # The branches hang from the message before them
+    index = MessageIndex([ 1, [ 2, 3 ], [ 4, 5 ] ], threaded=True)
+    assert list(index.root_list()) == [ 1 ]
+    assert index.children(index.position(1)) == [ 2, 4 ]
+    assert index.children(index.position(2)) == [ 3 ]
+    assert [ index.level[index.position(uid)] for uid in range(1, 6) ] == [
+        0, 1, 2, 1, 2 ]
+    # Repeated messages are ignored
+    assert len(MessageIndex([ 1, [ 2 ], [ 2, 3 ] ], threaded=True)) == 3
+
+def test_message_dict():
+    index = MessageIndex([ 1, [ 2, 3 ], [ 4 ] ], threaded=True)
+    message_dict = MessageDict(index)
+    assert 3 in message_dict and 7 not in message_dict
+    entry = message_dict[4]
+    assert entry['parent'] == 1 and entry['level'] == 1
+    assert message_dict[1]['children'] == [ 2, 4 ]
+    assert message_dict[1]['parent'] is None
+    assert 'data' not in entry
+    entry['data'] = 'message'
+    assert message_dict[4]['data'] == 'message'
+    assert entry.pop('data') == 'message'
+    assert entry.get('data') is None
+    with pytest.raises(KeyError):
+        entry['level'] = 2
+    with pytest.raises(KeyError):
+        message_dict[7]
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of hlimap.
+##
+## hlimap is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## hlimap is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+
+'''Instrumentation.
+'''
+
+import pytest
+
+from hlimap.imapinstrument import MetricsSink, InstrumentedIMAP4P
+from hlimap.imapmessage import SORTED
+
+from .fake import server_class
+
+def test_events():
+    server = server_class(messages=50)()
+    events = []
+    server.add_observer(events.append)
+    server.login('user', 'password')
+    msg_list = server['INBOX'].message_list
+    msg_list.show_style = SORTED
+    list(msg_list.msg_iter_page())
+    commands = [ event.command for event in events ]
+    assert commands[:2] == [ 'LOGIN', 'ENABLE' ]
+    assert 'SELECT' in commands
+    # The raw commands are reported by name
+    assert 'UID SORT' in commands
+    select = events[commands.index('SELECT')]
+    assert select.folder == 'INBOX' and select.items == 50
+    fetch = events[commands.index('FETCH')]
+    assert fetch.folder == 'INBOX' and fetch.items == 50
+    assert all([ event.elapsed >= 0 and event.error is None
+                 for event in events ])
+
+def test_bytes():
+    server = server_class(messages=50)()
+    metrics = MetricsSink()
+    server.add_observer(metrics)
+    server.login('user', 'password')
+    server['INBOX'].message_list.refresh_messages()
+    sort = metrics.summary()['UID SORT']
+    assert sort['count'] == 1
+    assert sort['bytes_out'] > len('UID SORT')
+    assert sort['bytes_in'] > 0
+    metrics.reset()
+    assert metrics.summary() == {}
+
+def test_errors():
+    server = server_class()()
+    metrics = MetricsSink()
+    server.add_observer(metrics)
+    server.login('user', 'password')
+    with pytest.raises(Exception):
+        server._imap.select('No such folder')
+    assert metrics.summary()['SELECT']['errors'] == 1
+    assert server._imap.selected is None
+
+def test_broken_observer():
+    server = server_class()()
+    def observer(event):
+        raise ValueError('Broken')
+    server.add_observer(observer)
+    server.login('user', 'password')
+    assert server['INBOX'].messages() == 100
+
+def test_remove_observer():
+    server = server_class()()
+    connection = server._imap
+    metrics = MetricsSink()
+    server.add_observer(metrics)
+    assert isinstance(server._imap, InstrumentedIMAP4P)
+    server.remove_observer(metrics)
+    assert server._imap is connection
+    # The low level connection is restored too
+    assert not hasattr(connection._imap, 'proxy')
+    server.login('user', 'password')
+    assert metrics.summary() == {}
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of hlimap.
+##
+## hlimap is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## hlimap is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+
+'''Messages.
+'''
+
+import io
+import quopri
+import base64
+
+import pytest
+
+from hlimap.imapmessage import Message, StreamDecoder, octets, FLAG_BITS
+
+from .fake import Commands, connect
+
+try:
+    encodebytes = base64.encodebytes
+except AttributeError:
+    encodebytes = base64.encodestring
+
+def loaded_messages(capabilities='modern', **account_args):
+    server = connect(capabilities, **account_args)
+    folder = server['INBOX']
+    messages = dict([ (message.uid, message)
+                      for message in folder.message_list.msg_iter_page() ])
+    metrics = Commands(server)
+    return server, folder, messages, metrics
+
+# Flags
+
+def test_message_flags():
+    server, folder, messages, metrics = loaded_messages()
+    assert messages[100].flagged and not messages[100].seen
+    assert messages[99].seen and not messages[99].flagged
+
+def test_set_flags_without_fetch():
+    server, folder, messages, metrics = loaded_messages()
+    message = messages[99]
+    message.set_flags(r'\Flagged', r'\Answered')
+    assert message.flagged and message.answered and message.seen
+    assert list(metrics.summary()) == [ 'UID STORE' ]
+    assert metrics.summary()['UID STORE']['count'] == 1
+    assert server._imap.account.mailbox('INBOX').flags(99) == [ r'\Seen',
+        r'\Flagged', r'\Answered' ]
+
+def test_reset_flags():
+    server, folder, messages, metrics = loaded_messages()
+    message = messages[99]
+    message.reset_flags(r'\Seen')
+    assert not message.seen
+    assert server._imap.account.mailbox('INBOX').flags(99) == []
+    assert list(metrics.summary()) == [ 'UID STORE' ]
+
+def test_set_flags_on_several_messages():
+    server, folder, messages, metrics = loaded_messages()
+    folder.set_flags([ 91, 92, 93, 150 ], r'\Deleted')
+    assert messages[91].deleted and messages[92].deleted
+    assert not messages[94].deleted
+    assert metrics.summary()['UID STORE']['count'] == 1
+    folder.reset_flags([ 91, 92 ], r'\Deleted')
+    assert not messages[91].deleted and messages[93].deleted
+    assert 'FETCH' not in metrics.summary()
+
+def test_flags_match_server_after_changes():
+    server, folder, messages, metrics = loaded_messages()
+    folder.set_flags(list(messages), r'\Draft')
+    folder.reset_flags([ 97, 98 ], r'\Seen')
+    mailbox = server._imap.account.mailbox('INBOX')
+    for uid, message in messages.items():
+        flags = [ flag for flag, bit in FLAG_BITS.items()
+                  if message.flag_bits & bit ]
+        assert flags and set(flags) == set(mailbox.flags(uid))
+
+# Message objects
+
+def new_message(folder, subject, sender, flags=()):
+    envelope = [ 'Mon, 2 Jan 2012 10:00:00 +0000', subject, [ sender ],
+        [ sender ], [ sender ], [], None, None, None, '<1@example.com>' ]
+    return Message(folder.server, folder, { 'UID': 1, 'ENVELOPE': envelope,
+        'RFC822.SIZE': 100, 'FLAGS': list(flags) })
+
+def test_message_slots():
+    server, folder, messages, metrics = loaded_messages()
+    message = messages[100]
+    assert not hasattr(message, '__dict__')
+    with pytest.raises(AttributeError):
+        message.other = 1
+    assert message.server is server
+    assert message.size == server._imap.account.mailbox('INBOX').size(100)
+
+def test_flag_bits():
+    server, folder, messages, metrics = loaded_messages()
+    message = new_message(folder, 'Subject', [ None, None, 'a', 'b' ],
+        [ r'\Seen', r'\Draft', '$Label' ])
+    assert message.seen and message.draft
+    assert not (message.deleted or message.answered or message.flagged or
+        message.recent)
+    message.flagged = True
+    message.seen = False
+    assert message.flagged and message.draft and not message.seen
+
+def test_decoded_fields():
+    server, folder, messages, metrics = loaded_messages()
+    message = new_message(folder, '=?utf-8?q?Ol=C3=A1_mundo?=',
+        [ '=?iso-8859-1?q?Jos=E9?=', None, 'jose', 'example.com' ])
+    assert message.subject == u'Olá mundo'
+    assert message.from_name == u'José'
+    assert message.from_address == u'jose@example.com'
+
+def test_decoded_once():
+    server, folder, messages, metrics = loaded_messages()
+    message = new_message(folder, 'First', [ None, None, 'jose',
+        'example.com' ])
+    assert message.from_name == u'jose@example.com'
+    assert message.subject == u'First'
+    message.envelope[1] = 'Second'
+    assert message.subject == u'First'
+
+def test_page_fields():
+    server, folder, messages, metrics = loaded_messages()
+    assert messages[98].subject == u'Re: Topic 96'
+    assert messages[98].from_name == u'Sender 1'
+    assert messages[98].from_address == u'sender1@example.com'
+
+# Streaming
+
+class TextPart(object):
+    media = 'TEXT'
+    media_subtype = 'HTML'
+
+    def __init__(self, encoding):
+        self.body_fld_enc = encoding
+
+    def query(self):
+        return 'BODY[1]'
+
+    def charset(self):
+        return 'utf-8'
+
+@pytest.mark.parametrize('encoding', [ 'QUOTED-PRINTABLE', 'BASE64' ])
+def test_write_part(encoding):
+    server, folder, messages, metrics = loaded_messages(encoding=encoding,
+        text_size=10000)
+    part = TextPart(encoding)
+    output = io.BytesIO()
+    fetched = messages[100].write_part(part, output, chunk_size=1000)
+    assert output.getvalue() == messages[100].part(part)
+    assert fetched == len(server._imap.account.mailbox('INBOX').section(100,
+        '1'))
+    # One FETCH for each chunk, and the last one is shorter
+    assert metrics.summary()['UID FETCH']['count'] == fetched // 1000 + 1
+
+def test_write_source():
+    server, folder, messages, metrics = loaded_messages()
+    output = io.BytesIO()
+    fetched = messages[100].write_source(output, chunk_size=512)
+    assert output.getvalue() == octets(messages[100].source())
+    assert fetched == len(output.getvalue())
+
+@pytest.mark.parametrize('encoding, data', [
+    ( 'BASE64', encodebytes(bytes(bytearray(range(256))) * 3) ),
+    ( 'QUOTED-PRINTABLE', quopri.encodestring(
+        u'Olá mundo, '.encode('utf-8') * 200) ),
+    ( None, b'plain data' * 100 ) ])
+def test_stream_decoder(encoding, data):
+    decoder = StreamDecoder(encoding)
+    # Split anywhere
+    decoded = b''.join([ decoder.decode(data[start:start + 7])
+                         for start in range(0, len(data), 7) ])
+    decoded += decoder.flush()
+    if encoding == 'BASE64':
+        assert decoded == base64.b64decode(data)
+    elif encoding:
+        assert decoded == quopri.decodestring(data)
+    else:
+        assert decoded == data
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of hlimap.
+##
+## hlimap is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## hlimap is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+
+'''Connection pool.
+'''
+
+import time
+import threading
+
+import pytest
+
+from hlimap.imappool import ConnectionPool, PoolExhausted, PooledImapServer
+from .fake import Commands, connect
+
+class Connection(object):
+    def __init__(self, number):
+        self.number = number
+        self.logged_out = False
+
+    def logout(self):
+        self.logged_out = True
+
+def pool(size=2, **kwargs):
+    created = []
+    def factory():
+        created.append(Connection(len(created)))
+        return created[-1]
+    return ConnectionPool(factory, size, **kwargs), created
+
+def test_affinity():
+    connections, created = pool()
+    first = connections.acquire('INBOX')
+    first.selected = 'INBOX'
+    second = connections.acquire('Sent')
+    second.selected = 'Sent'
+    connections.release(first)
+    connections.release(second)
+    assert connections.acquire('Sent') is second
+    assert connections.acquire('INBOX') is first
+    assert len(created) == 2
+
+def test_exhausted():
+    connections, created = pool(wait_timeout=0.05)
+    connections.acquire()
+    connections.acquire()
+    start = time.time()
+    with pytest.raises(PoolExhausted):
+        connections.acquire()
+    assert time.time() - start >= 0.05
+    assert len(created) == 2
+
+def test_wait_for_release():
+    connections, created = pool(size=1, wait_timeout=5)
+    connection = connections.acquire()
+    timer = threading.Timer(0.05, connections.release, (connection,))
+    timer.start()
+    assert connections.acquire() is connection
+    timer.join()
+
+def test_idle_timeout():
+    connections, created = pool(idle_timeout=60)
+    connection = connections.acquire()
+    connections.release(connection)
+    connection.last_used -= 120
+    other = connections.acquire()
+    assert other is not connection
+    assert created[0].logged_out
+    assert connections.connections == [ other ]
+
+def test_discard():
+    connections, created = pool(size=1)
+    connection = connections.acquire()
+    connections.discard(connection)
+    assert created[0].logged_out
+    assert connections.acquire().imap is created[1]
+
+def test_server_affinity():
+    server = connect(folders=4, base=PooledImapServer)
+    metrics = Commands(server)
+    for count in range(2):
+        try:
+            list(server['INBOX'].message_list.msg_iter_page())
+        finally:
+            server.release()
+    # Still selected on the pooled connection, a NOOP gets the changes
+    assert metrics.summary()['SELECT']['count'] == 1
+    assert metrics.summary()['NOOP']['count'] == 1
+
+    # Leased by this thread, another thread gets a new connection
+    server['INBOX']
+    def other():
+        try:
+            server['INBOX'].message_list.refresh_messages()
+        finally:
+            server.release()
+    thread = threading.Thread(target=other)
+    thread.start()
+    thread.join()
+    server.release()
+    assert metrics.summary()['SELECT']['count'] == 2
+    assert len(server.pool.connections) == 2
+    assert [ connection.selected for connection in
+             server.pool.connections ] == [ 'INBOX', 'INBOX' ]
+
+def test_one_lease_per_thread():
+    server = connect(folders=4, base=PooledImapServer)
+    metrics = Commands(server)
+    try:
+        for path in ('INBOX', 'Folder0001', 'INBOX'):
+            server[path].message_list.refresh_messages()
+    finally:
+        server.release()
+    # The folders are selected on the same connection
+    assert len(server.pool.connections) == 1
+    assert metrics.summary()['SELECT']['count'] == 3
+    assert 'NOOP' not in metrics.summary()
+
+def test_noop_changes():
+    # Without CONDSTORE
+    server = connect('sort', folders=4, base=PooledImapServer)
+    try:
+        message_list = server['INBOX'].message_list
+        message_list.refresh_messages()
+    finally:
+        server.release()
+    # A message appended by another connection
+    connection = server.pool.connections[0].imap
+    connection.command_noop = lambda arguments, uid: [ '* 301 EXISTS' ]
+    try:
+        server.select_folder(server['INBOX'])
+    finally:
+        server.release()
+    # Reloaded when needed
+    assert message_list.refresh
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of hlimap.
+##
+## hlimap is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## hlimap is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+
+'''Search queries.
+'''
+
+import datetime
+
+import pytest
+
+from hlimap.imapquery import astring, SUBJECT, FROM, UNSEEN, SINCE, \
+    LARGER, ALL, SEEN, FLAGGED, SMALLER, UID, HEADER, BEFORE, ON, SENTON, \
+    SENTBEFORE, BODY, TEXT, KEYWORD, AND, OR, NOT, Raw, NotEvaluable, Query
+from hlimap.imapext import literal_segments
+from hlimap.imapmessage import UNSORTED
+
+from .fake import Commands, connect
+
+def test_astring():
+    assert astring('report') == '"report"'
+    assert astring(u'Jos\xe9') == '{5}\r\nJos\xc3\xa9'
+    assert astring(u'Jos\xe9', True) == '{5+}\r\nJos\xc3\xa9'
+
+def test_compile():
+    query = SUBJECT('report') & UNSEEN & SINCE(datetime.date(2010, 1, 1))
+    assert query.compile() == 'SUBJECT "report" UNSEEN SINCE 1-Jan-2010'
+    query = FROM(u'Jos\xe9') | LARGER(1000000)
+    assert query.compile() == \
+        'CHARSET UTF-8 OR FROM {5}\r\nJos\xc3\xa9 LARGER 1000000'
+
+def test_abstract_query():
+    with pytest.raises(TypeError):
+        Query()
+
+def test_literal_segments():
+    assert literal_segments('UID SEARCH ALL') == [ 'UID SEARCH ALL' ]
+    # The literal data isn't searched for literals
+    assert literal_segments('SEARCH FROM {5}\r\n{1}\r\n TO {1}\r\nx') == [
+        'SEARCH FROM {5}', '{1}\r\n TO {1}', 'x' ]
+    assert literal_segments('SEARCH FROM {1+}\r\nx') == [
+        'SEARCH FROM {1+}\r\nx' ]
+
+def non_ascii_search(capabilities, show_style=None):
+    server = connect(capabilities, messages=300)
+    metrics = Commands(server)
+    msg_list = server['INBOX'].message_list
+    if show_style:
+        msg_list.show_style = show_style
+    msg_list.set_search_expression(SUBJECT('topic 10') & ~FROM(u'Jos\xe9'))
+    msg_list.refresh_messages()
+    return metrics.summary(), list(msg_list.flat_message_list)
+
+TOPIC_10 = [ uid for uid in range(300, 0, -1)
+             if ('topic %d' % (uid - (uid - 1) % 5)).startswith('topic 10') ]
+
+def test_synchronizing_literals_sort():
+    summary, uid_list = non_ascii_search('sort')
+    assert 'UID SORT' in summary
+    assert uid_list == TOPIC_10
+
+def test_synchronizing_literals_search():
+    summary, uid_list = non_ascii_search('imap4rev1', UNSORTED)
+    assert 'UID SEARCH' in summary
+    assert uid_list == sorted(TOPIC_10)
+
+def test_literal_plus_window():
+    summary, uid_list = non_ascii_search('modern')
+    assert 'UID SORT' in summary
+    assert uid_list == TOPIC_10
+
+# Local evaluation
+
+def msg_info(uid, subject='Report', flags=(), size=1000, sender=None,
+    date='Mon, 2 Jan 2012 10:00:00 +0000',
+    internaldate='03-Jan-2012 10:00:00 +0000'):
+    sender = sender or [ u'Jos\xe9', None, 'jose', 'example.com' ]
+    envelope = [ date, subject, [ sender ], [ sender ], [ sender ],
+        [[ None, None, 'user', 'example.com' ]], None, None, None,
+        '<%d@example.com>' % uid ]
+    return { 'UID': uid, 'ENVELOPE': envelope, 'RFC822.SIZE': size,
+             'FLAGS': list(flags), 'INTERNALDATE': internaldate }
+
+MESSAGES = [
+    msg_info(1, flags=[ '\\Seen' ]),
+    msg_info(2, subject='=?utf-8?q?Relat=C3=B3rio?=', size=5000),
+    msg_info(3, subject='Other', flags=[ '\\Flagged', '\\Seen' ],
+        sender=[ None, None, 'ana', 'example.org' ],
+        date='Sat, 31 Dec 2011 10:00:00 +0000',
+        internaldate='31-Dec-2011 10:00:00 +0000'),
+    ]
+
+def test_filter():
+    assert UNSEEN.filter(MESSAGES) == [ 2 ]
+    assert SUBJECT('report').filter(MESSAGES) == [ 1 ]
+    # Decoded before the comparison
+    assert SUBJECT(u'relat\xf3rio').filter(MESSAGES) == [ 2 ]
+    assert FROM(u'jos\xe9').filter(MESSAGES) == [ 1, 2 ]
+    assert FROM('example.org').filter(MESSAGES) == [ 3 ]
+    assert LARGER(1000).filter(MESSAGES) == [ 2 ]
+    assert SMALLER(1001).filter(MESSAGES) == [ 1, 3 ]
+    assert UID('2:3').filter(MESSAGES) == [ 2, 3 ]
+    assert UID([ 1, 3 ]).filter(MESSAGES) == [ 1, 3 ]
+    assert HEADER('Message-ID', '<3@').filter(MESSAGES) == [ 3 ]
+
+def test_filter_dates():
+    assert SINCE(datetime.date(2012, 1, 1)).filter(MESSAGES) == [ 1, 2 ]
+    assert BEFORE(datetime.date(2012, 1, 1)).filter(MESSAGES) == [ 3 ]
+    assert ON('3-Jan-2012').filter(MESSAGES) == [ 1, 2 ]
+    assert SENTON(datetime.date(2012, 1, 2)).filter(MESSAGES) == [ 1, 2 ]
+    assert SENTBEFORE(datetime.datetime(2012, 1, 1, 12)).filter(
+        MESSAGES) == [ 3 ]
+
+def test_filter_combined():
+    assert (SEEN & ~FLAGGED).filter(MESSAGES) == [ 1 ]
+    assert (FLAGGED | LARGER(4000)).filter(MESSAGES) == [ 2, 3 ]
+    assert NOT(OR(UNSEEN, FLAGGED)).filter(MESSAGES) == [ 1 ]
+    assert AND().filter(MESSAGES) == [ 1, 2, 3 ]
+
+def test_not_evaluable():
+    for query in (BODY('report'), TEXT('report'), KEYWORD('$Label'),
+        HEADER('X-Mailer', 'hlimap'), UID('1:*'), Raw('UNSEEN'),
+        SEEN | BODY('report'), ~TEXT('x')):
+        assert query.filter(MESSAGES) is None
+        with pytest.raises(NotEvaluable):
+            query.match(MESSAGES[0])
+    # No INTERNALDATE
+    assert SINCE(datetime.date(2012, 1, 1)).filter([ { 'UID': 1 } ]) is None
+
+def test_compile_groups():
+    assert OR(SEEN, FLAGGED, UNSEEN).compile() == 'OR SEEN OR FLAGGED UNSEEN'
+    assert (~(SEEN & FLAGGED)).compile() == 'NOT (SEEN FLAGGED)'
+    assert (Raw('OR SEEN FLAGGED') & UNSEEN).compile() == \
+        '(OR SEEN FLAGGED) UNSEEN'
+    assert UID([ 5, 1, 2, 3 ]).compile() == 'UID 1:3,5'
+    assert HEADER('X-Mailer', 'hlimap').compile() == \
+        'HEADER "X-Mailer" "hlimap"'
+
+def refined_list(msg_per_page):
+    server = connect('sort', messages=300)
+    metrics = Commands(server)
+    msg_list = server['INBOX'].message_list
+    msg_list.paginator.msg_per_page = msg_per_page
+    msg_list.set_search_expression(SUBJECT('topic 1'))
+    list(msg_list.msg_iter_page())
+    metrics.reset()
+    return server, metrics, msg_list
+
+def test_refine_locally():
+    server, metrics, msg_list = refined_list(-1)
+    before = list(msg_list.flat_message_list)
+    msg_list.refine(UNSEEN)
+    # No command sent
+    assert metrics.summary() == {}
+    assert list(msg_list.flat_message_list) == [ uid for uid in before
+                                                 if not uid % 4 ]
+
+def test_refine_on_the_server():
+    # Only a page is loaded, the server is asked
+    server, metrics, msg_list = refined_list(20)
+    before = list(msg_list.flat_message_list)
+    msg_list.refine(UNSEEN)
+    assert metrics.summary()['SEARCH']['count'] == 1
+    assert list(msg_list.flat_message_list) == [ uid for uid in before
+                                                 if not uid % 4 ]
+    msg_list.refresh_messages()
+    assert list(msg_list.flat_message_list) == [ uid for uid in before
+                                                 if not uid % 4 ]
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of hlimap.
+##
+## hlimap is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## hlimap is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+
+'''Local search index.
+'''
+
+import pytest
+
+from hlimap.imapsearch import SearchIndex
+from hlimap.imapmessage import UNSORTED
+
+from .fake import Commands, connect
+
+TEXTS = { 1: u'Lorem ipsum, dolor sit amet', 2: u'Relat\xf3rio: dolores',
+          3: u'...' }
+
+def source(text, subtype='plain'):
+    return (u'Content-Type: text/%s; charset=utf-8\r\n'
+        u'Content-Transfer-Encoding: 8bit\r\n\r\n%s' % (subtype,
+        text)).encode('utf-8')
+
+def text_index():
+    index = SearchIndex(index_text=True)
+    for uid, text in TEXTS.items():
+        index.add_source('INBOX', 7, uid, source(text))
+        index.mailbox('INBOX', 7).uids.add(uid)
+    return index
+
+@pytest.mark.parametrize('expression, result', [
+    ('BODY "DOLOR"', [ 1, 2 ]),
+    ('BODY "psu"', [ 1 ]),
+    (u'BODY "relat\xd3rio"', [ 2 ]),
+    ('BODY ""', [ 1, 2, 3 ]),
+    ('NOT BODY dolores', [ 1, 3 ]),
+    ('OR BODY sit BODY dolores UID 1:2', [ 1, 2 ]),
+    # Not single words, the index can't answer
+    ('BODY "ipsum, dolor"', None),
+    ('BODY "..."', None),
+    ('BODY "m d"', None),
+    ('TEXT dolor', None),
+    ('UNSEEN', None),
+    ])
+def test_body(expression, result):
+    index = text_index()
+    assert index.search('INBOX', 7, expression, [ 1, 2, 3 ]) == result
+
+def test_text_not_indexed():
+    index = text_index()
+    index.mailbox('INBOX', 7).uids.add(4)
+    assert index.search('INBOX', 7, 'BODY dolor', [ 1, 2, 3, 4 ]) is None
+
+def test_html_parts():
+    index = SearchIndex(index_text=True)
+    index.add_source('INBOX', 7, 1, b'Content-Type: multipart/alternative; '
+        b'boundary="b"\r\n\r\n--b\r\nContent-Type: text/plain\r\n\r\n'
+        b'alpha\r\n--b\r\nContent-Type: text/html\r\n\r\n<p class="beta">'
+        b'gamma&amp;delta</p><script>epsilon</script>\r\n--b--\r\n')
+    index.mailbox('INBOX', 7).uids.add(1)
+    for word, result in (('alpha', [ 1 ]), ('gamma', [ 1 ]),
+        ('delta', [ 1 ]), ('beta', []), ('class', []), ('epsilon', [])):
+        assert index.search('INBOX', 7, 'BODY %s' % word, [ 1 ]) == result
+
+def test_parts_not_enough():
+    index = text_index()
+    # Only a part of message 4 is indexed
+    index.add_text('INBOX', 7, 4, u'dolor', True)
+    index.mailbox('INBOX', 7).uids.add(4)
+    assert index.search('INBOX', 7, 'BODY dolor', [ 1, 2, 3, 4 ]) is None
+
+def server_list(expression, **account_args):
+    msg_list = connect('imap4rev1', **account_args)['INBOX'].message_list
+    msg_list.show_style = UNSORTED
+    msg_list.set_search_expression(expression)
+    msg_list.refresh_messages()
+    return list(msg_list.flat_message_list)
+
+def test_message_list_local_search():
+    server = connect('imap4rev1')
+    server.set_search_index(SearchIndex())
+    metrics = Commands(server)
+    msg_list = server['INBOX'].message_list
+    msg_list.show_style = UNSORTED
+    for expression in ('SUBJECT "topic 1"', 'OR SUBJECT "topic 2" '
+        'NOT FROM "a"', 'SUBJECT "-"', 'SUBJECT "topic 3"'):
+        msg_list.set_search_expression(expression)
+        msg_list.refresh_messages()
+        assert list(msg_list.flat_message_list) == server_list(expression)
+    # The messages of the folder are searched once
+    assert metrics.summary()['SEARCH']['count'] == 1
+
+def test_message_list_new_messages():
+    server = connect('imap4rev1', messages=20)
+    server.set_search_index(SearchIndex())
+    folder = server['INBOX']
+    msg_list = folder.message_list
+    msg_list.show_style = UNSORTED
+    msg_list.set_search_expression('SUBJECT "topic"')
+    msg_list.refresh_messages()
+    assert len(msg_list.flat_message_list) == 20
+    server._imap.account.mailbox('INBOX').append(3)
+    server['INBOX']
+    msg_list.refresh_messages()
+    assert len(msg_list.flat_message_list) == 23
+
+class TextPart(object):
+    media = 'TEXT'
+    media_subtype = 'PLAIN'
+    body_fld_enc = 'QUOTED-PRINTABLE'
+
+    def query(self):
+        return 'BODY[1]'
+
+    def charset(self):
+        return 'utf-8'
+
+def test_text_from_the_sources():
+    server = connect('imap4rev1', messages=20, text_size=20)
+    server.set_search_index(SearchIndex(index_text=True))
+    msg_list = server['INBOX'].message_list
+    msg_list.show_style = UNSORTED
+    msg_list.refresh_messages()
+    messages = list(msg_list.msg_iter_page())
+    expression = 'BODY consectetur'
+    expected = server_list(expression, messages=20, text_size=20)
+    assert 0 < len(expected) < 20
+
+    # The parts aren't enough
+    for message in messages:
+        message.part(TextPart())
+    metrics = Commands(server)
+    msg_list.set_search_expression(expression)
+    msg_list.refresh_messages()
+    assert list(msg_list.flat_message_list) == expected
+    # The UIDs of the folder, and BODY
+    assert metrics.summary()['SEARCH']['count'] == 2
+
+    for message in messages:
+        message.source()
+    metrics.reset()
+    msg_list.set_search_expression(expression)
+    msg_list.refresh_messages()
+    assert list(msg_list.flat_message_list) == expected
+    assert 'SEARCH' not in metrics.summary()
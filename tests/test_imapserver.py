@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of hlimap.
+##
+## hlimap is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## hlimap is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+
+'''ImapServer with the fake server on benchmarks/.
+'''
+
+import base64
+
+import pytest
+
+from hlimap.imapserver import ImapServer, NoConnectionClass
+
+from .fake import connect
+
+class TextPart(object):
+    media = 'TEXT'
+    media_subtype = 'PLAIN'
+    body_fld_enc = 'QUOTED-PRINTABLE'
+
+    def query(self):
+        return 'BODY[1]'
+
+    def charset(self):
+        return 'utf-8'
+
+def test_no_connection_class():
+    class Server(ImapServer):
+        connection_class = None
+    with pytest.raises(NoConnectionClass):
+        Server()
+
+def test_login_and_folders():
+    server = connect()
+    server.refresh_folders(subscribed=False)
+    assert 'INBOX' in [ folder.path for folder in server ]
+    assert server['INBOX'].messages() == 100
+
+def test_special_folders_first():
+    server = connect(folders=5)
+    server.set_special_folders('Folder0002')
+    server.refresh_folders(subscribed=False)
+    assert server.folder_tree.root_folder == [ 'Folder0002', 'Folder0001',
+        'INBOX' ]
+
+def test_folder_names():
+    server = connect()
+    folder = server['INBOX']
+    assert base64.urlsafe_b64decode(folder.url()) == b'INBOX'
+    folder.name = 'Relat&APM-rios'
+    assert folder.unicode_name() == u'Relat\xf3rios'
+
+def test_message_text():
+    server = connect(text_size=200)
+    message = server['INBOX'][98]
+    assert message.uid == 98
+    text = message.part(TextPart())
+    assert isinstance(text, type(u''))
+    assert u'relat\xf3rio' in text
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of hlimap.
+##
+## hlimap is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## hlimap is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+
+'''Client side sorting, RFC 5256.
+'''
+
+import pytest
+
+from hlimap.imapsort import insert_positions, casemap, base_subject, \
+    subject_key, address_key
+
+from .fake import connect
+
+PROGRAMS = [ ('-DATE',), ('SUBJECT',), ('FROM', '-SIZE'),
+             ('-SUBJECT', 'DATE'), ('-FROM',) ]
+
+def sorted_list(program, capabilities='sort', **account_args):
+    server = connect(capabilities, **account_args)
+    msg_list = server['INBOX'].message_list
+    msg_list.set_sort_program(*program)
+    msg_list.refresh_messages()
+    return server, msg_list
+
+def test_casemap():
+    # Only the ASCII letters
+    assert casemap(u'relat\xf3rio \xe9t\xe9') == u'RELAT\xf3RIO \xe9T\xe9'
+
+@pytest.mark.parametrize('subject, base', [
+    ('Re: Fwd: [list] Topic  (fwd)', 'Topic'),
+    ('[fwd: Topic]', 'Topic'),
+    ('=?utf-8?q?Re=3A_Relat=C3=B3rio?=', u'Relat\xf3rio'),
+    ('[list]', '[list]'),
+    ])
+def test_base_subject(subject, base):
+    assert base_subject(subject) == base
+
+def test_keys():
+    assert subject_key(u'Re: relat\xf3rio') == u'RELAT\xf3RIO'
+    assert address_key('"Jos\xe9" <jos\xe9@example.com>, b@example.com'
+        ) == u'JOS\xe9'
+    assert address_key('=?iso-8859-1?q?Jos=E9?= <jose@example.com>') == \
+        'JOSE'
+    assert address_key(None) == ''
+
+@pytest.mark.parametrize('program', PROGRAMS + [ ('ARRIVAL',),
+    ('-SIZE', 'SUBJECT'), ('-ARRIVAL',) ])
+def test_same_as_server(program):
+    server, server_list = sorted_list(program, messages=300)
+    server, client_list = sorted_list(program, 'imap4rev1', messages=300)
+    assert not client_list.server_sort
+    assert list(client_list.flat_message_list) == list(
+        server_list.flat_message_list)
+
+@pytest.mark.parametrize('program', PROGRAMS)
+def test_insert_positions(program):
+    server, msg_list = sorted_list(program, messages=300)
+    full = list(msg_list.flat_message_list)
+    new = [ 1, 7, 50, 51, 52, 299, 300 ]
+    old = [ uid for uid in full if uid not in new ]
+    positions = insert_positions(server._imap, old, new, program)
+    result = list(old)
+    for position, uid in reversed(positions):
+        result.insert(position, uid)
+    assert result == full
+
+@pytest.mark.parametrize('program', PROGRAMS)
+def test_new_messages_on_sorted_list(program):
+    server, msg_list = sorted_list(program, messages=300)
+    full = list(msg_list.flat_message_list)
+    new = [ 3, 100, 101, 250 ]
+    msg_list.set_message_list([ uid for uid in full if uid not in new ])
+    msg_list.apply_changes(changed=dict([ (uid, []) for uid in new ]))
+    assert not msg_list.refresh
+    assert list(msg_list.flat_message_list) == full
+    assert msg_list.number_messages == 300
+
+def test_new_messages_searched():
+    server, msg_list = sorted_list(('-DATE',), messages=300)
+    msg_list.set_search_expression('FLAGGED')
+    msg_list.refresh_messages()
+    full = list(msg_list.flat_message_list)
+    assert full == [ 300, 250, 200, 150, 100, 50 ]
+    msg_list.set_message_list([ 300, 250, 200, 50 ])
+    msg_list.apply_changes(changed=dict([ (uid, []) for uid in
+        (100, 101, 150, 151) ]))
+    assert list(msg_list.flat_message_list) == full
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of hlimap.
+##
+## hlimap is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## hlimap is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+
+'''Client side threading, RFC 5256.
+'''
+
+import pytest
+
+from hlimap.imapthread import thread_messages, sort_threads, THREAD_QUERY
+from hlimap.imapmessage import THREADED
+
+from .fake import connect, Commands
+
+class FetchedMessages(object):
+    '''Replaces the IMAP4P instance, the messages are fetched beforehand.
+    '''
+
+    def __init__(self, msg_dict):
+        self.msg_dict = msg_dict
+
+    def fetch_smart(self, message_list, query):
+        return self.msg_dict
+
+def fetched(messages):
+    '''Fetch responses for the messages.
+
+    @param messages: list of (UID, day of the month, header text) tuples
+    '''
+    key = THREAD_QUERY.strip('()').split(' ', 1)[1].replace('.PEEK', '')
+    return FetchedMessages(dict([ (uid, { 'UID': uid,
+        'INTERNALDATE': '%02d-Jan-2010 00:00:00 +0000' % day,
+        key: 'Date: %02d Jan 2010 00:00:00 +0000\r\n%s\r\n\r\n' % (day,
+            text) }) for uid, day, text in messages ]))
+
+@pytest.mark.parametrize('algorithm', [ 'REFERENCES', 'ORDEREDSUBJECT' ])
+def test_same_as_server(algorithm):
+    server = connect('sort', messages=53)
+    server['INBOX']
+    imap = server._imap
+    assert thread_messages(imap, imap.search_smart('ALL'), algorithm) == \
+        imap.thread_smart(algorithm, 'utf-8', 'ALL')
+
+def test_references_subjects_gathered_by_date():
+    # The oldest message with the subject takes the reply, the root set is
+    # sorted before the subjects are gathered
+    imap = fetched([
+        (1, 3, 'Message-ID: <1@x>\r\nSubject: X'),
+        (2, 1, 'Message-ID: <2@x>\r\nSubject: X'),
+        (3, 2, 'Message-ID: <3@x>\r\nSubject: Re: X'),
+        ])
+    assert thread_messages(imap, [ 1, 2, 3 ]) == [ [ [ 2, 3 ], [ 1 ] ] ]
+
+def test_references_links():
+    imap = fetched([
+        (1, 1, 'Message-ID: <1@x>\r\nSubject: A'),
+        (2, 2, 'Message-ID: <2@x>\r\nSubject: Re: A\r\nReferences: <1@x>'),
+        (3, 3, 'Message-ID: <3@x>\r\nSubject: Re: A\r\n'
+            'References: <1@x> <2@x>'),
+        (4, 4, 'Message-ID: <4@x>\r\nSubject: Re: A\r\nIn-Reply-To: <1@x>'),
+        (5, 5, 'Message-ID: <5@x>\r\nSubject: B'),
+        ])
+    assert thread_messages(imap, [ 1, 2, 3, 4, 5 ]) == [
+        [ 1, [ 2, 3 ], [ 4 ] ], [ 5 ] ]
+
+def test_sort_threads_latest():
+    imap = fetched([
+        (1, 1, 'Message-ID: <1@x>\r\nSubject: A'),
+        (2, 2, 'Message-ID: <2@x>\r\nSubject: B'),
+        (3, 3, 'Message-ID: <3@x>\r\nSubject: Re: A\r\nReferences: <1@x>'),
+        ])
+    threads = thread_messages(imap, [ 1, 2, 3 ])
+    assert threads == [ [ 1, 3 ], [ 2 ] ]
+    assert sort_threads(imap, threads, ('-DATE',), latest=True) == [
+        [ 1, 3 ], [ 2 ] ]
+    assert sort_threads(imap, threads, ('-DATE',)) == [ [ 2 ], [ 1, 3 ] ]
+
+# Threads sorted on the message list
+
+def size(uid):
+    return 2000 + (uid * 7919) % 20000
+
+def threaded_list(*sort_program, **options):
+    server = connect('sort', messages=12)
+    metrics = Commands(server)
+    msg_list = server['INBOX'].message_list
+    msg_list.show_style = THREADED
+    msg_list.set_sort_program(*sort_program)
+    msg_list.set_thread_sort(True, **options)
+    msg_list.refresh_messages()
+    return metrics.summary(), list(msg_list.flat_message_list)
+
+def test_server_thread_sorted_by_date():
+    summary, uid_list = threaded_list('-DATE')
+    assert uid_list == [ 11, 12, 6, 10, 9, 8, 7, 1, 5, 4, 3, 2 ]
+    # The server threads, the sort keys are fetched at once
+    assert summary['THREAD']['count'] == 1
+    assert summary['FETCH']['count'] == 1
+    assert 'SORT' not in summary
+
+def test_server_thread_sorted_by_size():
+    summary, uid_list = threaded_list('SIZE')
+    roots = sorted([ 1, 6, 11 ], key=size)
+    expected = []
+    for root in roots:
+        expected.append(root)
+        expected.extend(sorted([ uid for uid in range(root + 1, root + 5)
+                                 if uid <= 12 ], key=size))
+    assert uid_list == expected
+
+def test_server_thread_not_sorted():
+    server = connect('sort', messages=12)
+    msg_list = server['INBOX'].message_list
+    msg_list.show_style = THREADED
+    msg_list.set_sort_program('-DATE')
+    msg_list.refresh_messages()
+    assert list(msg_list.flat_message_list) == list(range(1, 13))
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of hlimap.
+##
+## hlimap is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## hlimap is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+
+'''Paging through a message list, with ESEARCH/ESORT PARTIAL and the
+prefetch of the pages around.
+'''
+
+import pytest
+
+from hlimap.imapmessage import SORTED, UNSORTED
+from hlimap.imappool import PooledImapServer
+from .fake import Commands, connect
+
+def pages(msg_list):
+    result = []
+    for page in range(1, msg_list.paginator.max_page + 1):
+        msg_list.paginator.current_page = page
+        result.append([ message.uid for message in msg_list.msg_iter_page() ])
+    return result
+
+def message_list(capabilities, style, expression='ALL'):
+    server = connect(capabilities, messages=230)
+    msg_list = server['INBOX'].message_list
+    msg_list.show_style = style
+    msg_list.paginator.msg_per_page = 20
+    msg_list.set_search_expression(expression)
+    return server, msg_list
+
+@pytest.mark.parametrize('style, expression', [ (SORTED, 'ALL'),
+    (UNSORTED, 'ALL'), (SORTED, 'UNSEEN'), (UNSORTED, 'NOT FLAGGED') ])
+def test_same_pages(style, expression):
+    server, window = message_list('modern', style, expression)
+    window.refresh_messages()
+    assert window.use_partial()
+    server, full = message_list('sort', style, expression)
+    full.refresh_messages()
+    assert not full.use_partial()
+    assert window.number_messages == full.number_messages
+    assert window.paginator.max_page == full.paginator.max_page
+    assert pages(window) == pages(full)
+
+def test_window():
+    server, msg_list = message_list('modern', SORTED)
+    metrics = Commands(server)
+    def sort_commands():
+        return metrics.summary()['UID SORT']['count']
+    msg_list.refresh_messages()
+    assert msg_list.number_messages == 230
+    assert msg_list.paginator.max_page == 12
+    # Only the page is loaded
+    assert len(msg_list.flat_message_list) == 20
+    assert msg_list.window_start == 0
+    assert sort_commands() == 1
+
+    msg_list.paginator.current_page = 3
+    for count in range(2):
+        assert len(list(msg_list.msg_iter_page())) == 20
+    assert msg_list.window_start == 40
+    assert sort_commands() == 2
+    # The last page
+    msg_list.paginator.current_page = 12
+    assert len(list(msg_list.msg_iter_page())) == 10
+    assert sort_commands() == 3
+
+# Prefetch of the pages around
+
+def fetched(metrics):
+    return metrics.summary().get('FETCH', {}).get('items', 0)
+
+@pytest.mark.parametrize('capabilities', [ 'sort', 'modern' ])
+def test_prefetch_on_the_same_connection(capabilities):
+    server, msg_list = message_list(capabilities, SORTED)
+    msg_list.set_prefetch(1)
+    metrics = Commands(server)
+    assert len(list(msg_list.msg_iter_page())) == 20
+    # The current page and the next one on the same FETCH
+    assert metrics.summary()['FETCH']['count'] == 1
+    assert fetched(metrics) == 40
+    msg_list.paginator.current_page = 2
+    metrics.reset()
+    assert len(list(msg_list.msg_iter_page())) == 20
+    # The page 2 is in memory, only the page 3 is fetched
+    assert metrics.summary()['FETCH']['count'] == 1
+    assert fetched(metrics) == 20
+    msg_list.paginator.current_page = 3
+    metrics.reset()
+    assert len(list(msg_list.msg_iter_page())) == 20
+    # The page 3 was prefetched, the page 4 is fetched
+    assert fetched(metrics) == 20
+    assert [ message.uid for message in msg_list.msg_iter_page() ] == \
+        list(range(190, 170, -1))
+
+def test_prefetch_pages():
+    server, msg_list = message_list('sort', SORTED)
+    msg_list.set_prefetch(1)
+    list(msg_list.msg_iter_page())
+    msg_list.paginator.current_page = 2
+    # The next page first, the page 1 was shown so it's loaded again
+    assert msg_list.prefetcher.page_ids() == msg_list.page_list(3) + \
+        msg_list.page_list(1)
+    # On a single connection the page 3, never fetched, is loaded though the
+    # page 2 was prefetched
+    list(msg_list.msg_iter_page())
+    assert msg_list.prefetcher.page_ids() == msg_list.page_list(1)
+
+def test_prefetch_disabled():
+    server, msg_list = message_list('sort', SORTED)
+    msg_list.set_prefetch(0)
+    assert msg_list.prefetcher is None
+    metrics = Commands(server)
+    list(msg_list.msg_iter_page())
+    assert fetched(metrics) == 20
+
+def test_prefetch_on_another_connection():
+    server = connect('sort', base=PooledImapServer, messages=230)
+    msg_list = server['INBOX'].message_list
+    msg_list.show_style = SORTED
+    msg_list.paginator.msg_per_page = 20
+    msg_list.set_prefetch(1)
+    metrics = Commands(server)
+    assert [ message.uid for message in msg_list.msg_iter_page() ] == \
+        list(range(230, 210, -1))
+    msg_list.prefetcher.wait()
+    # The current page, then the next one in the background
+    assert metrics.summary()['FETCH']['count'] == 2
+    assert fetched(metrics) == 40
+    msg_list.paginator.current_page = 2
+    assert [ message.uid for message in msg_list.msg_iter_page() ] == \
+        list(range(210, 190, -1))
+    msg_list.prefetcher.wait()
+    # The page 2 was prefetched, the pages 1 and 3 are loaded again
+    assert metrics.summary()['FETCH']['count'] == 3
+    assert fetched(metrics) == 80
+
+def test_prefetch_discarded_after_refresh():
+    server, msg_list = message_list('sort', SORTED)
+    msg_list.set_prefetch(1)
+    list(msg_list.msg_iter_page())
+    msg_list.refresh_messages()
+    metrics = Commands(server)
+    msg_list.paginator.current_page = 2
+    assert len(list(msg_list.msg_iter_page())) == 20
+    assert fetched(metrics) > 0
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+## This file is part of hlimap.
+##
+## hlimap is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## hlimap is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@paxjulia.com>
+#
+
+'''Sequence sets.
+'''
+
+import pytest
+
+from hlimap.utils import sequence_set, sequence_sets, split_message_list, \
+    address_text
+from hlimap.imapext import parse_sequence_set
+from .fake import Commands, connect
+
+def test_sequence_set():
+    assert sequence_set([ 5, 1, 2, 3, 3, 7, 8 ]) == '1:3,5,7:8'
+    assert sequence_set(4) == '4'
+    assert sequence_set([]) == ''
+    assert parse_sequence_set('1:3,5,8:7') == [ 1, 2, 3, 5, 7, 8 ]
+
+@pytest.mark.parametrize('max_length', [ 20, 100, 8000 ])
+def test_sequence_sets(max_length):
+    uid_list = list(range(1, 20000, 3)) + list(range(30000, 31000))
+    sets = sequence_sets(uid_list, max_length)
+    assert max([ len(item) for item in sets ]) <= max_length
+    uids = []
+    for item in sets:
+        uids.extend(parse_sequence_set(item))
+    assert uids == uid_list
+    if max_length == 8000:
+        assert len(sets) == 5
+
+def test_address_text():
+    addresses = [ ('=?utf-8?q?Jos=C3=A9?=', None, 'jose', 'example.com'),
+                  (None, None, 'ana', 'example.org') ]
+    assert address_text(addresses) == \
+        u'Jos\xe9 <jose@example.com>, ana@example.org'
+    assert address_text(None) == u''
+
+def test_split_message_list():
+    uid_list = list(range(1, 1000))
+    parts = split_message_list(uid_list, 100)
+    assert sum(parts, []) == uid_list
+    assert max([ len(','.join(map(str, part))) for part in parts ]) < 100
+
+def test_store_flags_split():
+    server = connect(messages=20000)
+    folder = server['INBOX']
+    uid_list = list(range(1, 20001, 2))
+    metrics = Commands(server)
+    assert folder.store_flags(uid_list, '+FLAGS.SILENT', [ r'\Flagged' ]
+        ) == {}
+    assert metrics.summary()['UID STORE']['count'] == len(
+        sequence_sets(uid_list))
+    assert metrics.summary()['UID STORE']['count'] > 1
+    mailbox = server._imap.account.mailbox('INBOX')
+    assert r'\Flagged' in mailbox.flags(19999)
+    assert r'\Flagged' not in mailbox.flags(2)